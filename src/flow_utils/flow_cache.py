@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+import time
+from typing import Optional, Union
+
+import tyro
+from typing_extensions import Annotated
+
+from pipeline_utils.cache import CacheManager, EVICTION_POLICIES
+
+
+def format_bytes(n: int) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if n < 1024 or unit == 'TB':
+            return f'{n:.0f}{unit}' if unit == 'B' else f'{n:.1f}{unit}'
+        n /= 1024
+
+
+def format_time(timestamp: Optional[float]) -> str:
+    if timestamp is None:
+        return '-'
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+@dataclass
+class ListEntries:
+    """Lists the cached outputs in cache_dir"""
+    cache_dir: Path = Path('.')
+    cache: Optional[str] = None # Only list entries of this cache
+    node: Optional[str] = None # Only list entries produced by this node
+
+    def run(self):
+        entries = CacheManager(self.cache_dir).entries()
+        total = 0
+        for (name, key), entry in sorted(entries.items()):
+            if self.cache is not None and name != self.cache:
+                continue
+            if self.node is not None and entry.get('node') != self.node:
+                continue
+            runtime = entry.get('runtime')
+            print(f'{name}\t{key}\t{format_bytes(entry.get("size", 0))}\t'
+                  + f'{format_time(entry.get("accessed"))}\t'
+                  + ('-' if runtime is None else f'{runtime:.2f}s') + '\t'
+                  + entry.get('node', '-'))
+            total += entry.get('size', 0)
+        print(f'Total: {format_bytes(total)}')
+
+
+@dataclass
+class Inspect:
+    """Prints the index entry and files of a key"""
+    key: tyro.conf.Positional[str]
+    cache_dir: Path = Path('.')
+    cache: Optional[str] = None # Cache holding key (default: any)
+
+    def run(self):
+        manager = CacheManager(self.cache_dir)
+        caches = {cache.name: cache for cache in manager.caches()}
+        found = False
+        for (name, key), entry in manager.entries().items():
+            if key != self.key or (self.cache is not None
+                                   and name != self.cache):
+                continue
+            found = True
+            print(f'{name}: {key}')
+            for field, value in entry.items():
+                if field in ('created', 'accessed'):
+                    value = format_time(value)
+                elif field == 'size':
+                    value = format_bytes(value)
+                print(f'  {field}: {value}')
+            for path in caches[name].entry_files(key):
+                print(f'  > {path}')
+            if caches[name].in_progress(key):
+                print('  (being computed)')
+        if not found:
+            print(f'{self.key} not found in {self.cache_dir}')
+
+
+@dataclass
+class Prune:
+    """Removes cached outputs from cache_dir. Entries whose files have gone
+    missing are always removed from the index."""
+    cache_dir: Path = Path('.')
+    older_than_days: Optional[float] = None # Remove entries not accessed since
+    node: Optional[str] = None # Remove entries produced by this node
+    max_bytes: Optional[int] = None # Then evict until cache_dir fits
+    policy: str = 'lru' # Eviction policy for max_bytes
+    dry_run: bool = False # Only print what would be removed
+
+    def run(self):
+        assert self.policy in EVICTION_POLICIES, \
+            f'policy must be one of {EVICTION_POLICIES}'
+        manager = CacheManager(self.cache_dir, self.max_bytes, self.policy)
+        accessed_before = None
+        if self.older_than_days is not None:
+            accessed_before = time.time() - self.older_than_days*24*3600
+        removed = manager.prune(accessed_before, self.node, self.dry_run)
+        pruned = {(cache.name, key) for cache, key in removed}
+        # A dry run evicts as if nothing had been pruned
+        removed += [(cache, key)
+                    for cache, key in manager.evict(self.dry_run)
+                    if (cache.name, key) not in pruned]
+        for cache, key in removed:
+            print(f'{"Would remove" if self.dry_run else "Removed"} '
+                  + f'{cache.name}: {key}')
+        print(f'{len(removed)} entries, {format_bytes(manager.nbytes())} left')
+
+
+Command = Union[
+    Annotated[ListEntries, tyro.conf.subcommand('list')],
+    Annotated[Inspect, tyro.conf.subcommand('inspect')],
+    Annotated[Prune, tyro.conf.subcommand('prune')],
+]
+
+
+def hook():
+    """Special for project.scripts in pyproject.toml"""
+    tyro.cli(
+        Command,
+        description='Lists, inspects and prunes the outputs cached by pipeline nodes',
+    ).run()
+
+if __name__ == '__main__':
+    hook()
@@ -1,28 +1,52 @@
 from abc import ABC, abstractmethod
-from collections.abc import Mapping
+import atexit
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
 from functools import partial
+import inspect
 import metrohash
 import json
+import os
 from pathlib import Path
+import shutil
+import threading
+import time
 from typing import Callable, Optional
+import weakref
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
 import numpy as np
+import torch
 
 from .conversion import (
     DeviceArray,
-    to_nested_mapping,
-    to_np,
+    copy_structure,
+    host_view,
+    infer_all,
+    iter_leaves,
+    map_leaves,
+    nbytes,
+    on_device,
     recursive_apply_inplace_with_stop,
-    is_numeric,
-    is_array,
     is_leaf,
-    is_leaf_or_device_arr
+    is_leaf_or_device_arr,
+    unpack_all,
 )
+from .chunked import ChunkedArray, ChunksRef, finalize, replace_dir, write_chunks
+from .compression import buffer_kind, get_codec
+from .hashing import array_digest, hash_data, HashMemo, recursive_hash
+from .index import CacheIndex, open_index
+from .lazy import is_lazy, lazy_view
 
 
 class Cache(ABC):
@@ -34,91 +58,1232 @@ class Cache(ABC):
     def load(self, key):
         return NotImplemented
 
+    def __contains__(self, key):
+        """Whether key can be loaded. Caches that can't check cheaply return
+        False, which only disables skipping of upstream nodes."""
+        return False
+
+    def known_miss(self, key) -> bool:
+        """Whether key is known not to be stored, so that loading it can be
+        skipped. Caches that can't tell cheaply return False."""
+        return False
+
+    def lock(self, key):
+        """Context manager held while computing the output for key, so that
+        concurrent callers compute it only once. Defaults to no locking."""
+        return nullcontext()
 
-def recursive_hash(data, hash_fn):
-    """hash_fn should be an incremental hash function"""
-    if is_numeric(data):
-        hash_fn(str(data))
-    elif isinstance(data, str):
-        hash_fn(data)
-    elif is_array(data):
-        hash_fn(np.ascontiguousarray(to_np(data)))
-    elif isinstance(data, Mapping):
-        for k, v in data.items():
-            recursive_hash(k, hash_fn)
-            recursive_hash(v, hash_fn)
-    elif isinstance(data, list) or isinstance(data, tuple):
-        for v in data:
-            recursive_hash(v, hash_fn)
-
-
-def hash_data(data):
-    hash_obj = metrohash.MetroHash64()
-    recursive_hash(
-        to_nested_mapping(data),
-        hash_obj.update
+    def record_runtime(self, key, runtime: float, node: Optional[str] = None):
+        """Records how long the output for key took to compute, and the
+        name of the node that produced it, for cost-aware eviction and
+        listing. Defaults to doing nothing."""
+        pass
+
+
+@contextmanager
+def atomic_open(path: Path, mode: str = 'wb'):
+    """Writes to a temporary file that is renamed to path once it has been
+    completely written, so readers never see a partial file"""
+    tmp = path.with_name(
+        f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp'
     )
-    return hash_obj.hexdigest()
+    try:
+        with open(tmp, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def path_size(path: Path) -> int:
+    """Size of a file, or of all files under a directory"""
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+    return path.stat().st_size
+
+
+@contextmanager
+def file_lock(path: Path, blocking: bool = True):
+    """Exclusive advisory lock on path for the duration of the context.
+    Yields whether the lock was acquired, which is always True when
+    blocking. Locks are released by the OS if the process dies.
+    Does nothing where fcntl is unavailable.
+    """
+    if fcntl is None:
+        yield True
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f.fileno(),
+                        fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+EVICTION_POLICIES = ('lru', 'cost')
+
+
+def entry_blobs(entry: dict) -> dict:
+    """name -> size of the shared blobs an index entry references (see
+    DedupPklCache). These are not included in the entry's size."""
+    blobs = entry.get('blobs', {})
+    # Entries from json indexes list names only, and include blob sizes
+    # in their size
+    return blobs if isinstance(blobs, dict) else {}
+
+
+def total_size(entries: dict) -> int:
+    """Total size of index entries, counting each blob they share once"""
+    blobs = {}
+    for entry in entries.values():
+        blobs.update(entry_blobs(entry))
+    return sum(entry.get('size', 0) for entry in entries.values()) \
+        + sum(blobs.values())
+
+
+def select_evictions(entries: dict,
+                     max_bytes: int,
+                     policy: str = 'lru',
+                     protect: Optional[set] = None) -> list:
+    """Chooses keys to evict so that the total size of entries fits in
+    max_bytes. Blobs shared by several entries count once, and are only
+    freed once all the entries referencing them are evicted.
+
+    entries: key -> index entry (see index.CacheIndex)
+    policy:
+      'lru': least recently accessed first.
+      'cost': lowest recorded compute time per byte first, so outputs that
+        are cheap to recompute but large go first. Entries without a
+        recorded runtime count as free to recompute. Ties are broken by
+        least recent access.
+    protect: keys that must not be evicted
+    """
+    protect = protect or set()
+    total = total_size(entries)
+    if total <= max_bytes:
+        return []
+    if policy == 'lru':
+        order = lambda item: item[1].get('accessed', 0)
+    elif policy == 'cost':
+        order = lambda item: (
+            item[1].get('runtime', 0) / max(
+                item[1].get('size', 0) + sum(entry_blobs(item[1]).values()), 1
+            ),
+            item[1].get('accessed', 0),
+        )
+    else:
+        raise ValueError(f'Unknown eviction policy: {policy}, must be one of {EVICTION_POLICIES}')
+    refs = Counter(name for entry in entries.values()
+                   for name in entry_blobs(entry))
+    evicted = []
+    for key, entry in sorted(entries.items(), key=order):
+        if total <= max_bytes:
+            break
+        if key in protect:
+            continue
+        evicted.append(key)
+        total -= entry.get('size', 0)
+        for name, size in entry_blobs(entry).items():
+            refs[name] -= 1
+            if refs[name] == 0:
+                total -= size
+    return evicted
 
 
 class PklCache(Cache):
+    """Sharded pickle cache
+
+    Each key is pickled to its own file inside `shard_dir`, so loading or
+    storing one key only touches the bytes for that key. A SQLite index
+    shared by all caches in cache_dir (see index.CacheIndex) maps keys to
+    their shard files.
+
+    Caches written in the old single-file layout (`cache_dir/name`) or with
+    a json index (`shard_dir/index.json`) are migrated on first access.
+
+    Safe for concurrent use by several processes: files are replaced
+    atomically, multi-entry updates to the index are serialized by a file
+    lock, and lock(key) holds a per-key lock file while the key is being
+    computed.
+
+    The index also records each entry's size, creation and last access
+    times, compute runtime and producer node. If max_bytes is set, entries
+    are evicted after each store according to eviction_policy (see
+    select_evictions).
+
+    With lazy, load returns a lazy view of the output (see lazy.lazy_view)
+    whose array leaves are only converted and moved to device_idx when they
+    are first accessed. Combine with MmapPklCache to also defer reading
+    them from disk. Lazy objects are instances of a subclass of their class;
+    pass lazy=False to load for the output as the eager path returns it.
+    """
+    legacy_index_filename = 'index.json'
+
     def __init__(self,
                  name: Optional[str] = None,
                  cache_dir: Optional[Path] = None,
                  load_callback: Optional[Callable] = None,
                  store_callback: Optional[Callable] = None,
+                 max_bytes: Optional[int] = None,
+                 eviction_policy: str = 'lru',
+                 lazy: bool = False,
     ):
         self.filename = name or 'cache.pkl'
         self.cache_dir = cache_dir or Path('.')
         self.load_callback = load_callback or (lambda x: x)
         self.store_callback = store_callback or (lambda x: x)
+        self.max_bytes = max_bytes
+        self.eviction_policy = eviction_policy
+        self.lazy = lazy
 
     @property
     def filepath(self) -> Path:
+        """Location of the legacy single-file cache"""
         return self.cache_dir/self.filename
 
-    def store(self, key, data):
-        data = self.store_callback(data)
-        data = recursive_apply_inplace_with_stop(
-            data, DeviceArray.infer, is_leaf
-        )
-        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+    @property
+    def shard_dir(self) -> Path:
+        return self.cache_dir/Path(self.filename).stem
+
+    @property
+    def name(self) -> str:
+        """Name of the cache in the index"""
+        return self.shard_dir.name
+
+    @property
+    def index(self) -> CacheIndex:
+        return open_index(self.cache_dir)
+
+    @property
+    def legacy_index_path(self) -> Path:
+        return self.shard_dir/self.legacy_index_filename
+
+    def shard_path(self, key) -> Path:
+        return self.shard_dir/f'{metrohash.hash64_hex(key)}.pkl'
+
+    def lock_path(self, key) -> Path:
+        return self.shard_path(key).with_suffix('.lock')
+
+    def lock(self, key):
+        return file_lock(self.lock_path(key))
+
+    def in_progress(self, key) -> bool:
+        """Whether another caller currently holds the lock for key"""
+        if not self.lock_path(key).is_file():
+            return False
+        with file_lock(self.lock_path(key), blocking=False) as acquired:
+            return not acquired
 
-        cache = {}
-        if self.filepath.is_file():
+    def index_lock(self):
+        return file_lock(self.shard_dir/'index.lock')
+
+    def entry_files(self, key):
+        """All files holding the output for key"""
+        stem = self.shard_path(key).stem
+        return [path for path in self.shard_dir.glob(f'{stem}.*')
+                if path.suffix != '.lock']
+
+    def read_index(self) -> dict:
+        """key -> {'file', 'size', 'created', 'accessed', 'runtime', 'node'}
+        Fields other than 'file' may be missing.
+        Entries without 'file' only hold metadata for a pending store.
+        """
+        self.migrate()
+        return self.index.entries(self.name)
+
+    def keys(self):
+        self.migrate()
+        return self.index.keys(self.name)
+
+    def __contains__(self, key):
+        self.migrate()
+        return self.index.contains(self.name, key)
+
+    def known_miss(self, key) -> bool:
+        return key not in self
+
+    def migrate(self):
+        """Split a legacy single-file cache into per-key shards, and move
+        a legacy json index into the SQLite index"""
+        if self.legacy_index_path.is_file():
+            self._migrate_index()
+        if not self.filepath.is_file():
+            return
+        with self.index_lock():
+            if not self.filepath.is_file(): # Migrated by another process
+                return
             with open(self.filepath, 'rb') as f:
                 cache = pickle.load(f)
                 assert isinstance(cache, dict)
-        cache[key] = data
-        with open(self.filepath, 'wb') as f:
-            pickle.dump(cache, f)
+            for key, data in cache.items():
+                self._write_shard(key, data)
+                self.index.update(self.name, key, **self._entry(key))
+            self.filepath.unlink()
+
+    def _migrate_index(self):
+        with self.index_lock():
+            try:
+                with open(self.legacy_index_path, 'r') as f:
+                    index = json.load(f)
+            except FileNotFoundError: # Migrated by another process
+                return
+            with self.index.transaction():
+                for key, entry in index.items():
+                    if isinstance(entry, str): # Filename only
+                        entry = {'file': entry}
+                    self.index.update(self.name, key, **entry)
+            self.legacy_index_path.unlink()
+
+    def _entry(self, key) -> dict:
+        """Index fields for a newly written key"""
+        now = time.time()
+        return {
+            'file': self.shard_path(key).name,
+            'size': sum(path_size(path) for path in self.entry_files(key)),
+            'created': now,
+            'accessed': now,
+        }
+
+    def _write_shard(self, key, data):
+        with atomic_open(self.shard_path(key)) as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _read_shard(self, key):
+        with open(self.shard_path(key), 'rb') as f:
+            return pickle.load(f)
+
+    def store(self, key, data):
+        self.migrate()
+        data = self.store_callback(data)
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        # Serialized from a view: data is left untouched, and GPU tensors
+        # are only copied to (reused) host buffers, not back to the GPU
+        with host_view(data) as packed:
+            self._write_shard(key, packed)
+        self._commit_index(key)
+
+    def _commit_index(self, key):
+        """Records a newly written key in the index"""
+        self.index.update(self.name, key, **self._entry(key))
+        if self.max_bytes is not None:
+            with self.index_lock():
+                self._evict(self.max_bytes, protect={key})
+
+    def load(self, key, device_idx=None, lazy: Optional[bool] = None):
+        """lazy: overrides self.lazy for this load, e.g. lazy=False for
+        callers that compare or type-check the output"""
+        self.migrate()
+        try:
+            data = self._read_shard(key)
+        except FileNotFoundError:
+            return None
+        self._touch(key)
+        return self._unpack(data, device_idx, lazy)
+
+    def _unpack(self, data, device_idx=None, lazy: Optional[bool] = None):
+        unpack = partial(DeviceArray.unpack,
+                         device_idx=device_idx)
+        if self.lazy if lazy is None else lazy:
+            data = lazy_view(data, unpack, is_leaf_or_device_arr)
+        else:
+            data = unpack_all(data, device_idx)
+        data = self.load_callback(data)
+        return data
+
+    def _touch(self, key):
+        self.index.touch(self.name, key, time.time())
 
-        data = recursive_apply_inplace_with_stop(
-            data, DeviceArray.unpack, is_leaf_or_device_arr
+    def record_runtime(self, key, runtime: float, node: Optional[str] = None):
+        fields = {'runtime': runtime}
+        if node is not None:
+            fields['node'] = node
+        self.index.update(self.name, key, **fields)
+
+    def _remove(self, key):
+        for path in self.entry_files(key):
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+        self.index.remove(self.name, key)
+
+    def remove(self, key):
+        """Deletes the output for key"""
+        with self.index_lock():
+            self._remove(key)
+
+    def _evict(self, max_bytes, policy=None, protect=None):
+        if self._nbytes() <= max_bytes:
+            return []
+        index = self.index.entries(self.name)
+        protect = set(protect or ())
+        protect.update(key for key in index if self.in_progress(key))
+        evicted = select_evictions(
+            {key: entry for key, entry in index.items() if 'file' in entry},
+            max_bytes,
+            policy or self.eviction_policy,
+            protect,
         )
+        for key in evicted:
+            self._remove(key)
+        return evicted
 
-    def load(self, key, device_idx=None):
-        if not self.filepath.is_file():
+    def evict(self, max_bytes: Optional[int] = None,
+              policy: Optional[str] = None) -> list:
+        """Evicts entries until the cache fits in max_bytes (default:
+        self.max_bytes). Returns the evicted keys."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return []
+        self.migrate()
+        with self.index_lock():
+            return self._evict(max_bytes, policy)
+
+    def nbytes(self) -> int:
+        """Total size of the cached outputs, according to the index"""
+        self.migrate()
+        return self._nbytes()
+
+    def _nbytes(self) -> int:
+        return self.index.nbytes(self.name)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.shard_dir})'
+
+
+class CacheManager:
+    """Enforces a byte budget across all the PklCache-style caches in a
+    cache_dir (one subdirectory per cache, sharing the cache_dir's index),
+    and lists and prunes their entries (see flow_utils.flow_cache)
+    """
+    def __init__(self,
+                 cache_dir: Path,
+                 max_bytes: Optional[int] = None,
+                 policy: str = 'lru',
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+    def caches(self) -> list:
+        names = set(open_index(self.cache_dir).caches())
+        names.update(path.parent.name for path in self.cache_dir.glob(
+            f'*/{PklCache.legacy_index_filename}'
+        ))
+        return [PklCache(f'{name}.pkl', self.cache_dir)
+                for name in sorted(names)]
+
+    def nbytes(self) -> int:
+        """Total size of all stored outputs, counting shared blobs once"""
+        return total_size(self.entries())
+
+    def entries(self) -> dict:
+        """(cache name, key) -> index entry, for all stored outputs"""
+        return {(name, key): entry
+                for cache in self.caches()
+                for name in [cache.name]
+                for key, entry in cache.read_index().items()
+                if 'file' in entry}
+
+    def evict(self, dry_run: bool = False) -> list:
+        """Evicts entries across all caches until cache_dir fits in
+        max_bytes. Returns the evicted (cache, key) pairs."""
+        if self.max_bytes is None:
+            return []
+        caches = {cache.name: cache for cache in self.caches()}
+        entries = self.entries()
+        protect = {(name, key) for name, key in entries
+                   if caches[name].in_progress(key)}
+        evicted = select_evictions(entries, self.max_bytes, self.policy,
+                                   protect)
+        return self._remove(caches, evicted, dry_run)
+
+    def prune(self,
+              accessed_before: Optional[float] = None,
+              node: Optional[str] = None,
+              dry_run: bool = False) -> list:
+        """Removes the entries last accessed before accessed_before (a
+        timestamp) and/or produced by node, as well as entries whose files
+        have gone missing. Returns the removed (cache, key) pairs.
+        """
+        caches = {cache.name: cache for cache in self.caches()}
+        pruned = []
+        for (name, key), entry in self.entries().items():
+            if caches[name].in_progress(key):
+                continue
+            missing = not (caches[name].shard_dir/entry['file']).exists()
+            selected = (
+                (accessed_before is not None or node is not None)
+                and (accessed_before is None
+                     or entry.get('accessed', 0) < accessed_before)
+                and (node is None or entry.get('node') == node)
+            )
+            if missing or selected:
+                pruned.append((name, key))
+        return self._remove(caches, pruned, dry_run)
+
+    def _remove(self, caches, entries, dry_run):
+        if not dry_run:
+            for name, key in entries:
+                caches[name].remove(key)
+            if entries:
+                collect_garbage(self.cache_dir)
+        return [(caches[name], key) for name, key in entries]
+
+
+class MmapPklCache(PklCache):
+    """Sharded pickle cache with memory-mapped array leaves
+
+    Array buffers are pickled out-of-band (pickle protocol 5) and written
+    back-to-back, aligned, into a `.buf` container next to each shard.
+    Loading memory-maps the container copy-on-write, so arrays are returned
+    without copying and only the pages that are actually read get loaded.
+    """
+    alignment = 64
+
+    def buffer_paths(self, key):
+        return self.shard_dir.glob(f'{self.shard_path(key).stem}.*.buf')
+
+    def _write_shard(self, key, data):
+        buffers = []
+        payload = pickle.dumps(data, protocol=5,
+                               buffer_callback=buffers.append)
+        layout = []
+        # Each write gets its own container, so a reader holding the old
+        # shard never sees a new container
+        buffer_path = self.shard_path(key).with_suffix(
+            f'.{os.getpid()}-{threading.get_ident()}-{time.time_ns()}.buf'
+        )
+        with atomic_open(buffer_path) as f:
+            offset = 0
+            for buf in buffers:
+                raw = buf.raw()
+                pad = -offset % self.alignment
+                f.write(b'\0' * pad)
+                offset += pad
+                f.write(raw)
+                layout.append((offset, raw.nbytes))
+                offset += raw.nbytes
+        with atomic_open(self.shard_path(key)) as f:
+            pickle.dump({'layout': layout,
+                         'buffer': buffer_path.name,
+                         'payload': payload}, f,
+                        protocol=5)
+        for path in self.buffer_paths(key):
+            if path != buffer_path:
+                path.unlink(missing_ok=True)
+
+    def _read_shard(self, key):
+        for retry in range(2):
+            with open(self.shard_path(key), 'rb') as f:
+                shard = pickle.load(f)
+            try:
+                return self._read_buffers(shard)
+            except FileNotFoundError:
+                # Replaced by a concurrent store, read the new shard
+                if retry > 0:
+                    raise
+
+    def _read_buffers(self, shard):
+        buffers = []
+        if any(size > 0 for _, size in shard['layout']):
+            mm = np.memmap(self.shard_dir/shard['buffer'],
+                           dtype=np.uint8, mode='c')
+            buffers = [mm[offset:offset + size]
+                       for offset, size in shard['layout']]
+        else:
+            buffers = [bytearray(0) for _ in shard['layout']]
+        return pickle.loads(shard['payload'], buffers=buffers)
+
+
+class CompressedPklCache(PklCache):
+    """Sharded pickle cache with compressed array leaves
+
+    Array buffers are pickled out-of-band (pickle protocol 5) and each one
+    is compressed in chunks of chunk_bytes with a codec from
+    compression.CODECS (zlib and lzma, plus zstd and blosc when installed).
+
+    codec: default codec for array buffers
+    dtype_codecs: numpy dtype kind -> codec, overriding codec for e.g.
+      boolean masks ('b') or floats ('f')
+    min_bytes: buffers smaller than this are stored uncompressed
+    """
+    def __init__(self,
+                 name: Optional[str] = None,
+                 cache_dir: Optional[Path] = None,
+                 codec: str = 'zlib',
+                 dtype_codecs: Optional[dict] = None,
+                 min_bytes: int = 2**12,
+                 chunk_bytes: int = 2**22,
+                 **kwargs,
+    ):
+        super().__init__(name, cache_dir, **kwargs)
+        self.codec = codec
+        self.dtype_codecs = dtype_codecs or {}
+        self.min_bytes = min_bytes
+        self.chunk_bytes = chunk_bytes
+        for codec in [self.codec, *self.dtype_codecs.values()]:
+            get_codec(codec)
+
+    def select_codec(self, view: memoryview) -> str:
+        if view.nbytes < self.min_bytes:
+            return 'none'
+        return self.dtype_codecs.get(buffer_kind(view), self.codec)
+
+    def _compress(self, buf: pickle.PickleBuffer) -> dict:
+        view = memoryview(buf)
+        codec = get_codec(self.select_codec(view))
+        raw = buf.raw()
+        chunks = [codec.compress(raw[start:start + self.chunk_bytes],
+                                 view.itemsize)
+                  for start in range(0, raw.nbytes, self.chunk_bytes)]
+        return {'codec': codec.name, 'nbytes': raw.nbytes, 'chunks': chunks}
+
+    @staticmethod
+    def _decompress(compressed: dict) -> bytearray:
+        codec = get_codec(compressed['codec'])
+        out = bytearray(compressed['nbytes'])
+        view = memoryview(out)
+        start = 0
+        for chunk in compressed['chunks']:
+            chunk = codec.decompress(chunk)
+            view[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        return out
+
+    def _write_shard(self, key, data):
+        buffers = []
+        payload = pickle.dumps(data, protocol=5,
+                               buffer_callback=buffers.append)
+        with atomic_open(self.shard_path(key)) as f:
+            pickle.dump({'buffers': [self._compress(buf) for buf in buffers],
+                         'payload': payload}, f,
+                        protocol=5)
+
+    def _read_shard(self, key):
+        with open(self.shard_path(key), 'rb') as f:
+            shard = pickle.load(f)
+        buffers = [self._decompress(buf) for buf in shard['buffers']]
+        return pickle.loads(shard['payload'], buffers=buffers)
+
+
+class ChunkedCache(PklCache):
+    """Sharded pickle cache that can also hold ChunkedArrays, for outputs
+    that don't fit in memory
+
+    Chunked outputs are stored as a directory of .npy chunks next to the
+    shard, written one chunk at a time by store_chunks or filled in place
+    through allocate. Loading them returns a lazily loaded ChunkedArray.
+    Other outputs are stored like in PklCache.
+    """
+    def chunk_dir(self, key) -> Path:
+        return self.shard_path(key).with_suffix('.chunks')
+
+    def _tmp_chunk_dir(self, key) -> Path:
+        return self.shard_dir/(
+            f'.{self.shard_path(key).stem}.'
+            f'{os.getpid()}-{threading.get_ident()}-{time.time_ns()}.chunks'
+        )
+
+    def _commit_chunks(self, key, path: Path):
+        replace_dir(path, self.chunk_dir(key))
+        self._write_shard(key, ChunksRef(self.chunk_dir(key).name))
+        self._commit_index(key)
+
+    def store_chunks(self, key, chunks):
+        """Stores an iterable of row blocks (e.g. a generator) without
+        holding more than one block in memory"""
+        self.migrate()
+        tmp = self._tmp_chunk_dir(key)
+        try:
+            write_chunks(tmp, chunks)
+            self._commit_chunks(key, tmp)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def allocate(self, key, shape, dtype, chunk_rows: int) -> ChunkedArray:
+        """Preallocates a writable ChunkedArray to be filled in and then
+        committed with store"""
+        self.migrate()
+        return ChunkedArray.create(self._tmp_chunk_dir(key), shape, dtype,
+                                   chunk_rows)
+
+    def commit_chunks(self, key, array: ChunkedArray):
+        """Stores a ChunkedArray, moving it into place if it was returned
+        by allocate"""
+        if not array.writable:
+            self.store_chunks(key, array.iter_chunks())
+            return
+        try:
+            self._commit_chunks(key, finalize(array).path)
+        finally:
+            shutil.rmtree(array.path, ignore_errors=True)
+
+    def store(self, key, data):
+        if isinstance(data, ChunkedArray):
+            self.commit_chunks(key, data)
+        elif inspect.isgenerator(data):
+            self.store_chunks(key, data)
+        else:
+            super().store(key, data)
+
+    def load(self, key, device_idx=None, lazy: Optional[bool] = None):
+        self.migrate()
+        try:
+            data = self._read_shard(key)
+        except FileNotFoundError:
             return None
-        with open(self.filepath, 'rb') as f:
-            cached = pickle.load(f)
-            if key in cached:
-                data = cached[key]
-                unpack = partial(DeviceArray.unpack,
-                                 device_idx=device_idx)
-                data = recursive_apply_inplace_with_stop(
-                    data, unpack, is_leaf_or_device_arr
-                )
-                data = self.load_callback(data)
+        self._touch(key)
+        if isinstance(data, ChunksRef):
+            try:
+                return ChunkedArray(self.shard_dir/data.name)
+            except FileNotFoundError:
+                return None
+        return self._unpack(data, device_idx, lazy)
+
+
+BLOB_DIRNAME = '_blobs'
+
+
+@dataclass
+class BlobRef:
+    """Stored in a DedupPklCache shard in place of an array"""
+    name: str
+
+
+def blob_path(cache_dir: Path, name: str) -> Path:
+    return Path(cache_dir)/BLOB_DIRNAME/name[:2]/f'{name}.npy'
+
+
+def referenced_blobs(cache_dir: Path) -> set:
+    """Names of the blobs referenced by the indexes of all caches in
+    cache_dir, including those of stores in progress"""
+    names = set()
+    for entry in open_index(cache_dir).entries().values():
+        names.update(entry.get('blobs', ()))
+        names.update(entry.get('pending_blobs', ()))
+    # Not yet migrated
+    for path in Path(cache_dir).glob(f'*/{PklCache.legacy_index_filename}'):
+        try:
+            with open(path, 'r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            continue
+        for entry in index.values():
+            if isinstance(entry, dict):
+                names.update(entry.get('blobs', ()))
+    return names
+
+
+def collect_garbage(cache_dir: Path, grace: float = 0.) -> int:
+    """Deletes the blobs in cache_dir that no cache entry references.
+    Stores register their blobs in the index before writing them (see
+    DedupPklCache), and this holds the index's write lock, so blobs of
+    stores in progress are kept. Blobs modified less than grace seconds ago
+    are also kept. Returns the number of bytes freed.
+    """
+    blob_dir = Path(cache_dir)/BLOB_DIRNAME
+    if not blob_dir.is_dir():
+        return 0
+    cutoff = time.time() - grace
+    freed = 0
+    with open_index(cache_dir).transaction():
+        referenced = referenced_blobs(cache_dir)
+        for path in blob_dir.glob('*/*.npy'):
+            if path.stem in referenced:
+                continue
+            try:
+                stat = path.stat()
+                if grace > 0 and stat.st_mtime > cutoff:
+                    continue
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            freed += stat.st_size
+    return freed
+
+
+class DedupPklCache(PklCache):
+    """Sharded pickle cache that stores array leaves once per content
+
+    Arrays of at least min_bytes are written to a content-addressed blob
+    store shared by all caches in cache_dir (cache_dir/_blobs), named by
+    the same digest hash_data uses, plus dtype and shape. Shards only hold
+    references, so identical arrays (e.g. an input passed through into an
+    output) are written once across nodes and runs.
+
+    Index entries list the blobs they reference with their sizes, which
+    count once towards the size of a cache or cache_dir no matter how many
+    entries share them (see select_evictions). Unreferenced blobs are
+    deleted by collect_garbage, which also runs after evicting or removing
+    entries.
+
+    hash_memo: optional HashMemo to reuse digests of arrays that were
+      already hashed, e.g. as node inputs
+    gc_grace: see collect_garbage
+    """
+    def __init__(self,
+                 name: Optional[str] = None,
+                 cache_dir: Optional[Path] = None,
+                 min_bytes: int = 2**12,
+                 hash_memo: Optional[HashMemo] = None,
+                 gc_grace: float = 0.,
+                 **kwargs,
+    ):
+        super().__init__(name, cache_dir, **kwargs)
+        self.min_bytes = min_bytes
+        self.hash_memo = hash_memo
+        self.gc_grace = gc_grace
+
+    def blob_name(self, arr: np.ndarray) -> str:
+        if self.hash_memo is not None:
+            digest = self.hash_memo.digest(arr)
+        else:
+            digest = array_digest(arr)
+        layout = metrohash.hash64_hex(f'{arr.dtype.str}{arr.shape}'.encode())
+        return f'{digest.hex()}{layout}'
+
+    def _write_shard(self, key, data):
+        blobs = {} # name -> array
+
+        def dedup(leaf):
+            if (isinstance(leaf, DeviceArray)
+                    and isinstance(leaf.arr, np.ndarray)
+                    and not leaf.arr.dtype.hasobject
+                    and leaf.arr.nbytes >= self.min_bytes):
+                name = self.blob_name(leaf.arr)
+                blobs[name] = leaf.arr
+                return DeviceArray(BlobRef(name), leaf.device, leaf.mode)
+            return leaf
+
+        data = map_leaves(data, dedup, is_leaf_or_device_arr)
+        with self.index.transaction():
+            # Registered as in flight before anything is written, so that
+            # collect_garbage keeps them until the entry is committed
+            entry = self.index.get(self.name, key) or {}
+            extra = {field: value for field, value in entry.items()
+                     if field not in CacheIndex.columns}
+            self.index.update(self.name, key, **extra,
+                              pending_blobs=sorted(blobs))
+            missing = [name for name in blobs
+                       if not blob_path(self.cache_dir, name).is_file()]
+        for name in missing:
+            path = blob_path(self.cache_dir, name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_open(path) as f:
+                np.save(f, blobs[name], allow_pickle=False)
+        super()._write_shard(key, data)
+
+    def _read_shard(self, key):
+        data = super()._read_shard(key)
+
+        def load_blob(leaf):
+            if isinstance(leaf, DeviceArray) and isinstance(leaf.arr, BlobRef):
+                leaf.arr = np.load(blob_path(self.cache_dir, leaf.arr.name))
+            return leaf
+
+        return recursive_apply_inplace_with_stop(data, load_blob,
+                                                 is_leaf_or_device_arr)
+
+    def blobs(self, key) -> list:
+        """Names of the blobs referenced by the shard for key"""
+        with open(self.shard_path(key), 'rb') as f:
+            data = pickle.load(f)
+        return sorted({leaf.arr.name
+                       for leaf in iter_leaves(data, is_leaf_or_device_arr)
+                       if isinstance(leaf, DeviceArray)
+                       and isinstance(leaf.arr, BlobRef)})
+
+    def _entry(self, key) -> dict:
+        entry = super()._entry(key)
+        entry['blobs'] = {name: blob_path(self.cache_dir, name).stat().st_size
+                          for name in self.blobs(key)}
+        return entry
+
+    def _nbytes(self) -> int:
+        return total_size(self.index.entries(self.name))
+
+    def collect_garbage(self) -> int:
+        return collect_garbage(self.cache_dir, self.gc_grace)
+
+    def remove(self, key):
+        super().remove(key)
+        self.collect_garbage()
+
+    def evict(self, max_bytes: Optional[int] = None,
+              policy: Optional[str] = None) -> list:
+        evicted = super().evict(max_bytes, policy)
+        if evicted:
+            self.collect_garbage()
+        return evicted
+
+    def _commit_index(self, key):
+        super()._commit_index(key)
+        if self.max_bytes is not None:
+            self.collect_garbage()
+
+
+class WriteBehindCache(Cache):
+    """Wraps another cache so that stores happen on a background thread
+
+    store returns immediately; the output is written by the wrapped cache in
+    the background. Outputs waiting to be written are served from memory by
+    load. At most max_pending_bytes of array data is held for writing;
+    beyond that, store blocks until the writer catches up.
+
+    Pending outputs are protected from in-place changes by their consumers
+    until they have been written: numpy arrays (and the arrays they are
+    views of) are made read-only, so writing to them raises, and torch
+    tensors are copied. Arrays are made writable again once written (see
+    flush). Pending stores are flushed at interpreter exit.
+
+    Pending outputs are loaded as the wrapped cache would load them once
+    written: its store_callback, device_idx and load_callback are applied.
+    """
+    def __init__(self,
+                 cache: Cache,
+                 max_pending_bytes: int = 2**30,
+    ):
+        self.cache = cache
+        self.max_pending_bytes = max_pending_bytes
+        self._pending = {} # key -> (data, nbytes, frozen), in order of store
+        self._pending_bytes = 0
+        self._frozen = {} # id -> [array made read-only, pending outputs]
+        self._frozen_lock = threading.Lock()
+        self._error = None
+        self._cond = threading.Condition()
+        self._writer = None
+        _write_behind_caches.add(self)
+
+    @property
+    def cache_dir(self) -> Path:
+        return self.cache.cache_dir
+
+    @cache_dir.setter
+    def cache_dir(self, cache_dir: Path):
+        self.cache.cache_dir = cache_dir
+
+    def __getattr__(self, name):
+        if name == 'cache':
+            raise AttributeError(name)
+        return getattr(self.cache, name)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                if len(self._pending) == 0:
+                    # Exit rather than wait, so the cache can be collected
+                    self._writer = None
+                    return
+                key = next(iter(self._pending))
+                entry = self._pending[key]
+            try:
+                # Copy so that the pending entry stays intact for load
+                self.cache.store(key, copy_structure(entry[0]))
+            except BaseException as e:
+                self._error = e
+            with self._cond:
+                if self._pending.get(key) is entry:
+                    del self._pending[key]
+                    self._pending_bytes -= entry[1]
+                    self._thaw(entry[2])
+                self._cond.notify_all()
+
+    def _protect(self, data):
+        """(data with copied tensors, the numpy arrays it holds that are
+        kept read-only until _thaw)"""
+        frozen = []
+        def protect(leaf):
+            if isinstance(leaf, torch.Tensor):
+                return leaf.detach().clone()
+            elif isinstance(leaf, np.ndarray):
+                base = leaf
+                while isinstance(base, np.ndarray):
+                    frozen.append(base)
+                    base = base.base
+            return leaf
+        data = map_leaves(data, protect)
+        with self._frozen_lock:
+            for arr in frozen:
+                if id(arr) in self._frozen:
+                    self._frozen[id(arr)][1] += 1
+                elif arr.flags.writeable:
+                    arr.flags.writeable = False
+                    self._frozen[id(arr)] = [arr, 1]
+        return data, [arr for arr in frozen if id(arr) in self._frozen]
+
+    def _thaw(self, frozen: list):
+        """Makes the arrays frozen by _protect writable again once no
+        pending output holds them"""
+        with self._frozen_lock:
+            for arr in frozen:
+                self._frozen[id(arr)][1] -= 1
+            # A view can only be made writable once its base is, which may
+            # still be held by another pending output
+            thawed = True
+            while thawed:
+                thawed = False
+                for arr_id, (arr, count) in list(self._frozen.items()):
+                    base = arr.base
+                    if count == 0 and (not isinstance(base, np.ndarray)
+                                       or base.flags.writeable):
+                        del self._frozen[arr_id]
+                        arr.flags.writeable = True
+                        thawed = True
+
+    def store(self, key, data):
+        data, frozen = self._protect(data)
+        entry = (data, nbytes(data), frozen)
+        with self._cond:
+            self._raise_error()
+            while (len(self._pending) > 0
+                   and self._pending_bytes + entry[1] > self.max_pending_bytes):
+                self._cond.wait()
+            if key in self._pending:
+                old = self._pending.pop(key)
+                self._pending_bytes -= old[1]
+                self._thaw(old[2])
+            self._pending[key] = entry
+            self._pending_bytes += entry[1]
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop,
+                                                daemon=True)
+                self._writer.start()
+            self._cond.notify_all()
+
+    def load(self, key, device_idx=None):
+        with self._cond:
+            entry = self._pending.get(key)
+        if entry is not None:
+            return self._as_loaded(entry[0], device_idx)
+        return self.cache.load(key, device_idx=device_idx)
+
+    def _as_loaded(self, data, device_idx=None):
+        """A pending output as the wrapped cache would load it"""
+        data = copy_structure(data)
+        store_callback = getattr(self.cache, 'store_callback', None)
+        if store_callback is not None:
+            data = store_callback(data)
+        data = infer_all(data)
+        if hasattr(self.cache, '_unpack'):
+            return self.cache._unpack(data, device_idx)
+        return unpack_all(data, device_idx)
+
+    def __contains__(self, key):
+        with self._cond:
+            if key in self._pending:
+                return True
+        return key in self.cache
+
+    def known_miss(self, key) -> bool:
+        with self._cond:
+            if key in self._pending:
+                return False
+        return self.cache.known_miss(key)
+
+    def lock(self, key):
+        # Note: released once the output is queued, before it is written
+        return self.cache.lock(key)
+
+    def record_runtime(self, key, runtime: float, node: Optional[str] = None):
+        self.cache.record_runtime(key, runtime, node)
+
+    def flush(self):
+        """Blocks until all pending stores have been written"""
+        with self._cond:
+            while len(self._pending) > 0:
+                self._cond.wait()
+            self._raise_error()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.cache})'
+
+
+_write_behind_caches = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_write_behind():
+    """Flushes the pending stores of all live WriteBehindCaches"""
+    for cache in list(_write_behind_caches):
+        cache.flush()
+
+
+def _host_copy(data):
+    """DeviceArray.infer, copying arrays that already are in host memory"""
+    arr = DeviceArray.infer(data)
+    if isinstance(arr, DeviceArray) and (
+        isinstance(data, np.ndarray)
+        or (arr.mode == 'torch' and arr.device.type == 'cpu')
+    ):
+        arr.arr = arr.arr.copy()
+    return arr
+
+
+class MemoryCache(Cache):
+    """In-process LRU cache holding at most max_bytes of array data
+
+    By default outputs are held on the host, and moved to device_idx by
+    DeviceArray.unpack on load, which skips unpickling and disk I/O.
+    With device_resident, outputs are held as they are (e.g. on the GPU) and
+    only returned if they are already on the requested device_idx, which
+    skips the device transfer too.
+
+    Host-held outputs are copied on store. Device-resident outputs, and
+    loaded outputs, share array data with the cached copy, so they must not
+    be modified in-place.
+    """
+    def __init__(self,
+                 max_bytes: int = 2**30,
+                 device_resident: bool = False,
+    ):
+        self.max_bytes = max_bytes
+        self.device_resident = device_resident
+        self._entries = OrderedDict() # key -> (data, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def store(self, key, data):
+        size = nbytes(data)
+        if size > self.max_bytes:
+            return
+        data = copy_structure(data)
+        if not self.device_resident:
+            # Host arrays are copied, so that later in-place changes to data
+            # don't reach the cached copy
+            data = recursive_apply_inplace_with_stop(
+                data, _host_copy, is_leaf
+            )
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (data, size)
+            self._nbytes += size
+            while self._nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._nbytes -= evicted_size
+
+    def load(self, key, device_idx=None):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            data = self._entries[key][0]
+        if self.device_resident:
+            if not on_device(data, device_idx):
+                return None
+            return copy_structure(data)
+        return unpack_all(data, device_idx)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def known_miss(self, key) -> bool:
+        return key not in self._entries
+
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(' \
+            + f'{len(self._entries)} entries, ' \
+            + f'{self._nbytes}/{self.max_bytes} bytes' \
+            + (', device_resident' if self.device_resident else '') \
+            + ')'
+
+
+class TieredCache(Cache):
+    """Checks a list of caches in order, fastest first, e.g.
+    TieredCache([MemoryCache(device_resident=True), MemoryCache(), PklCache()])
+
+    Hits are copied into the faster tiers, and stores go to every tier.
+    The last tier is the persistent one: attributes such as cache_dir and
+    locking are forwarded to it. Hits and misses are counted per tier in
+    stats.
+    """
+    def __init__(self, tiers: list):
+        self.tiers = tiers
+        self.stats = [{'hits': 0, 'misses': 0} for _ in tiers]
+
+    @property
+    def persistent(self) -> Cache:
+        return self.tiers[-1]
+
+    @property
+    def cache_dir(self) -> Path:
+        return self.persistent.cache_dir
+
+    @cache_dir.setter
+    def cache_dir(self, cache_dir: Path):
+        self.persistent.cache_dir = cache_dir
+
+    def __getattr__(self, name):
+        if name == 'tiers':
+            raise AttributeError(name)
+        return getattr(self.persistent, name)
+
+    def store(self, key, data):
+        for tier in reversed(self.tiers):
+            tier.store(key, data)
+
+    def load(self, key, device_idx=None):
+        for i, tier in enumerate(self.tiers):
+            data = tier.load(key, device_idx=device_idx)
+            if data is None:
+                self.stats[i]['misses'] += 1
+                continue
+            self.stats[i]['hits'] += 1
+            if is_lazy(data):
+                # Promoting would load every leaf
                 return data
+            for faster in self.tiers[:i]:
+                faster.store(key, data)
+            return data
         return None
 
+    def __contains__(self, key):
+        return any(key in tier for tier in self.tiers)
+
+    def known_miss(self, key) -> bool:
+        return all(tier.known_miss(key) for tier in self.tiers)
+
+    def lock(self, key):
+        return self.persistent.lock(key)
+
+    def record_runtime(self, key, runtime: float, node: Optional[str] = None):
+        self.persistent.record_runtime(key, runtime, node)
+
+    def report(self) -> str:
+        lines = []
+        for tier, stats in zip(self.tiers, self.stats):
+            lines.append(f'{tier}: {stats["hits"]} hits, {stats["misses"]} misses')
+        return '\n'.join(lines)
+
     def __repr__(self):
-        return f'{self.__class__.__name__}({self.filepath})'
+        return f'{self.__class__.__name__}({self.tiers})'
 
 
 class NpzCache(Cache):
-    """Deprecated in favor of PklCache"""
+    """Deprecated in favor of PklCache (or CompressedPklCache)"""
     def __init__(self,
                  name: Optional[str] = None,
                  cache_dir: Optional[Path] = None,
@@ -0,0 +1,225 @@
+"""Arrays stored as a directory of row chunks, for outputs larger than RAM"""
+from dataclasses import dataclass
+import json
+from pathlib import Path
+import shutil
+from typing import Iterable, Optional, Sequence
+
+import metrohash
+import numpy as np
+
+
+@dataclass
+class ChunksRef:
+    """Stored in a cache shard in place of an output held as chunks"""
+    name: str
+
+
+class ChunkedArray:
+    """Array split along its first axis into .npy chunk files in path
+
+    Chunks are memory-mapped when accessed, so indexing only reads the
+    chunks (and pages) that are needed. Slicing along the first axis
+    returns a numpy array holding just the selected rows.
+
+    A writable ChunkedArray (see create) is preallocated with fixed-size
+    chunks that can be filled in with __setitem__.
+    """
+    meta_filename = 'meta.json'
+
+    def __init__(self, path: Path, mode: str = 'r'):
+        self.path = Path(path)
+        self.mode = mode
+        with open(self.path/self.meta_filename, 'r') as f:
+            meta = json.load(f)
+        self.dtype = np.dtype(meta['dtype'])
+        self.row_shape = tuple(meta['row_shape'])
+        self.chunk_rows = list(meta['chunk_rows'])
+        self.chunk_digests = meta.get('chunk_digests')
+        self.offsets = np.concatenate([[0], np.cumsum(self.chunk_rows)]).astype(int)
+        self._chunks = {}
+
+    @classmethod
+    def create(cls, path: Path, shape: Sequence[int], dtype,
+               chunk_rows: int) -> 'ChunkedArray':
+        """Preallocates a writable chunked array of the given shape"""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        dtype = np.dtype(dtype)
+        rows = [min(chunk_rows, shape[0] - start)
+                for start in range(0, shape[0], chunk_rows)]
+        for i, n in enumerate(rows):
+            np.lib.format.open_memmap(
+                path/cls.chunk_filename(i), mode='w+', dtype=dtype,
+                shape=(n, *shape[1:])
+            )
+        write_meta(path, dtype, shape[1:], rows)
+        return cls(path, mode='r+')
+
+    @staticmethod
+    def chunk_filename(i: int) -> str:
+        return f'chunk_{i:06d}.npy'
+
+    @property
+    def shape(self):
+        return (int(self.offsets[-1]), *self.row_shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def writable(self) -> bool:
+        return self.mode != 'r'
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunk(self, i: int) -> np.ndarray:
+        if i not in self._chunks:
+            self._chunks[i] = np.load(self.path/self.chunk_filename(i),
+                                      mmap_mode=self.mode)
+        return self._chunks[i]
+
+    def iter_chunks(self):
+        for i in range(len(self.chunk_rows)):
+            yield self.chunk(i)
+
+    def _row_slices(self, rows: slice):
+        """Yields (chunk index, slice within chunk) covering rows"""
+        start, stop, step = rows.indices(len(self))
+        if step != 1:
+            raise IndexError('Only contiguous row slices are supported')
+        first = np.searchsorted(self.offsets, start, side='right') - 1
+        for i in range(max(first, 0), len(self.chunk_rows)):
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            if lo >= stop:
+                break
+            yield i, slice(max(start, lo) - lo, min(stop, hi) - lo)
+
+    def __getitem__(self, idx):
+        rest = ()
+        if isinstance(idx, tuple):
+            idx, rest = idx[0], idx[1:]
+        if isinstance(idx, (int, np.integer)):
+            idx = int(idx) + len(self) if idx < 0 else int(idx)
+            if not 0 <= idx < len(self):
+                raise IndexError(f'index {idx} out of range for {len(self)} rows')
+            i = np.searchsorted(self.offsets, idx, side='right') - 1
+            row = self.chunk(i)[idx - self.offsets[i]]
+            return row[rest] if rest else row
+        if isinstance(idx, slice) and idx.step in (None, 1):
+            parts = [self.chunk(i)[(s, *rest)]
+                     for i, s in self._row_slices(idx)]
+            if len(parts) == 1:
+                return parts[0]
+            if len(parts) == 0:
+                return np.empty((0, *self.row_shape), self.dtype)[(slice(None), *rest)]
+            return np.concatenate(parts)
+        return np.asarray(self)[(idx, *rest)]
+
+    def __setitem__(self, idx, value):
+        if not self.writable:
+            raise ValueError('ChunkedArray is read-only')
+        if isinstance(idx, (int, np.integer)):
+            idx = slice(int(idx), int(idx) + 1)
+            value = np.asarray(value)[None]
+        if not isinstance(idx, slice):
+            raise IndexError('Only row slices can be assigned')
+        value = np.broadcast_to(value, (len(range(*idx.indices(len(self)))),
+                                        *self.row_shape))
+        start = 0
+        for i, s in self._row_slices(idx):
+            n = s.stop - s.start
+            self.chunk(i)[s] = value[start:start + n]
+            start += n
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.concatenate(list(self.iter_chunks())) if self.chunk_rows \
+            else np.empty(self.shape, self.dtype)
+        return out if dtype is None else out.astype(dtype)
+
+    def flush(self):
+        for chunk in self._chunks.values():
+            if isinstance(chunk, np.memmap):
+                chunk.flush()
+
+    @property
+    def to_nested_mapping(self):
+        """Used for hashing, see hashing.hash_data. Hashes the per-chunk
+        digests recorded when the chunks were written instead of reading
+        the data."""
+        digests = self.chunk_digests
+        if digests is None or self.writable:
+            digests = [chunk_digest(chunk) for chunk in self.iter_chunks()]
+        return {'shape': list(self.shape), 'dtype': self.dtype.str,
+                'chunk_digests': digests}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path}, shape={self.shape}, ' \
+            + f'dtype={self.dtype}, chunks={len(self.chunk_rows)})'
+
+
+def chunk_digest(chunk: np.ndarray) -> str:
+    return metrohash.hash64_hex(np.ascontiguousarray(chunk))
+
+
+def write_meta(path: Path, dtype, row_shape, chunk_rows,
+               chunk_digests: Optional[list] = None):
+    meta = {'dtype': np.dtype(dtype).str,
+            'row_shape': list(row_shape),
+            'chunk_rows': list(chunk_rows)}
+    if chunk_digests is not None:
+        meta['chunk_digests'] = chunk_digests
+    with open(Path(path)/ChunkedArray.meta_filename, 'w') as f:
+        json.dump(meta, f)
+
+
+def write_chunks(path: Path, chunks: Iterable[np.ndarray]) -> ChunkedArray:
+    """Writes an iterable of row blocks to path one at a time.
+    All blocks must have the same dtype and shape after the first axis.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    dtype = row_shape = None
+    rows, digests = [], []
+    for i, chunk in enumerate(chunks):
+        chunk = np.asarray(chunk)
+        if dtype is None:
+            dtype, row_shape = chunk.dtype, chunk.shape[1:]
+        elif chunk.dtype != dtype or chunk.shape[1:] != row_shape:
+            raise ValueError(
+                f'Chunk {i} has dtype {chunk.dtype} and rows of shape '
+                f'{chunk.shape[1:]}, expected {dtype} and {row_shape}'
+            )
+        np.save(path/ChunkedArray.chunk_filename(i), chunk)
+        rows.append(chunk.shape[0])
+        digests.append(chunk_digest(chunk))
+    if dtype is None:
+        raise ValueError('Cannot store an empty sequence of chunks')
+    write_meta(path, dtype, row_shape, rows, digests)
+    return ChunkedArray(path)
+
+
+def finalize(array: ChunkedArray) -> ChunkedArray:
+    """Flushes a writable chunked array and records its chunk digests"""
+    array.flush()
+    digests = [chunk_digest(chunk) for chunk in array.iter_chunks()]
+    write_meta(array.path, array.dtype, array.row_shape, array.chunk_rows,
+               digests)
+    return ChunkedArray(array.path)
+
+
+def replace_dir(src: Path, dst: Path):
+    """Moves directory src to dst, replacing dst if it exists"""
+    if dst.exists():
+        trash = dst.with_name(f'.{dst.name}.old-{src.name}')
+        dst.rename(trash)
+        src.rename(dst)
+        shutil.rmtree(trash, ignore_errors=True)
+    else:
+        src.rename(dst)
@@ -0,0 +1,70 @@
+"""Codecs for compressing array buffers in CompressedPklCache"""
+from dataclasses import dataclass
+import lzma
+from typing import Callable, Dict
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+
+@dataclass
+class Codec:
+    """compress(data, itemsize) -> bytes and decompress(data) -> bytes"""
+    name: str
+    compress: Callable
+    decompress: Callable
+
+
+CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(name: str, compress: Callable, decompress: Callable):
+    CODECS[name] = Codec(name, compress, decompress)
+
+
+def get_codec(name: str) -> Codec:
+    if name not in CODECS:
+        raise ValueError(
+            f'Unknown or unavailable codec: {name}, must be one of {list(CODECS)}'
+        )
+    return CODECS[name]
+
+
+register_codec('none', lambda data, itemsize: bytes(data), bytes)
+register_codec('zlib', lambda data, itemsize: zlib.compress(data, 1),
+               zlib.decompress)
+register_codec('lzma', lambda data, itemsize: lzma.compress(data),
+               lzma.decompress)
+if zstd is not None:
+    register_codec(
+        'zstd',
+        lambda data, itemsize: zstd.ZstdCompressor().compress(data),
+        lambda data: zstd.ZstdDecompressor().decompress(data),
+    )
+if blosc is not None:
+    register_codec(
+        'blosc',
+        lambda data, itemsize: blosc.compress(data, typesize=itemsize),
+        blosc.decompress,
+    )
+
+
+def buffer_kind(view: memoryview) -> str:
+    """numpy dtype kind ('b', 'i', 'u', 'f', 'c', ...) of a buffer"""
+    fmt = view.format.lstrip('<>=!@')
+    if fmt.startswith('Z'): # Complex
+        return 'c'
+    try:
+        return np.dtype(fmt).kind
+    except TypeError:
+        return 'V'
@@ -1,7 +1,11 @@
+import copy
+from contextlib import contextmanager
 from dataclasses import dataclass, is_dataclass, fields
-from collections.abc import Mapping, Set
+from collections import defaultdict
+from collections.abc import Mapping, MutableSequence, Set
 from functools import partial
-from typing import Union, List, Tuple, Any, Optional
+import threading
+from typing import Union, List, Tuple, Any, NamedTuple, Optional
 
 import numpy as np
 import torch
@@ -12,7 +16,7 @@ except ImportError:
     cp = np
 
 is_array = lambda x: isinstance(x, np.ndarray) or isinstance(x, cp.ndarray) or isinstance(x, torch.Tensor)
-is_numeric = lambda x: isinstance(x, int) or isinstance(x, float) or isinstance(x, complex)
+is_numeric = lambda x: isinstance(x, (int, float, complex, np.number, np.bool_))
 
 def recursive_map(data, func):
     """Recursively performs func on the items of data
@@ -57,7 +61,7 @@ def to_nested_mapping(data):
         return data
     elif isinstance(data, Mapping):
         return type(data)({k: apply(v) for k, v in data.items()})
-    elif isinstance(data, list) or isinstance(data, tuple):
+    elif isinstance(data, (MutableSequence, tuple)):
         return type(data)(apply(v) for v in data)
     elif hasattr(data, 'to_nested_mapping'):
         return apply(data.to_nested_mapping)
@@ -93,7 +97,7 @@ def recursive_apply_inplace_with_stop(data, func, stop_cond):
         for k, v in data.items():
             data[k] = apply(v)
         return data
-    elif isinstance(data, list):
+    elif isinstance(data, MutableSequence):
         for i, v in enumerate(data):
             data[i] = apply(v)
         return data
@@ -118,6 +122,175 @@ def is_leaf_or_device_arr(data):
     return is_leaf(data) or isinstance(data, DeviceArray)
 
 
+def copy_structure(data, stop_cond=is_leaf):
+    """Copies the containers of data (mappings, lists, tuples and general
+    objects) without copying the leaves.
+    The copy can then be modified with recursive_apply_inplace_with_stop
+    without affecting data.
+    """
+    apply = partial(copy_structure, stop_cond=stop_cond)
+    if stop_cond(data):
+        return data
+    elif isinstance(data, tuple):
+        if hasattr(data, '_fields'): # namedtuple
+            return type(data)(*(apply(v) for v in data))
+        return type(data)(apply(v) for v in data)
+    out = copy.copy(data)
+    if isinstance(data, Mapping):
+        for k, v in data.items():
+            out[k] = apply(v)
+    elif isinstance(data, MutableSequence):
+        for i, v in enumerate(data):
+            out[i] = apply(v)
+    else:
+        for k, v in data.__dict__.items():
+            setattr(out, k, apply(v))
+    return out
+
+
+def iter_leaves(data, stop_cond=is_leaf):
+    """Yields the leaves of data, in the same order as
+    recursive_apply_inplace_with_stop visits them"""
+    yield from flatten(data, stop_cond)[0]
+
+
+def nbytes(data):
+    """Total size of the array leaves of data"""
+    return sum(leaf.nbytes for leaf in flatten(data)[0] if is_array(leaf))
+
+
+##############
+# Tree specs #
+##############
+
+# Kinds of nodes in nested data
+LEAF, MAPPING, SEQUENCE, TUPLE, NAMEDTUPLE, OBJECT = range(6)
+
+LEAF_TYPES = (int, float, complex, np.number, np.bool_, str, np.ndarray,
+              torch.Tensor, type(None)) \
+    + ((cp.ndarray,) if cp is not np else ())
+
+_kinds = {} # (type, stop_cond) -> kind
+
+
+def node_kind(cls: type, stop_cond=is_leaf) -> int:
+    """Kind of node that instances of cls are in nested data, cached per
+    type. is_leaf and is_leaf_or_device_arr only depend on the type, so
+    they are decided here too; for other stop_cond (or None) cls is
+    classified as a container and stop_cond is left to the caller."""
+    kind = _kinds.get((cls, stop_cond))
+    if kind is not None:
+        return kind
+    if stop_cond is is_leaf:
+        leaf_types = LEAF_TYPES
+    elif stop_cond is is_leaf_or_device_arr:
+        leaf_types = LEAF_TYPES + (DeviceArray,)
+    else:
+        leaf_types = ()
+    if issubclass(cls, leaf_types):
+        kind = LEAF
+    elif issubclass(cls, Mapping):
+        kind = MAPPING
+    elif issubclass(cls, MutableSequence):
+        kind = SEQUENCE
+    elif issubclass(cls, tuple):
+        kind = NAMEDTUPLE if hasattr(cls, '_fields') else TUPLE
+    else:
+        kind = OBJECT # General object/dataclass, through its __dict__
+    _kinds[(cls, stop_cond)] = kind
+    return kind
+
+
+class TreeSpec(NamedTuple):
+    """Structure of nested data without its leaves, see flatten.
+    keys: the keys of a mapping or attribute names of an object
+    aux: the default_factory of a defaultdict
+    """
+    kind: int
+    type: Optional[type] = None
+    keys: tuple = ()
+    children: tuple = ()
+    aux: Any = None
+
+    @property
+    def num_leaves(self) -> int:
+        if self.kind == LEAF:
+            return 1
+        return sum(child.num_leaves for child in self.children)
+
+
+_LEAF_SPEC = TreeSpec(LEAF)
+
+
+def flatten(data, stop_cond=is_leaf) -> Tuple[list, TreeSpec]:
+    """The leaves of data, in the same order as
+    recursive_apply_inplace_with_stop visits them, and the TreeSpec to
+    rebuild data from them with unflatten. Recurses through mappings,
+    lists, tuples and general objects like recursive_apply_inplace_with_stop,
+    but in a single pass without modifying data."""
+    leaves = []
+    if stop_cond is is_leaf or stop_cond is is_leaf_or_device_arr:
+        kind_of = lambda x: node_kind(type(x), stop_cond)
+    else:
+        kind_of = lambda x: LEAF if stop_cond(x) else node_kind(type(x), None)
+    spec = _flatten(data, leaves, kind_of)
+    return leaves, spec
+
+
+def _flatten(data, leaves, kind_of) -> TreeSpec:
+    kind = kind_of(data)
+    if kind == LEAF:
+        leaves.append(data)
+        return _LEAF_SPEC
+    keys, aux = (), None
+    if kind == MAPPING:
+        keys, values = tuple(data.keys()), data.values()
+        if isinstance(data, defaultdict):
+            aux = data.default_factory
+    elif kind == OBJECT:
+        keys, values = tuple(data.__dict__), data.__dict__.values()
+    else:
+        values = data
+    children = tuple([_flatten(v, leaves, kind_of) for v in values])
+    return TreeSpec(kind, type(data), keys, children, aux)
+
+
+def unflatten(spec: TreeSpec, leaves):
+    """Rebuilds the data flattened into spec with new leaves. Containers
+    are new, objects are created without calling their __init__."""
+    return _unflatten(spec, iter(leaves))
+
+
+def _unflatten(spec: TreeSpec, leaves):
+    if spec.kind == LEAF:
+        return next(leaves)
+    children = [_unflatten(child, leaves) for child in spec.children]
+    cls = spec.type
+    if spec.kind == MAPPING:
+        items = dict(zip(spec.keys, children))
+        if cls is dict:
+            return items
+        elif issubclass(cls, defaultdict):
+            return cls(spec.aux, items)
+        return cls(items)
+    elif spec.kind == SEQUENCE:
+        return children if cls is list else cls(children)
+    elif spec.kind == TUPLE:
+        return tuple(children) if cls is tuple else cls(children)
+    elif spec.kind == NAMEDTUPLE:
+        return cls(*children)
+    out = cls.__new__(cls)
+    out.__dict__.update(zip(spec.keys, children))
+    return out
+
+
+def map_leaves(data, func, stop_cond=is_leaf):
+    """Like recursive_apply_inplace_with_stop, but returns new containers
+    and leaves data untouched (tuples also stay tuples)"""
+    leaves, spec = flatten(data, stop_cond)
+    return unflatten(spec, [func(leaf) for leaf in leaves])
+
+
 ######################
 # [Cuda] <-> [Numpy] #
 ######################
@@ -145,15 +318,7 @@ class DeviceArray:
             if data.mode == 'numpy':
                 return data.arr
             elif data.mode == 'torch':
-                if device_idx is None:
-                    device = data.device
-                else:
-                    device = torch.device(
-                        f'cuda:{device_idx}'
-                        if (torch.cuda.is_available()
-                            and device_idx >= 0)
-                        else 'cpu'
-                    )
+                device = data.torch_device(device_idx)
                 return torch.from_numpy(data.arr).to(device)
             elif data.mode == 'cupy':
                 if device_idx is None:
@@ -168,6 +333,296 @@ class DeviceArray:
                 raise ValueError(f'Unknown DeviceArray mode: {data.mode}')
         return data
 
+    def torch_device(self, device_idx=None) -> torch.device:
+        """Device that unpack puts a torch array on"""
+        if device_idx is None:
+            return torch.device(self.device)
+        return torch.device(
+            f'cuda:{device_idx}'
+            if (torch.cuda.is_available()
+                and device_idx >= 0)
+            else 'cpu'
+        )
+
+
+class PinnedPool:
+    """Reusable host buffers for staging device transfers, pinned (page
+    locked) so that copies can be asynchronous.
+
+    Buffers are rounded up to powers of two and kept for reuse once
+    released, up to max_bytes in total. Transfers are staged in at most
+    max_bytes of buffers at a time: larger ones are streamed through
+    buffers of chunk_bytes (see to_host and to_device).
+    pin: whether to pin the buffers (default: if CUDA is available)
+    """
+    chunk_bytes = 2**24
+
+    def __init__(self, pin: Optional[bool] = None, max_bytes: int = 2**28):
+        self.pin = torch.cuda.is_available() if pin is None else pin
+        self.max_bytes = max_bytes
+        self._free = defaultdict(list) # size -> buffers
+        self._free_bytes = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes: int) -> torch.Tensor:
+        """A uint8 buffer of at least nbytes. Above max_bytes, a buffer of
+        exactly nbytes that isn't pinned or kept for reuse."""
+        if nbytes > self.max_bytes:
+            return torch.empty(nbytes, dtype=torch.uint8)
+        size = 1 << max(nbytes - 1, 0).bit_length()
+        with self._lock:
+            if len(self._free[size]) > 0:
+                self._free_bytes -= size
+                return self._free[size].pop()
+        return torch.empty(size, dtype=torch.uint8, pin_memory=self.pin)
+
+    def release(self, buf: torch.Tensor):
+        with self._lock:
+            if self._free_bytes + buf.numel() <= self.max_bytes:
+                self._free[buf.numel()].append(buf)
+                self._free_bytes += buf.numel()
+
+    def nbytes(self) -> int:
+        """Size of the buffers held for reuse"""
+        return self._free_bytes
+
+
+_pinned_pool = None
+_pinned_pool_lock = threading.Lock()
+
+
+def pinned_pool() -> PinnedPool:
+    """PinnedPool shared by the batched transfers of the process"""
+    global _pinned_pool
+    with _pinned_pool_lock:
+        if _pinned_pool is None:
+            _pinned_pool = PinnedPool()
+        return _pinned_pool
+
+
+def _staging(buf: torch.Tensor, dtype: torch.dtype, shape) -> torch.Tensor:
+    """View of the start of buf as a tensor of dtype and shape"""
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    return buf[:nbytes].view(dtype).view(shape)
+
+
+def _synchronize(devices):
+    for device in devices:
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+
+def _chunk_ranges(nbytes: int, pool: PinnedPool):
+    step = min(pool.chunk_bytes, pool.max_bytes)
+    return [(start, min(start + step, nbytes))
+            for start in range(0, nbytes, step)]
+
+
+def _stream_to_host(tensor: torch.Tensor, pool: PinnedPool) -> np.ndarray:
+    """Copy of tensor in a new array, streamed through one buffer from pool
+    a chunk at a time"""
+    src = tensor.detach().reshape(-1).view(torch.uint8)
+    out = torch.empty(src.numel(), dtype=torch.uint8)
+    ranges = _chunk_ranges(src.numel(), pool)
+    buf = pool.acquire(ranges[0][1])
+    try:
+        for start, stop in ranges:
+            chunk = buf[:stop - start]
+            chunk.copy_(src[start:stop], non_blocking=True)
+            _synchronize({tensor.device})
+            out[start:stop].copy_(chunk)
+    finally:
+        pool.release(buf)
+    return out.view(tensor.dtype).view(tensor.shape).numpy()
+
+
+def _stream_to_device(arr: np.ndarray, device: torch.device,
+                      pool: PinnedPool) -> torch.Tensor:
+    """Copy of arr in a new tensor on device, streamed through one buffer
+    from pool a chunk at a time"""
+    src = np.ascontiguousarray(arr).reshape(-1).view(np.uint8)
+    dtype = torch.from_numpy(np.empty(0, dtype=arr.dtype)).dtype
+    out = torch.empty(src.size, dtype=torch.uint8, device=device)
+    ranges = _chunk_ranges(src.size, pool)
+    buf = pool.acquire(ranges[0][1])
+    try:
+        for start, stop in ranges:
+            chunk = buf[:stop - start]
+            np.copyto(chunk.numpy(), src[start:stop])
+            out[start:stop].copy_(chunk, non_blocking=True)
+            # Before the buffer is refilled
+            _synchronize({device})
+    finally:
+        pool.release(buf)
+    return out.view(dtype).view(arr.shape)
+
+
+def _stage_to_host(tensors: List[torch.Tensor], pool: PinnedPool):
+    """[(buffer from pool, numpy view of it holding tensor)], copied with
+    non-blocking copies and synchronized once at the end. Once max_bytes of
+    buffers are staged, the other tensors are streamed into new arrays
+    instead, with None as buffer."""
+    staged = []
+    staged_bytes = 0
+    for tensor in tensors:
+        tensor = tensor.detach()
+        nbytes = tensor.numel() * tensor.element_size()
+        if nbytes > 0 and staged_bytes + nbytes > pool.max_bytes:
+            staged.append((None, tensor))
+            continue
+        buf = pool.acquire(nbytes)
+        host = _staging(buf, tensor.dtype, tensor.shape)
+        host.copy_(tensor, non_blocking=True)
+        staged.append((buf, host))
+        staged_bytes += buf.numel()
+    staged = [(None, _stream_to_host(host, pool)) if buf is None
+              else (buf, host) for buf, host in staged]
+    _synchronize({tensor.device for tensor in tensors})
+    return [(buf, host if buf is None else host.numpy())
+            for buf, host in staged]
+
+
+def to_host(tensors: List[torch.Tensor],
+            pool: Optional[PinnedPool] = None) -> List[np.ndarray]:
+    """Copies tensors to numpy arrays, staging them in buffers from pool
+    with non-blocking copies and synchronizing once at the end. Past
+    pool.max_bytes, tensors are streamed through chunks of a buffer."""
+    pool = pool or pinned_pool()
+    staged = _stage_to_host(tensors, pool)
+    # Copied out, since the buffers are reused
+    arrays = [view if buf is None else view.copy() for buf, view in staged]
+    for buf, _ in staged:
+        if buf is not None:
+            pool.release(buf)
+    return arrays
+
+
+def to_device(arrays: List[np.ndarray], devices: List[torch.device],
+              pool: Optional[PinnedPool] = None) -> List[torch.Tensor]:
+    """Copies numpy arrays to tensors on devices, staging them in buffers
+    from pool with non-blocking copies and synchronizing once at the end.
+    Past pool.max_bytes, arrays are streamed through chunks of a buffer."""
+    pool = pool or pinned_pool()
+    tensors = []
+    bufs = []
+    staged_bytes = 0
+    for arr, device in zip(arrays, devices):
+        if arr.nbytes > 0 and staged_bytes + arr.nbytes > pool.max_bytes:
+            tensors.append(_stream_to_device(arr, device, pool))
+            continue
+        dtype = torch.from_numpy(np.empty(0, dtype=arr.dtype)).dtype
+        buf = pool.acquire(arr.nbytes)
+        staged_bytes += buf.numel()
+        host = _staging(buf, dtype, arr.shape)
+        np.copyto(host.numpy(), arr)
+        tensor = host.to(device, non_blocking=True)
+        if tensor.data_ptr() == host.data_ptr() and host.numel() > 0:
+            # Not copied (e.g. to cpu), so the buffer can't be reused
+            tensor = tensor.clone()
+        tensors.append(tensor)
+        bufs.append(buf)
+    _synchronize(set(devices))
+    for buf in bufs:
+        pool.release(buf)
+    return tensors
+
+
+def _gpu_tensors(leaves) -> dict:
+    return {id(leaf): leaf for leaf in leaves
+            if isinstance(leaf, torch.Tensor) and leaf.device.type == 'cuda'}
+
+
+def _infer_leaves(leaves, hosts: dict) -> list:
+    """DeviceArray.infer of leaves, with the host copies of GPU tensors
+    in hosts (by id)"""
+    out = []
+    for leaf in leaves:
+        if id(leaf) in hosts:
+            out.append(DeviceArray(hosts[id(leaf)], leaf.device, 'torch'))
+        else:
+            out.append(DeviceArray.infer(leaf))
+    return out
+
+
+def infer_all(data, pool: Optional[PinnedPool] = None):
+    """Applies DeviceArray.infer to every leaf of data, returning new
+    containers and leaving data untouched (see map_leaves). Tensors on GPUs
+    are copied to the host together (see to_host) rather than one
+    synchronous copy at a time.
+    """
+    leaves, spec = flatten(data)
+    gpu = _gpu_tensors(leaves)
+    hosts = dict(zip(gpu, to_host(list(gpu.values()), pool))) if gpu else {}
+    return unflatten(spec, _infer_leaves(leaves, hosts))
+
+
+@contextmanager
+def host_view(data, pool: Optional[PinnedPool] = None):
+    """Context with infer_all(data), except that GPU tensors are only copied
+    into buffers from pool and their arrays are views of those, valid until
+    the context exits. For serializing data without touching it and with a
+    single device to host copy (see PklCache.store)."""
+    pool = pool or pinned_pool()
+    leaves, spec = flatten(data)
+    gpu = _gpu_tensors(leaves)
+    staged = _stage_to_host(list(gpu.values()), pool) if gpu else []
+    try:
+        yield unflatten(spec, _infer_leaves(
+            leaves, {i: view for i, (_, view) in zip(gpu, staged)}))
+    finally:
+        for buf, _ in staged:
+            if buf is not None:
+                pool.release(buf)
+
+
+def unpack_all(data, device_idx=None, pool: Optional[PinnedPool] = None):
+    """Applies DeviceArray.unpack to every leaf of data, returning new
+    containers and leaving data untouched (see map_leaves). Torch arrays
+    bound for GPUs are copied together (see to_device) rather than one
+    synchronous copy at a time.
+    """
+    leaves, spec = flatten(data, is_leaf_or_device_arr)
+    gpu = {id(leaf): leaf for leaf in leaves
+           if isinstance(leaf, DeviceArray) and leaf.mode == 'torch'
+           and leaf.torch_device(device_idx).type == 'cuda'}
+    devices = {}
+    if gpu:
+        tensors = to_device(
+            [leaf.arr for leaf in gpu.values()],
+            [leaf.torch_device(device_idx) for leaf in gpu.values()],
+            pool
+        )
+        devices = dict(zip(gpu, tensors))
+    out = []
+    for leaf in leaves:
+        if id(leaf) in devices:
+            out.append(devices[id(leaf)])
+        else:
+            out.append(DeviceArray.unpack(leaf, device_idx))
+    return unflatten(spec, out)
+
+
+def on_device(data, device_idx=None):
+    """Whether every torch/cupy leaf of data is already where
+    DeviceArray.unpack would put it for device_idx"""
+    if device_idx is None:
+        return True
+    for leaf in iter_leaves(data):
+        if isinstance(leaf, torch.Tensor):
+            device = torch.device(
+                f'cuda:{device_idx}'
+                if (torch.cuda.is_available()
+                    and device_idx >= 0)
+                else 'cpu'
+            )
+            if leaf.device != device:
+                return False
+        elif (cp != np) and isinstance(leaf, cp.ndarray):
+            if device_idx < 0 or leaf.device.id != device_idx:
+                return False
+    return True
+
+
 def to_np(data):
     """Converts an input array to a cpu np array if it is
     either a torch tensor or a cupy array"""
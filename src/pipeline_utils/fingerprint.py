@@ -0,0 +1,224 @@
+"""Fingerprints of node source code and the project code it depends on"""
+import ast
+import functools
+import inspect
+from pathlib import Path
+import site
+import sysconfig
+import textwrap
+import types
+from typing import Callable, Dict, Optional, Tuple
+
+import metrohash
+import numpy as np
+import torch
+
+from .hashing import hash_data, is_frozen
+
+CONSTANT_TYPES = (int, float, complex, str, bytes, bool, type(None))
+
+
+def normalize_source(src: str) -> str:
+    """Canonical form of python source code, unaffected by whitespace,
+    comments and formatting"""
+    return ast.dump(ast.parse(textwrap.dedent(src)))
+
+
+def source_fingerprint(func: Callable) -> str:
+    """Hash of the normalized source of func"""
+    return metrohash.hash64_hex(normalize_source(inspect.getsource(func)))
+
+
+@functools.lru_cache(maxsize=None)
+def library_paths() -> Tuple[Path, ...]:
+    paths = set()
+    for k in ['stdlib', 'platstdlib', 'purelib', 'platlib']:
+        if k in sysconfig.get_paths():
+            paths.add(sysconfig.get_paths()[k])
+    paths.update(site.getsitepackages())
+    paths.add(site.getusersitepackages())
+    return tuple(Path(p).resolve() for p in paths)
+
+
+@functools.lru_cache(maxsize=None)
+def is_project_file(path: str) -> bool:
+    """Files that are not part of the standard library or installed
+    packages are considered part of the project"""
+    path = Path(path).resolve()
+    return not any(path.is_relative_to(p) for p in library_paths())
+
+
+def source_file(obj) -> Optional[str]:
+    try:
+        return inspect.getsourcefile(obj)
+    except TypeError:
+        return None
+
+
+def is_constant(value) -> bool:
+    if isinstance(value, tuple):
+        return all(is_constant(v) for v in value)
+    return isinstance(value, CONSTANT_TYPES)
+
+
+def is_data(value) -> bool:
+    """Module-level containers and arrays, e.g. `PARAMS = {...}`"""
+    return isinstance(value, (dict, list, tuple, set, frozenset, np.ndarray,
+                              torch.Tensor))
+
+
+def is_immutable_data(value) -> bool:
+    """Data whose value can't change at runtime: tuples and frozensets of
+    constants (or of immutable data) and frozen numpy arrays"""
+    if isinstance(value, (tuple, frozenset)):
+        return all(is_constant(v) or is_immutable_data(v) for v in value)
+    return isinstance(value, np.ndarray) and is_frozen(value)
+
+
+@functools.lru_cache(maxsize=None)
+def _module_assignments(path: str, mtime: int) -> Dict[str, str]:
+    """name -> normalized source of the top-level statements of the module
+    at path assigning to name"""
+    try:
+        with open(path, 'r') as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError, ValueError):
+        return {}
+    assignments = {}
+    for stmt in tree.body:
+        if isinstance(stmt, ast.Assign):
+            targets = stmt.targets
+        elif isinstance(stmt, (ast.AnnAssign, ast.AugAssign)):
+            targets = [stmt.target]
+        else:
+            continue
+        for target in targets:
+            for node in ast.walk(target):
+                if isinstance(node, ast.Name):
+                    assignments[node.id] = assignments.get(node.id, '') \
+                        + ast.dump(stmt)
+    return assignments
+
+
+def module_assignment(path: Optional[str], name: str) -> Optional[str]:
+    """Normalized source of the top-level assignments to name in the module
+    at path, if any"""
+    if path is None or file_mtime(path) is None:
+        return None
+    return _module_assignments(path, file_mtime(path)).get(name)
+
+
+def file_mtime(path: str) -> Optional[int]:
+    try:
+        return Path(path).stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def code_names(code: types.CodeType):
+    """Global and attribute names referenced by code, including nested
+    functions, lambdas and comprehensions"""
+    yield from code.co_names
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from code_names(const)
+
+
+def functions_of(obj):
+    if inspect.isfunction(obj):
+        yield obj
+    elif inspect.isclass(obj):
+        for v in vars(obj).values():
+            if isinstance(v, (staticmethod, classmethod)):
+                v = v.__func__
+            elif isinstance(v, property):
+                yield from (f for f in (v.fget, v.fset, v.fdel)
+                            if inspect.isfunction(f))
+                continue
+            if inspect.isfunction(v):
+                yield v
+
+
+def dependency_fingerprint(func: Callable) -> Tuple[str, Dict[str, int]]:
+    """Hash of the normalized source of func and, transitively, of every
+    project function or class it references, plus the values of referenced
+    module-level constants and immutable data (tuples and frozensets of
+    constants and frozen numpy arrays, hashed with hash_data).
+
+    Mutable data (dicts, lists, sets, writable arrays and tensors) could be
+    changed at runtime, so their values are never read: module globals are
+    hashed by the source of their top-level assignments (so editing
+    `PARAMS = {...}` changes the fingerprint, but `PARAMS['a'] = 1` at
+    runtime doesn't), and closure cells by name only. Fingerprints thus
+    don't depend on when they are computed.
+
+    Returns the fingerprint and the mtimes of all source files involved, so
+    callers can tell when it needs to be recomputed.
+    """
+    hash_obj = metrohash.MetroHash64()
+    mtimes = {}
+    seen = set()
+
+    def visit(obj, strict=False):
+        obj = inspect.unwrap(obj)
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        try:
+            src = inspect.getsource(obj)
+        except (OSError, TypeError):
+            if strict:
+                raise
+            # Source unavailable, e.g. defined interactively
+            hash_obj.update(f'{obj.__module__}.{obj.__qualname__}')
+            return
+        path = source_file(obj)
+        if path is not None and file_mtime(path) is not None:
+            mtimes[path] = file_mtime(path)
+        hash_obj.update(obj.__qualname__)
+        hash_obj.update(normalize_source(src))
+        for f in functions_of(obj):
+            names = sorted(set(code_names(f.__code__)))
+            module_path = f.__globals__.get('__file__')
+            for name in names:
+                if name in f.__globals__:
+                    visit_value(name, f.__globals__[name], names, module_path)
+            for name, cell in zip(f.__code__.co_freevars, f.__closure__ or ()):
+                try:
+                    visit_value(name, cell.cell_contents, names)
+                except ValueError: # Empty cell
+                    pass
+
+    def visit_value(name, value, names, module_path=None):
+        value = inspect.unwrap(value) if callable(value) else value
+        if inspect.isfunction(value) or inspect.isclass(value):
+            path = source_file(value)
+            if path is not None and is_project_file(path):
+                visit(value)
+        elif inspect.ismodule(value):
+            path = getattr(value, '__file__', None)
+            if path is not None and is_project_file(path):
+                # Attributes of the module referenced by the code
+                for attr in names:
+                    if attr in vars(value):
+                        visit_value(f'{name}.{attr}', vars(value)[attr],
+                                    names, path)
+        elif is_constant(value):
+            hash_obj.update(f'{name}={value!r}')
+        elif is_immutable_data(value):
+            try:
+                digest = hash_data(value)
+            except (TypeError, AttributeError): # Not hashable as data
+                return
+            hash_obj.update(f'{name}={digest}')
+        elif is_data(value):
+            # Mutable, so by its assignment in the module's source
+            assignment = module_assignment(module_path, name.split('.')[-1])
+            if module_path is not None and file_mtime(module_path) is not None:
+                mtimes[module_path] = file_mtime(module_path)
+            hash_obj.update(f'{name}:{type(value).__name__}')
+            if assignment is not None:
+                hash_obj.update(assignment)
+
+    visit(func, strict=True)
+    return hash_obj.hexdigest(), mtimes
@@ -0,0 +1,682 @@
+from collections.abc import Mapping, MutableSequence
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+from enum import Enum
+from functools import lru_cache, partial
+import inspect
+import marshal
+import os
+from pathlib import PurePath
+import pickle
+import struct
+import threading
+import types
+from typing import Callable, Dict, Optional
+import weakref
+
+import metrohash
+import numpy as np
+import torch
+
+from .conversion import (
+    LEAF,
+    MAPPING,
+    OBJECT,
+    node_kind,
+    to_np,
+    is_numeric,
+    is_array,
+)
+
+HASH_MODES = ('flat', 'tree', 'fast')
+CHUNK_BYTES = 16 * 2**20
+# Fast fingerprints (see hash_array_fast)
+FAST_MIN_BYTES = 64 * 2**20
+FAST_BLOCKS = 16
+FAST_BLOCK_BYTES = 64 * 2**10
+FAST_SAMPLES = 4096
+
+
+def hash_array_flat(data, hash_fn):
+    hash_fn(np.ascontiguousarray(to_np(data)))
+
+
+def copy_flat_range(arr: np.ndarray, start: int, stop: int, out: np.ndarray):
+    """Copies elements start:stop of arr, in C order, into the 1d array out
+    without copying the rest of arr"""
+    if arr.ndim <= 1:
+        out[:] = arr.reshape(-1)[start:stop]
+        return
+    row_size = arr[0].size
+    first, last = -(-start // row_size), stop // row_size
+    if first > last: # Within a single row
+        copy_flat_range(arr[start // row_size], start % row_size,
+                        stop % row_size, out)
+        return
+    pos = 0
+    if start % row_size != 0: # Partial first row
+        pos = first*row_size - start
+        copy_flat_range(arr[first - 1], start % row_size, row_size,
+                        out[:pos])
+    rows = arr[first:last]
+    np.copyto(out[pos:pos + rows.size].reshape(rows.shape), rows)
+    pos += rows.size
+    if stop % row_size != 0: # Partial last row
+        copy_flat_range(arr[last], 0, stop % row_size, out[pos:])
+
+
+def iter_blocks(arr: np.ndarray, chunk_bytes: int):
+    """Yields the elements of arr in C order, in contiguous 1d blocks of
+    about chunk_bytes each. Blocks of contiguous arrays are views; otherwise
+    only one block is materialized at a time, so non-contiguous views are
+    never copied in full.
+    Block boundaries depend only on size and dtype, not on shape or memory
+    layout, so arrays with huge rows are split too.
+    """
+    block_size = max(chunk_bytes // max(arr.itemsize, 1), 1)
+    flat = arr.reshape(-1) if arr.flags.c_contiguous else None
+    for start in range(0, arr.size, block_size):
+        stop = min(start + block_size, arr.size)
+        if flat is not None:
+            yield flat[start:stop]
+        else:
+            block = np.empty(stop - start, dtype=arr.dtype)
+            copy_flat_range(arr, start, stop, block)
+            yield block
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def hash_pool() -> ThreadPoolExecutor:
+    """Thread pool shared by all tree hashes, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                       thread_name_prefix='hash')
+        return _pool
+
+
+def hash_array_tree(data, hash_fn,
+                    chunk_bytes: int = CHUNK_BYTES,
+                    max_workers: Optional[int] = None):
+    """Hashes fixed-size blocks of an array (see iter_blocks) on a shared
+    thread pool and feeds the combined digest of the blocks to hash_fn.
+    metrohash releases the GIL while hashing buffers. Arrays that fit in a
+    single block are hashed on the calling thread.
+    max_workers: maximum number of blocks hashed at once
+    """
+    arr = to_np(data)
+    if arr.nbytes <= chunk_bytes:
+        hash_fn(b''.join(metrohash.hash64(block)
+                         for block in iter_blocks(arr, chunk_bytes)))
+        return
+    window = 2 * (max_workers or os.cpu_count() or 1)
+    pool = hash_pool()
+    digests = []
+    pending = []
+    for block in iter_blocks(arr, chunk_bytes):
+        pending.append(pool.submit(metrohash.hash64, block))
+        # Bound the number of materialized blocks in flight
+        if len(pending) >= window:
+            digests.append(pending.pop(0).result())
+    digests.extend(f.result() for f in pending)
+    hash_fn(b''.join(digests))
+
+
+def hash_array_fast(data, hash_fn,
+                    min_bytes: int = FAST_MIN_BYTES,
+                    blocks: int = FAST_BLOCKS,
+                    block_bytes: int = FAST_BLOCK_BYTES,
+                    samples: int = FAST_SAMPLES):
+    """Fingerprint of an array from samples of its contents, for arrays of
+    more than min_bytes (smaller ones are hashed like hash_array_flat):
+    checksums of blocks of block_bytes evenly spaced through the elements
+    (in C order, including the first and last), and samples elements
+    evenly strided across the whole array. Only the samples are read (and
+    copied from the GPU), so changes elsewhere go unnoticed.
+    """
+    if isinstance(data, torch.Tensor):
+        size, itemsize = data.numel(), data.element_size()
+    else:
+        size, itemsize = data.size, data.itemsize
+    if size * itemsize <= min_bytes:
+        hash_array_flat(data, hash_fn)
+        return
+    if isinstance(data, torch.Tensor):
+        # Sampled on the tensor's device
+        flat = data.detach().reshape(-1)
+        take_range = lambda start, stop: to_np(flat[start:stop])
+        take = lambda idx: to_np(flat[torch.from_numpy(idx).to(flat.device)])
+    else:
+        arr = to_np(data)
+        def take_range(start, stop):
+            out = np.empty(stop - start, dtype=arr.dtype)
+            copy_flat_range(arr, start, stop, out)
+            return out
+        take = lambda idx: arr[np.unravel_index(idx, arr.shape)]
+    block_size = min(max(block_bytes // itemsize, 1), size)
+    for start in np.linspace(0, size - block_size, blocks).astype(np.int64):
+        hash_fn(metrohash.hash64(take_range(int(start), int(start) + block_size)))
+    idx = np.linspace(0, size - 1, samples).astype(np.int64)
+    hash_fn(np.ascontiguousarray(take(idx)))
+
+
+HASH_ARRAY_FNS = {
+    'flat': hash_array_flat,
+    'tree': hash_array_tree,
+    'fast': hash_array_fast,
+}
+
+
+@lru_cache(maxsize=None)
+def _torch_dtype_str(dtype: torch.dtype) -> str:
+    try:
+        return torch.empty(0, dtype=dtype).numpy().dtype.str
+    except TypeError: # No numpy equivalent, e.g. bfloat16
+        return str(dtype)
+
+
+def array_layout(data) -> str:
+    """dtype and shape of an array, the same for numpy, torch and cupy
+    arrays holding the same elements"""
+    if isinstance(data, torch.Tensor):
+        dtype = _torch_dtype_str(data.dtype)
+    else:
+        dtype = data.dtype.str
+    return f'{dtype}{tuple(data.shape)}'
+
+
+def array_digest(data, mode: str = 'flat') -> bytes:
+    """Digest of a single array's dtype, shape and contents"""
+    hash_obj = metrohash.MetroHash64()
+    hash_obj.update(array_layout(data))
+    HASH_ARRAY_FNS[mode](data, hash_obj.update)
+    return hash_obj.digest()
+
+
+def is_frozen(arr: np.ndarray) -> bool:
+    """Whether the contents of arr can't change: arr and every array it is
+    a view of are read-only, and the memory they view is immutable"""
+    base = arr
+    while isinstance(base, np.ndarray):
+        if base.flags.writeable:
+            return False
+        base = base.base
+    if base is None or isinstance(base, bytes):
+        return True
+    try:
+        return memoryview(base).readonly
+    except TypeError:
+        return False
+
+
+def freeze(arr: np.ndarray):
+    """Marks arr and the arrays it is a view of read-only"""
+    base = arr
+    while isinstance(base, np.ndarray):
+        base.flags.writeable = False
+        base = base.base
+
+
+def array_fingerprint(data):
+    """Cheap description of an array's identity and contents version.
+    Returns None if the contents could have changed without the fingerprint
+    changing, in which case the array's digest must not be memoized.
+    - torch tensors: the in-place modification counter `_version`
+    - numpy arrays: only frozen arrays (see is_frozen), since writes
+      through a writable base would go unnoticed
+    """
+    if isinstance(data, torch.Tensor):
+        return ('torch', data._version, data.data_ptr(), data.device,
+                tuple(data.shape), tuple(data.stride()), data.dtype)
+    elif isinstance(data, np.ndarray):
+        if not is_frozen(data):
+            return None
+        return ('numpy', data.__array_interface__['data'][0],
+                data.shape, data.strides, data.dtype.str)
+    return None
+
+
+class HashMemo:
+    """Memoizes array digests by object identity
+
+    Entries are keyed by id() and dropped when the object is garbage
+    collected (via weakref). An entry is only reused if the array's
+    fingerprint (see array_fingerprint) has not changed since it was hashed.
+
+    freeze_arrays: mark numpy arrays (and the arrays they are views of)
+      read-only once hashed, so that writable arrays can also be memoized.
+      Writing to them afterwards raises.
+    reuse_output_keys: node outputs that are arrays are registered with a
+      digest derived from the node's key, so downstream nodes taking them as
+      arguments do not hash their contents.
+
+    Array outputs of nodes are also remembered by identity (weakly) along
+    with the node and key that produced them and their fingerprint (see
+    output_ref), so that calling a node by hand on an upstream output gives
+    the same key as DataPipeline.run. Only outputs whose changes the
+    fingerprint catches qualify (torch tensors, and frozen numpy arrays);
+    containers and other outputs are always hashed by contents.
+    """
+    def __init__(self,
+                 freeze_arrays: bool = False,
+                 reuse_output_keys: bool = False,
+    ):
+        self.freeze_arrays = freeze_arrays
+        self.reuse_output_keys = reuse_output_keys
+        self._entries = {}
+        self._outputs = {} # id -> (ref, fingerprint, (node, key))
+        self._lock = threading.Lock()
+
+    def _fingerprint(self, data):
+        if self.freeze_arrays and isinstance(data, np.ndarray):
+            freeze(data)
+        return array_fingerprint(data)
+
+    def _remove(self, obj_id, ref):
+        with self._lock:
+            entry = self._entries.get(obj_id)
+            if entry is not None and entry[0] is ref:
+                del self._entries[obj_id]
+
+    def get(self, data, mode: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(id(data))
+        if entry is None:
+            return None
+        ref, fingerprint, digests = entry
+        if ref() is not data or array_fingerprint(data) != fingerprint:
+            return None
+        return digests.get(mode)
+
+    def put(self, data, mode: str, digest: bytes):
+        fingerprint = self._fingerprint(data)
+        if fingerprint is None:
+            return
+        obj_id = id(data)
+        with self._lock:
+            entry = self._entries.get(obj_id)
+            if (entry is not None
+                and entry[0]() is data
+                and entry[1] == fingerprint):
+                entry[2][mode] = digest
+                return
+            ref = weakref.ref(data, lambda r: self._remove(obj_id, r))
+            self._entries[obj_id] = (ref, fingerprint, {mode: digest})
+
+    def digest(self, data, mode: str = 'flat') -> bytes:
+        digest = self.get(data, mode)
+        if digest is None:
+            digest = array_digest(data, mode)
+            self.put(data, mode, digest)
+        return digest
+
+    def register_output(self, data, key: str, node: Optional[str] = None):
+        """Registers a node output as produced by node with key, and under a
+        digest derived from its key if reuse_output_keys is set"""
+        if node is not None:
+            self._register_ref(data, node, key)
+        if (not self.reuse_output_keys
+            or not isinstance(data, (np.ndarray, torch.Tensor))):
+            return
+        digest = metrohash.hash64(f'output:{key}')
+        for mode in HASH_MODES:
+            self.put(data, mode, digest)
+
+    def _register_ref(self, data, node: str, key: str):
+        obj_id = id(data)
+        fingerprint = self._fingerprint(data)
+        if fingerprint is None:
+            # Changes couldn't be detected, so it is hashed by contents
+            with self._lock:
+                self._outputs.pop(obj_id, None)
+            return
+        ref = weakref.ref(data, lambda r: self._remove_output(obj_id, r))
+        with self._lock:
+            self._outputs[obj_id] = (ref, fingerprint, (node, key))
+
+    def _remove_output(self, obj_id, ref):
+        with self._lock:
+            entry = self._outputs.get(obj_id)
+            if entry is not None and entry[0] is ref:
+                del self._outputs[obj_id]
+
+    def output_ref(self, data) -> Optional[tuple]:
+        """(node, key) of the node output data is, or None if data isn't a
+        registered output or changed since it was registered"""
+        with self._lock:
+            entry = self._outputs.get(id(data))
+        if (entry is None or entry[0]() is not data
+                or array_fingerprint(data) != entry[1]):
+            return None
+        return entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._outputs.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def recursive_hash(data, hash_fn, hash_array=hash_array_flat):
+    """hash_fn should be an incremental hash function
+    hash_array(arr, hash_fn) feeds an array to hash_fn
+    """
+    apply = partial(recursive_hash, hash_fn=hash_fn, hash_array=hash_array)
+    if is_numeric(data):
+        hash_fn(str(data))
+    elif isinstance(data, str):
+        hash_fn(data)
+    elif is_array(data):
+        hash_array(data, hash_fn)
+    elif isinstance(data, Mapping):
+        for k, v in data.items():
+            apply(k)
+            apply(v)
+    elif isinstance(data, (MutableSequence, tuple)):
+        for v in data:
+            apply(v)
+
+
+_UNRESOLVED = object()
+
+
+def hash_scalar(data, hash_fn):
+    """Hashes a number from its binary form, tagged with its type so that
+    e.g. 1, 1.0 and True differ"""
+    if isinstance(data, (bool, np.bool_)):
+        hash_fn(b'?\x01' if data else b'?\x00')
+    elif isinstance(data, int):
+        payload = data.to_bytes(data.bit_length() // 8 + 1, 'little',
+                                signed=True)
+        hash_fn(b'i' + len(payload).to_bytes(2, 'little') + payload)
+    elif isinstance(data, float):
+        hash_fn(struct.pack('<cd', b'f', data))
+    elif isinstance(data, complex):
+        hash_fn(struct.pack('<cdd', b'c', data.real, data.imag))
+    else: # Numpy scalar
+        hash_fn(b'n' + data.dtype.str.encode() + data.tobytes())
+
+
+# type -> handler(data, hash_fn, hash_array), see register_hash
+HASH_HANDLERS: Dict[type, Callable] = {}
+_resolved_handlers = {} # type -> handler or None, including subclasses
+
+
+def register_hash(cls: type, handler: Optional[Callable] = None):
+    """Registers handler(data, hash_fn, hash_array) to hash instances of cls
+    and its subclasses in hash_nested, instead of walking them. Handlers
+    feed bytes or strings to hash_fn and can hash nested data with
+    hash_nested(..., hash_fn, hash_array). Usable as a decorator:
+
+        @register_hash(MyType)
+        def hash_my_type(data, hash_fn, hash_array):
+            hash_nested(data.contents, hash_fn, hash_array)
+    """
+    if handler is None:
+        return lambda handler: register_hash(cls, handler)
+    HASH_HANDLERS[cls] = handler
+    _resolved_handlers.clear()
+    return handler
+
+
+def hash_handler(cls: type) -> Optional[Callable]:
+    """Handler for instances of cls: the registered handler of the closest
+    base class, hash_slots for objects with __slots__ but no __dict__ (e.g.
+    dataclasses with slots=True), or None for the default walk"""
+    try:
+        return _resolved_handlers[cls]
+    except KeyError:
+        pass
+    handler = None
+    for base in cls.__mro__:
+        if base in HASH_HANDLERS:
+            handler = HASH_HANDLERS[base]
+            break
+    else:
+        if (node_kind(cls) == OBJECT
+                and not any('__dict__' in vars(base) for base in cls.__mro__)):
+            handler = hash_slots
+    _resolved_handlers[cls] = handler
+    return handler
+
+
+def hash_slots(data, hash_fn, hash_array):
+    """Hashes an object without __dict__ as the mapping of its set slots,
+    like objects with a __dict__"""
+    bases = [base for base in reversed(type(data).__mro__)
+             if '__slots__' in vars(base)]
+    if len(bases) == 0:
+        hash_pickled(data, hash_fn, hash_array)
+        return
+    names = []
+    for base in bases:
+        slots = vars(base)['__slots__']
+        names.extend([slots] if isinstance(slots, str) else slots)
+    items = [(name, getattr(data, name)) for name in names
+             if name not in ('__dict__', '__weakref__') and hasattr(data, name)]
+    _hash_items(items, len(items), hash_fn, hash_array)
+
+
+def hash_pickled(data, hash_fn, hash_array):
+    """Fallback for objects with neither __dict__ nor __slots__ (e.g. of
+    extension types): their pickled state"""
+    try:
+        pickled = pickle.dumps(data, protocol=4)
+    except Exception as e:
+        raise TypeError(f'Cannot hash {type(data).__qualname__} objects: '
+                        f'they have neither __dict__ nor __slots__ and '
+                        f'can\'t be pickled, see hashing.register_hash') from e
+    hash_fn(b'P' + type(data).__qualname__.encode())
+    hash_bytes(pickled, hash_fn, hash_array)
+
+
+@register_hash(torch.device)
+@register_hash(torch.dtype)
+@register_hash(np.dtype)
+@register_hash(np.ufunc)
+@register_hash(range)
+@register_hash(datetime.date)
+@register_hash(datetime.time)
+@register_hash(datetime.timedelta)
+@register_hash(datetime.tzinfo)
+def hash_repr(data, hash_fn, hash_array):
+    """Values identified by their class and repr"""
+    hash_fn(b'r')
+    hash_nested(type(data).__qualname__, hash_fn, hash_array)
+    hash_nested(repr(data), hash_fn, hash_array)
+
+
+@register_hash(slice)
+def hash_slice(data, hash_fn, hash_array):
+    hash_fn(b'z')
+    hash_nested((data.start, data.stop, data.step), hash_fn, hash_array)
+
+
+def _code_contents(code: types.CodeType) -> bytes:
+    """Bytecode, names and constants of code, without line numbers"""
+    consts = tuple(_code_contents(c) if isinstance(c, types.CodeType) else c
+                   for c in code.co_consts)
+    return marshal.dumps((code.co_code, code.co_names, code.co_varnames,
+                          consts))
+
+
+@lru_cache(maxsize=None)
+def code_fingerprint(code: types.CodeType) -> str:
+    """Hash of the normalized source of code (see
+    fingerprint.source_fingerprint), or of its bytecode without source.
+    The source of a lambda is the lines it's on, so its bytecode is
+    included to tell apart lambdas on the same line."""
+    from .fingerprint import source_fingerprint
+    try:
+        src = source_fingerprint(code)
+    except SyntaxError:
+        # Part of a statement, e.g. a lambda in a call spanning lines
+        src = ' '.join(inspect.getsource(code).split())
+    except (OSError, TypeError): # Defined in a REPL or exec
+        return metrohash.hash64_hex(_code_contents(code))
+    if code.co_name == '<lambda>':
+        return metrohash.hash64_hex(src.encode() + _code_contents(code))
+    return metrohash.hash64_hex(src)
+
+
+@register_hash(types.FunctionType)
+def hash_function(data, hash_fn, hash_array):
+    """By qualified name, source and default arguments. Values captured by
+    closures and globals aren't included."""
+    hash_fn(b'F')
+    hash_nested(f'{data.__module__}.{data.__qualname__}', hash_fn, hash_array)
+    hash_nested(code_fingerprint(data.__code__), hash_fn, hash_array)
+    hash_nested(data.__defaults__, hash_fn, hash_array)
+    hash_nested(data.__kwdefaults__, hash_fn, hash_array)
+
+
+@register_hash(types.BuiltinFunctionType)
+def hash_builtin_function(data, hash_fn, hash_array):
+    """By qualified name, and the object it's bound to if any"""
+    hash_fn(b'B')
+    hash_nested(f'{data.__module__}.{data.__qualname__}', hash_fn, hash_array)
+    bound = data.__self__
+    hash_nested(None if isinstance(bound, types.ModuleType) else bound,
+                hash_fn, hash_array)
+
+
+@register_hash(types.MethodType)
+def hash_method(data, hash_fn, hash_array):
+    hash_fn(b'T')
+    hash_nested(data.__func__, hash_fn, hash_array)
+    hash_nested(data.__self__, hash_fn, hash_array)
+
+
+@register_hash(partial)
+def hash_partial(data, hash_fn, hash_array):
+    hash_fn(b'A')
+    hash_nested(data.func, hash_fn, hash_array)
+    hash_nested(data.args, hash_fn, hash_array)
+    hash_nested(data.keywords, hash_fn, hash_array)
+
+
+@register_hash(torch.nn.Module)
+def hash_module(data, hash_fn, hash_array):
+    """The module's class name and state_dict: its parameters and persistent
+    buffers, by name. The tensors themselves are hashed (keep_vars), so their
+    digests can be memoized."""
+    hash_fn(b'M' + type(data).__qualname__.encode())
+    state = data.state_dict(keep_vars=True)
+    _hash_items(state.items(), len(state), hash_fn, hash_array)
+
+
+@register_hash(PurePath)
+def hash_path(data, hash_fn, hash_array):
+    hash_fn(b'p')
+    hash_nested(os.fspath(data), hash_fn, hash_array)
+
+
+@register_hash(Enum)
+def hash_enum(data, hash_fn, hash_array):
+    """By class and member name, so that the values can change"""
+    hash_fn(b'e')
+    hash_nested(type(data).__qualname__, hash_fn, hash_array)
+    hash_nested(data.name, hash_fn, hash_array)
+
+
+@register_hash(bytes)
+@register_hash(bytearray)
+@register_hash(memoryview)
+def hash_bytes(data, hash_fn, hash_array):
+    data = memoryview(data).cast('B')
+    hash_fn(b'b' + len(data).to_bytes(8, 'little'))
+    hash_fn(data)
+
+
+@register_hash(set)
+@register_hash(frozenset)
+def hash_set(data, hash_fn, hash_array):
+    """Independent of iteration order: the sorted digests of the items"""
+    digests = []
+    for item in data:
+        hash_obj = metrohash.MetroHash64()
+        hash_nested(item, hash_obj.update, hash_array)
+        digests.append(hash_obj.digest())
+    hash_fn(b'S' + len(digests).to_bytes(8, 'little'))
+    hash_fn(b''.join(sorted(digests)))
+
+
+def hash_nested(data, hash_fn, hash_array=hash_array_flat):
+    """Hashes nested data in a single pass. Types with a handler (see
+    register_hash and hash_handler) are hashed by it; otherwise dispatches
+    on node_kind. Every node is tagged with its kind, and containers and
+    strings with their lengths, so that different structures of the same
+    leaves differ. Objects are hashed as the mapping of their __dict__ (or
+    of their to_nested_mapping), lists like tuples.
+    """
+    cls = type(data)
+    handler = _resolved_handlers.get(cls, _UNRESOLVED)
+    if handler is _UNRESOLVED:
+        handler = hash_handler(cls)
+    if handler is not None:
+        handler(data, hash_fn, hash_array)
+        return
+    kind = node_kind(cls)
+    if kind == LEAF:
+        if isinstance(data, str):
+            encoded = data.encode('utf-8', 'surrogatepass')
+            hash_fn(b's' + len(encoded).to_bytes(8, 'little') + encoded)
+        elif is_array(data):
+            hash_fn(b'a')
+            hash_array(data, hash_fn)
+        elif data is None:
+            hash_fn(b'N')
+        else:
+            hash_scalar(data, hash_fn)
+    elif kind == MAPPING:
+        _hash_items(data.items(), len(data), hash_fn, hash_array)
+    elif kind != OBJECT:
+        hash_fn(b'l' + len(data).to_bytes(8, 'little'))
+        for v in data:
+            hash_nested(v, hash_fn, hash_array)
+    elif hasattr(data, 'to_nested_mapping'):
+        hash_nested(data.to_nested_mapping, hash_fn, hash_array)
+    else:
+        _hash_items(data.__dict__.items(), len(data.__dict__), hash_fn,
+                    hash_array)
+
+
+def _hash_items(items, length: int, hash_fn, hash_array):
+    hash_fn(b'm' + length.to_bytes(8, 'little'))
+    for k, v in items:
+        hash_nested(k, hash_fn, hash_array)
+        hash_nested(v, hash_fn, hash_array)
+
+
+def hash_data(data, mode: str = 'flat', memo: Optional[HashMemo] = None):
+    """
+    mode:
+      'flat': each array is hashed as one contiguous buffer.
+      'tree': arrays are hashed in parallel chunks, see hash_array_tree.
+      'fast': arrays over FAST_MIN_BYTES are only sampled, see
+        hash_array_fast. Opt-in, for interactive runs: changes to unsampled
+        elements don't change the key.
+    The modes produce different (but each stable) keys.
+    memo: optional HashMemo for reusing array digests across calls.
+
+    Each array contributes its own digest (which includes its dtype and
+    shape) to the overall hash, so keys are identical with or without a
+    memo. Numbers are hashed from their binary form (see hash_scalar).
+    """
+    if mode not in HASH_MODES:
+        raise ValueError(f'Unknown hash mode: {mode}, must be one of {HASH_MODES}')
+    if memo is not None:
+        digest_fn = partial(memo.digest, mode=mode)
+    else:
+        digest_fn = partial(array_digest, mode=mode)
+    hash_array = lambda arr, hash_fn: hash_fn(digest_fn(arr))
+    hash_obj = metrohash.MetroHash64()
+    hash_nested(data, hash_obj.update, hash_array)
+    return hash_obj.hexdigest()
+
@@ -0,0 +1,237 @@
+import atexit
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Optional
+
+
+class CacheIndex:
+    """SQLite catalog of the entries of all caches in a cache_dir
+
+    Each row maps a (cache, key) pair to its shard file, size, creation and
+    last access times, compute runtime and producer node. Fields that aren't
+    columns (e.g. the blobs of a DedupPklCache entry) are kept as json in
+    `extra`. Rows without a file only hold metadata for a pending store.
+
+    Lookups and single-entry updates touch one row, so checking for a key
+    costs the same no matter how many entries there are. Access times are
+    written in batches, at most every touch_interval seconds, so that
+    repeated hits don't each take the write lock. Safe for concurrent use
+    by several threads and processes.
+
+    Uses SQLite's default rollback journal, which relies only on file
+    locks and so also works on network filesystems (as far as they
+    implement them). Setting wal switches to write-ahead logging, which lets
+    readers proceed during writes, but needs shared memory: only use it when
+    all processes sharing the cache_dir run on the same host.
+    """
+    filename = 'index.sqlite'
+    columns = ('file', 'size', 'created', 'accessed', 'runtime', 'node')
+    touch_interval = 1.
+    wal = False
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self._local = threading.local()
+        self._touched = {} # (cache, key) -> access time not yet written
+        self._touched_at = 0.
+        self._touch_lock = threading.Lock()
+
+    @property
+    def path(self) -> Path:
+        return self.cache_dir/self.filename
+
+    def exists(self) -> bool:
+        return self.path.is_file()
+
+    def connection(self) -> sqlite3.Connection:
+        """Connection for the current thread, created on first use, and
+        again after a fork or if the database file was deleted"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            if self._local.pid != os.getpid():
+                # Inherited across fork: closing it would release the
+                # parent's locks, so keep it open and unused
+                _inherited.append(conn)
+            elif self.path.is_file():
+                return conn
+            else:
+                conn.close()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60., isolation_level=None)
+        if self.wal:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        else:
+            try:
+                # Index files created in WAL mode keep it until switched back
+                conn.execute('PRAGMA journal_mode=DELETE')
+            except sqlite3.OperationalError:
+                pass # Still open in WAL mode elsewhere
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            ' cache TEXT NOT NULL, key TEXT NOT NULL,'
+            ' file TEXT, size INTEGER, created REAL, accessed REAL,'
+            ' runtime REAL, node TEXT, extra TEXT,'
+            ' PRIMARY KEY (cache, key))'
+        )
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Groups several statements into one atomic write, holding the
+        write lock throughout. Nested transactions join the outer one."""
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @classmethod
+    def _to_entry(cls, row) -> dict:
+        entry = {column: value for column, value in zip(cls.columns, row)
+                 if value is not None}
+        if row[len(cls.columns)] is not None:
+            entry.update(json.loads(row[len(cls.columns)]))
+        return entry
+
+    def _select(self, where: str = '', params: tuple = ()):
+        return self.connection().execute(
+            f'SELECT cache, key, {", ".join(self.columns)}, extra '
+            f'FROM entries {where}', params
+        )
+
+    def get(self, cache: str, key: str) -> Optional[dict]:
+        self.flush_touched()
+        row = self._select('WHERE cache = ? AND key = ?',
+                           (cache, key)).fetchone()
+        return None if row is None else self._to_entry(row[2:])
+
+    def contains(self, cache: str, key: str) -> bool:
+        """Whether key has a stored output in cache"""
+        return self.connection().execute(
+            'SELECT 1 FROM entries WHERE cache = ? AND key = ?'
+            ' AND file IS NOT NULL', (cache, key)
+        ).fetchone() is not None
+
+    def entries(self, cache: Optional[str] = None) -> dict:
+        """key -> entry for cache, or (cache, key) -> entry for all caches"""
+        self.flush_touched()
+        if cache is not None:
+            return {row[1]: self._to_entry(row[2:])
+                    for row in self._select('WHERE cache = ?', (cache,))}
+        return {(row[0], row[1]): self._to_entry(row[2:])
+                for row in self._select()}
+
+    def keys(self, cache: str) -> list:
+        return [row[0] for row in self.connection().execute(
+            'SELECT key FROM entries WHERE cache = ? AND file IS NOT NULL',
+            (cache,)
+        )]
+
+    def caches(self) -> list:
+        return [row[0] for row in self.connection().execute(
+            'SELECT DISTINCT cache FROM entries ORDER BY cache'
+        )]
+
+    def nbytes(self, cache: Optional[str] = None) -> int:
+        if cache is None:
+            row = self.connection().execute(
+                'SELECT SUM(size) FROM entries').fetchone()
+        else:
+            row = self.connection().execute(
+                'SELECT SUM(size) FROM entries WHERE cache = ?', (cache,)
+            ).fetchone()
+        return row[0] or 0
+
+    def update(self, cache: str, key: str, **fields):
+        """Sets the given fields of an entry, creating it if needed.
+        The creation time of an existing entry is never changed. Fields other
+        than columns replace the entry's extra fields.
+        """
+        columns = {name: value for name, value in fields.items()
+                   if name in self.columns}
+        extra = {name: value for name, value in fields.items()
+                 if name not in self.columns}
+        if len(extra) > 0:
+            columns['extra'] = json.dumps(extra)
+        names = list(columns)
+        assignments = [
+            f'{name} = COALESCE(entries.{name}, excluded.{name})'
+            if name == 'created' else f'{name} = excluded.{name}'
+            for name in names
+        ]
+        self.connection().execute(
+            f'INSERT INTO entries (cache, key{"".join(", " + n for n in names)})'
+            f' VALUES (?, ?{", ?" * len(names)})'
+            f' ON CONFLICT (cache, key) DO '
+            + (f'UPDATE SET {", ".join(assignments)}' if names else 'NOTHING'),
+            (cache, key, *columns.values())
+        )
+
+    def touch(self, cache: str, key: str, accessed: float):
+        """Updates the access time of an existing entry. Written with the
+        next batch, see flush_touched."""
+        with self._touch_lock:
+            self._touched[(cache, key)] = accessed
+            if accessed - self._touched_at < self.touch_interval:
+                return
+        self.flush_touched()
+
+    def flush_touched(self):
+        """Writes the pending access times in one transaction"""
+        with self._touch_lock:
+            if len(self._touched) == 0:
+                return
+            touched, self._touched = self._touched, {}
+            self._touched_at = max(touched.values())
+        with self.transaction() as conn:
+            conn.executemany(
+                'UPDATE entries SET accessed = MAX(COALESCE(accessed, 0), ?)'
+                ' WHERE cache = ? AND key = ?',
+                [(accessed, cache, key)
+                 for (cache, key), accessed in touched.items()]
+            )
+
+    def remove(self, cache: str, key: str):
+        self.connection().execute(
+            'DELETE FROM entries WHERE cache = ? AND key = ?', (cache, key)
+        )
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path})'
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+_inherited = []
+
+
+@atexit.register
+def _flush_indexes():
+    for index in list(_indexes.values()):
+        try:
+            index.flush_touched()
+        except sqlite3.Error:
+            pass
+
+
+def open_index(cache_dir: Path) -> CacheIndex:
+    """The CacheIndex of cache_dir, shared within the process so that
+    connections are reused"""
+    path = os.path.abspath(cache_dir)
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = CacheIndex(Path(path))
+        return _indexes[path]
@@ -0,0 +1,252 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field, fields
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+import torch
+
+
+@dataclass
+class NodeCall:
+    """Measurements of one call of a Node. Times are in seconds.
+
+    hit: whether the output was loaded from the node's cache (None if the
+      node has no cache)
+    bytes_read, bytes_written: array bytes loaded from and stored to the cache
+    peak_rss_increase: how much the call raised the peak resident memory of
+      the process, in bytes. The process peak can't be reset, so calls that
+      stay below an earlier peak record 0.
+    peak_cuda_memory: peak memory allocated by torch on the current CUDA
+      device during the call, in bytes (None without CUDA). The peak is
+      reset when the call starts, so calls overlapping on other threads
+      share it and may see each other's allocations or resets.
+    spans: [phase, start, duration] of each timed phase of the call, with
+      wall clock start times (see trace_events)
+    """
+    node: str
+    key: Optional[str] = None
+    hit: Optional[bool] = None
+    start: float = 0. # Wall clock time of the start of the call
+    duration: float = 0.
+    # Included in duration when the key is computed by the call, but not
+    # for keys computed up front by DataPipeline.run
+    hash_time: float = 0.
+    load_time: float = 0.
+    compute_time: float = 0.
+    store_time: float = 0.
+    bytes_read: int = 0
+    bytes_written: int = 0
+    peak_rss_increase: Optional[int] = None
+    peak_cuda_memory: Optional[int] = None
+    # Process peak RSS when the call started
+    start_rss: Optional[int] = field(default=None, repr=False)
+    thread: str = ''
+    tid: int = 0
+    pid: int = 0
+    spans: list = field(default_factory=list)
+
+    @classmethod
+    def start_now(cls, node: str, key: Optional[str] = None,
+                  hash_time: float = 0.) -> 'NodeCall':
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        return cls(node=node, key=key, start=time.time(), hash_time=hash_time,
+                   start_rss=peak_rss(),
+                   thread=threading.current_thread().name,
+                   tid=threading.get_native_id(), pid=os.getpid())
+
+    def finish(self):
+        """Sets the duration and the memory peaks of the call"""
+        self.duration = time.time() - self.start
+        if self.start_rss is not None:
+            self.peak_rss_increase = peak_rss() - self.start_rss
+        if torch.cuda.is_available():
+            self.peak_cuda_memory = torch.cuda.max_memory_allocated()
+
+
+@contextmanager
+def timed(call: Optional[NodeCall], field: str):
+    """Adds the time spent in the context to field of call, if any, and
+    records it as a span named after field (e.g. 'load' for 'load_time')"""
+    if call is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        setattr(call, field, getattr(call, field) + duration)
+        call.spans.append([field.replace('_time', ''), start, duration])
+
+
+def peak_rss() -> Optional[int]:
+    if resource is None:
+        return None
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Sink(ABC):
+    """Receives the NodeCall of every call of the nodes it is attached to
+    (see DataPipeline.set_sink). Must be safe to call from several threads."""
+    @abstractmethod
+    def record(self, call: NodeCall):
+        return NotImplemented
+
+    @abstractmethod
+    def records(self) -> List[NodeCall]:
+        return NotImplemented
+
+
+class MemorySink(Sink):
+    """Keeps the records in a list"""
+    def __init__(self):
+        self._records = []
+        self._lock = threading.Lock()
+
+    def record(self, call: NodeCall):
+        with self._lock:
+            self._records.append(call)
+
+    def records(self) -> List[NodeCall]:
+        with self._lock:
+            return list(self._records)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+
+class JsonlSink(Sink):
+    """Appends each record as a line of json to path, so that several
+    processes can share the file"""
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def record(self, call: NodeCall):
+        line = json.dumps(asdict(call)) + '\n'
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # A single write of a line in append mode isn't interleaved
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+    def records(self) -> List[NodeCall]:
+        if not self.path.is_file():
+            return []
+        names = {f.name for f in fields(NodeCall)}
+        with open(self.path, 'r') as f:
+            return [NodeCall(**{k: v for k, v in json.loads(line).items()
+                                if k in names})
+                    for line in f if line.strip()]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path})'
+
+
+def summarize(records: List[NodeCall]) -> Dict[str, dict]:
+    """Totals per node: number of calls, hits and misses, times, bytes and
+    memory peaks"""
+    summary = {}
+    for call in records:
+        stats = summary.setdefault(call.node, {
+            'calls': 0, 'hits': 0, 'misses': 0,
+            'duration': 0., 'hash_time': 0., 'load_time': 0.,
+            'compute_time': 0., 'store_time': 0.,
+            'bytes_read': 0, 'bytes_written': 0,
+            'peak_rss_increase': None, 'peak_cuda_memory': None,
+        })
+        stats['calls'] += 1
+        if call.hit is not None:
+            stats['hits' if call.hit else 'misses'] += 1
+        for name in ['duration', 'hash_time', 'load_time', 'compute_time',
+                     'store_time', 'bytes_read', 'bytes_written']:
+            stats[name] += getattr(call, name)
+        for name in ['peak_rss_increase', 'peak_cuda_memory']:
+            value = getattr(call, name)
+            if value is not None:
+                stats[name] = max(stats[name] or 0, value)
+    return summary
+
+
+def format_summary(summary: Dict[str, dict]) -> str:
+    """Table of summarize's output, slowest nodes first"""
+    header = f'{"node":<24}{"calls":>6}{"hits":>6}{"total":>10}' \
+        + f'{"hash":>9}{"load":>9}{"compute":>10}{"store":>9}' \
+        + f'{"read MB":>9}{"write MB":>9}'
+    lines = [header]
+    for name, stats in sorted(summary.items(),
+                              key=lambda item: -item[1]['duration']):
+        lines.append(
+            f'{name:<24}{stats["calls"]:>6}{stats["hits"]:>6}'
+            + f'{stats["duration"]:>9.3f}s'
+            + f'{stats["hash_time"]:>8.3f}s{stats["load_time"]:>8.3f}s'
+            + f'{stats["compute_time"]:>9.3f}s{stats["store_time"]:>8.3f}s'
+            + f'{stats["bytes_read"] / 2**20:>9.1f}'
+            + f'{stats["bytes_written"] / 2**20:>9.1f}'
+        )
+    return '\n'.join(lines)
+
+
+def trace_events(records: List[NodeCall]) -> List[dict]:
+    """Chrome trace events (see chrome://tracing or ui.perfetto.dev) for
+    records: one track per process and thread, a span per call annotated
+    with its key, hit and byte counts, and spans for its phases inside it.
+    Records may come from several processes, e.g. from a shared JsonlSink.
+    """
+    events = []
+    threads = {}
+    for call in records:
+        threads[(call.pid, call.tid)] = call.thread
+        args = {'key': call.key, 'hit': call.hit,
+                'bytes_read': call.bytes_read,
+                'bytes_written': call.bytes_written}
+        if call.hash_time > 0 and not any(span[0] == 'hash'
+                                          for span in call.spans):
+            # Hashed up front by DataPipeline.run
+            args['hash_time'] = call.hash_time
+        events.append({
+            'name': call.node, 'cat': 'node', 'ph': 'X',
+            'ts': call.start * 1e6, 'dur': call.duration * 1e6,
+            'pid': call.pid, 'tid': call.tid, 'args': args,
+        })
+        for phase, start, duration in call.spans:
+            span_args = {'key': call.key}
+            if phase == 'load':
+                span_args['bytes'] = call.bytes_read
+            elif phase == 'store':
+                span_args['bytes'] = call.bytes_written
+            events.append({
+                'name': phase, 'cat': phase, 'ph': 'X',
+                'ts': start * 1e6, 'dur': duration * 1e6,
+                'pid': call.pid, 'tid': call.tid, 'args': span_args,
+            })
+    for (pid, tid), thread in sorted(threads.items()):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': thread}})
+    for pid in sorted({pid for pid, _ in threads}):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': f'pipeline ({pid})'}})
+    return events
+
+
+def save_trace(records: List[NodeCall], path: Path):
+    """Writes trace_events(records) as a trace file that opens in
+    chrome://tracing or Perfetto"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events(records),
+                   'displayTimeUnit': 'ms'}, f)
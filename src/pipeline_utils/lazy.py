@@ -0,0 +1,199 @@
+"""Lazy views of nested data, whose leaves are converted on first access"""
+from collections.abc import Mapping, MutableMapping, MutableSequence
+import functools
+from typing import Callable
+
+from .conversion import (
+    is_leaf_or_device_arr,
+    nbytes,
+    recursive_apply_inplace_with_stop,
+)
+
+
+class Pending:
+    """A value that hasn't been resolved yet"""
+    __slots__ = ('value', 'resolve')
+
+    def __init__(self, value, resolve: Callable):
+        self.value = value
+        self.resolve = resolve
+
+    def __call__(self):
+        return self.resolve(self.value)
+
+
+def _restore(data):
+    """Lazy views are pickled as their materialized data"""
+    return data
+
+
+class LazyMapping(MutableMapping):
+    """Mapping whose values are resolved on first access"""
+    def __init__(self, data=None, resolve: Callable = None):
+        self._data = dict(data or {})
+        if resolve is not None:
+            self._data = {k: Pending(v, resolve)
+                          for k, v in self._data.items()}
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if isinstance(value, Pending):
+            value = self._data[key] = value()
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __copy__(self):
+        return LazyMapping(self._data)
+
+    def __reduce_ex__(self, protocol):
+        return _restore, (materialize(self),)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({list(self._data)})'
+
+
+class LazySequence(MutableSequence):
+    """List whose items are resolved on first access"""
+    def __init__(self, data=None, resolve: Callable = None):
+        self._data = list(data or [])
+        if resolve is not None:
+            self._data = [Pending(v, resolve) for v in self._data]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        value = self._data[i]
+        if isinstance(value, Pending):
+            value = self._data[i] = value()
+        return value
+
+    def __setitem__(self, i, value):
+        self._data[i] = value
+
+    def __delitem__(self, i):
+        del self._data[i]
+
+    def __len__(self):
+        return len(self._data)
+
+    def insert(self, i, value):
+        self._data.insert(i, value)
+
+    def __copy__(self):
+        return LazySequence(self._data)
+
+    def __reduce_ex__(self, protocol):
+        return _restore, (materialize(self),)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self._data)} items)'
+
+
+class LazyObject:
+    """Mixin for lazy views of general objects (e.g. dataclasses).
+    Attributes are resolved on first access, and all at once when __dict__
+    is accessed, so code walking vars(obj) sees resolved values.
+    """
+    def __getattribute__(self, name):
+        value = object.__getattribute__(self, name)
+        if name == '__dict__':
+            for k, v in value.items():
+                if isinstance(v, Pending):
+                    value[k] = v()
+        elif isinstance(value, Pending):
+            value = object.__getattribute__(self, '__dict__')[name] = value()
+        return value
+
+    def __reduce_ex__(self, protocol):
+        return _restore, (materialize(self),)
+
+    def __eq__(self, other):
+        """Compared in materialized form, so that a lazy object equals the
+        instance of its original class the eager path would return"""
+        return materialize(self) == materialize(other)
+
+
+@functools.lru_cache(maxsize=None)
+def lazy_class(cls: type) -> type:
+    """Subclass of cls with lazily resolved attributes. type(obj) is not cls
+    for its instances; see materialize, or load with lazy=False."""
+    return type(cls.__name__, (LazyObject, cls),
+                {'__module__': cls.__module__,
+                 '__qualname__': cls.__qualname__,
+                 '__hash__': cls.__hash__})
+
+
+def lazy_view(data, leaf_fn: Callable, stop_cond=is_leaf_or_device_arr):
+    """Lazy view of data mirroring its structure (as walked by
+    recursive_apply_inplace_with_stop): mappings, lists and tuples (as
+    LazySequences) and general objects (as lazy subclasses of their class).
+    leaf_fn is applied to each leaf the first time it is accessed.
+    Objects without a __dict__ are returned as they are, and objects whose
+    class can't be subclassed are converted eagerly.
+    """
+    resolve = functools.partial(lazy_view, leaf_fn=leaf_fn,
+                                stop_cond=stop_cond)
+    if stop_cond(data):
+        return leaf_fn(data)
+    elif isinstance(data, Mapping):
+        return LazyMapping(data, resolve)
+    elif isinstance(data, (list, tuple)):
+        return LazySequence(data, resolve)
+    elif not hasattr(data, '__dict__'):
+        return data
+    try:
+        cls = lazy_class(type(data))
+    except TypeError: # Can't be subclassed
+        return recursive_apply_inplace_with_stop(data, leaf_fn, stop_cond)
+    out = object.__new__(cls)
+    object.__getattribute__(out, '__dict__').update(
+        {k: Pending(v, resolve) for k, v in data.__dict__.items()}
+    )
+    return out
+
+
+def is_lazy(data) -> bool:
+    return isinstance(data, (LazyMapping, LazySequence, LazyObject))
+
+
+def materialize(data):
+    """Resolves all the leaves of a lazy view, returning plain dicts, lists
+    and objects of their original classes"""
+    if isinstance(data, LazyMapping):
+        return {k: materialize(v) for k, v in data.items()}
+    elif isinstance(data, LazySequence):
+        return [materialize(v) for v in data]
+    elif isinstance(data, LazyObject):
+        cls = type(data).__mro__[2]
+        out = object.__new__(cls)
+        out.__dict__.update({k: materialize(v)
+                             for k, v in data.__dict__.items()})
+        return out
+    return data
+
+
+def stored_nbytes(data) -> int:
+    """Total size of the array leaves of data like conversion.nbytes, but
+    pending values of lazy views are counted in their stored form instead of
+    being resolved"""
+    if isinstance(data, Pending):
+        return nbytes(data.value)
+    elif isinstance(data, (LazyMapping, LazySequence)):
+        values = data._data
+        values = values.values() if isinstance(values, dict) else values
+    elif isinstance(data, LazyObject):
+        values = object.__getattribute__(data, '__dict__').values()
+    else:
+        return nbytes(data)
+    return sum(stored_nbytes(v) for v in values)
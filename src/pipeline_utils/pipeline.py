@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dataclasses import dataclass, field
 from enum import Enum, auto
 import functools
@@ -5,13 +6,46 @@ import hashlib
 import inspect
 import json
 from pathlib import Path
-from typing import Any, Callable, Optional, List, Type, Union
+import time
+from typing import Any, Callable, Dict, Optional, List, Type, Union
 
 import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 
-from .cache import hash_data
+from .cache import (
+    CacheManager,
+    MemoryCache,
+    TieredCache,
+    WriteBehindCache,
+)
+from .chunked import ChunkedArray
+from .fingerprint import (
+    dependency_fingerprint,
+    file_mtime,
+    source_file,
+    source_fingerprint,
+)
+from .conversion import nbytes
+from .hashing import hash_data, HashMemo
+from .lazy import stored_nbytes
+from .instrument import (
+    MemorySink,
+    NodeCall,
+    Sink,
+    format_summary,
+    save_trace,
+    summarize,
+    timed,
+)
+
+@dataclass
+class OutputRef:
+    """Stands in for the output of the upstream node `node` when computing
+    keys, see Node.graph_key"""
+    node: str
+    key: str
+
 
 class NodeState(Enum):
     DEFAULT = auto()
@@ -28,7 +62,10 @@ class Node:
                  ignore_args: Optional[list] = None,
                  device_idx: Optional[int] = None,
                  verbose: bool = False,
-
+                 hash_mode: str = 'flat',
+                 hash_memo: Optional[HashMemo] = None,
+                 track_dependencies: bool = True,
+                 sink: Optional[Sink] = None,
     ):
         self.func = func
         self.name = name or self.func.__name__
@@ -38,9 +75,64 @@ class Node:
         self.ignore_args = ignore_args or [] # Ignore for the purpose of caching
         self.device_idx = device_idx
         self.verbose = verbose
+        self.hash_mode = hash_mode # See hashing.hash_data
+        self.hash_memo = hash_memo
+        self.signature = inspect.signature(self.func)
+        self.track_dependencies = track_dependencies
+        self.sink = sink # Receives a NodeCall per call, see instrument
+        self.upstream: List['Node'] = [] # Set by DataPipeline.add_node
+        self.downstream: List['Node'] = []
+        self._fingerprint = None
+        self._fingerprint_mtimes = {}
+
+    def _fingerprint_stale(self) -> bool:
+        if self._fingerprint is None:
+            return True
+        for path, mtime in self._fingerprint_mtimes.items():
+            try:
+                if Path(path).stat().st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    @property
+    def code_fingerprint(self) -> str:
+        """Hash of the function's normalized source and, if
+        track_dependencies is set, of the project code and constants it
+        references (see fingerprint.dependency_fingerprint).
+        Recomputed only when one of the source files' mtime changes.
+        Includes the code fingerprints of upstream nodes.
+        """
+        if self._fingerprint_stale():
+            if self.track_dependencies:
+                self._fingerprint, self._fingerprint_mtimes = \
+                    dependency_fingerprint(self.func)
+            else:
+                self._fingerprint = source_fingerprint(self.func)
+                path = source_file(self.func)
+                mtime = None if path is None else file_mtime(path)
+                self._fingerprint_mtimes = {} if mtime is None \
+                    else {path: mtime}
+        if len(self.upstream) == 0:
+            return self._fingerprint
+        upstream = sorted((node.name, node.code_fingerprint)
+                          for node in self.upstream)
+        return hash_data([self._fingerprint, upstream])
+
+    @property
+    def needs_key(self) -> bool:
+        """Whether this node's key is used, by its own cache or by the key of
+        a cached node downstream"""
+        return self.cache is not None or any(
+            node.needs_key for node in self.downstream
+        )
 
     def get_key(self, *args, **kwargs):
-        bound_args = inspect.signature(self.func).bind(*args, **kwargs)
+        """Key of a call with the given arguments. Arguments that are
+        outputs of upstream nodes (see HashMemo.output_ref) are replaced by
+        OutputRefs, so keys match those of DataPipeline.run."""
+        bound_args = self.signature.bind(*args, **kwargs)
         bound_args.apply_defaults()
         args_dict = bound_args.arguments
         if 'self' in args_dict:
@@ -49,46 +141,188 @@ class Node:
         for k in self.ignore_args:
             if k in args_dict:
                 args_dict.pop(k)
+        if self.hash_memo is not None and len(self.upstream) > 0:
+            upstream = {node.name for node in self.upstream}
+            for k, v in args_dict.items():
+                ref = self.hash_memo.output_ref(v)
+                if ref is not None and ref[0] in upstream:
+                    args_dict[k] = OutputRef(*ref)
         # Add source code
-        func_src = inspect.getsource(self.func)
-        return f'{self.func.__name__}({hash_data([func_src, args_dict])})'
+        args_hash = hash_data([self.code_fingerprint, args_dict],
+                              mode=self.hash_mode,
+                              memo=self.hash_memo)
+        return f'{self.func.__name__}({args_hash})'
+
+    def bind_inputs(self, upstream_outputs: Dict[str, Any],
+                    inputs: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Builds the kwargs for calling this node from the outputs of its
+        upstream nodes and extra inputs.
+        1. Parameters named after an upstream node get that node's output.
+        2. Parameters named in inputs get that value.
+        3. Remaining upstream outputs fill the remaining parameters in order.
+        Parameters left over keep their default values.
+        """
+        inputs = inputs or {}
+        kwargs = {}
+        unused = [node.name for node in self.upstream]
+        for name in self.signature.parameters:
+            if name in upstream_outputs and name in unused:
+                kwargs[name] = upstream_outputs[name]
+                unused.remove(name)
+            elif name in inputs:
+                kwargs[name] = inputs[name]
+        for name, param in self.signature.parameters.items():
+            if len(unused) == 0:
+                break
+            if name in kwargs or param.kind in (param.VAR_POSITIONAL,
+                                                param.VAR_KEYWORD):
+                continue
+            kwargs[name] = upstream_outputs[unused.pop(0)]
+        return kwargs
+
+    def graph_key(self, upstream_keys: Dict[str, str],
+                  inputs: Optional[Dict[str, Any]] = None) -> str:
+        """Key computed from the keys of upstream nodes instead of their
+        outputs, so it is known before any upstream output is loaded.
+        Used by DataPipeline.run.
+        """
+        refs = {name: OutputRef(name, key)
+                for name, key in upstream_keys.items()}
+        return self.get_key(**self.bind_inputs(refs, inputs))
+
+    def is_cached(self, key: str) -> bool:
+        """Whether the output for key can be loaded without recomputing"""
+        return (self.cache is not None
+                and self.state == NodeState.DEFAULT
+                and key in self.cache)
+
+    def load(self, key: str, call: Optional[NodeCall] = None):
+        """Loads the cached output for key, or returns None.
+        call: NodeCall to add the load time and bytes to
+        """
+        if self.verbose:
+            print(f'Loading cached output of {self.func.__name__}')
+            print(f'> Attempting load from {self.cache}')
+        with timed(call, 'load_time'):
+            output = self.cache.load(
+                key=key,
+                device_idx=self.device_idx
+            )
+        if output is not None:
+            if self.verbose:
+                print('> Load succeeded.')
+            if call is not None:
+                call.hit = True
+                # Doesn't resolve the leaves of lazy outputs
+                call.bytes_read += stored_nbytes(output)
+            if self.hash_memo is not None:
+                self.hash_memo.register_output(output, key, self.name)
+        return output
+
+    def start_call(self, key: Optional[str] = None,
+                   hash_time: float = 0.) -> Optional[NodeCall]:
+        """NodeCall to fill in during a call, if the node has a sink"""
+        if self.sink is None:
+            return None
+        return NodeCall.start_now(self.name, key, hash_time)
+
+    def finish_call(self, call: Optional[NodeCall]):
+        """Sends a NodeCall from start_call to the sink"""
+        if call is not None:
+            call.finish()
+            self.sink.record(call)
+
+    def is_chunked(self, output) -> bool:
+        """Whether output is stored as chunks by the cache"""
+        return hasattr(self.cache, 'store_chunks') and (
+            inspect.isgenerator(output) or isinstance(output, ChunkedArray)
+        )
 
-    def __call__(self, *args, **kwargs):
+    def call_with_key(self, key: Optional[str], *args, **kwargs):
+        """Like __call__, but with a precomputed cache key"""
         if self.state == NodeState.SKIP:
             return None
-
+        call = self.start_call(key)
+        output = self._call_with_key(key, args, kwargs, call)
+        self.finish_call(call)
+        return output
+
+    def _call_with_key(self, key, args, kwargs, call=None):
+        if call is not None:
+            call.key = key
         if self.cache:
-            key = self.get_key(*args, **kwargs)
             if self.verbose:
                 print(f'> key: {key}')
-            output = None
-            if self.state == NodeState.RERUN:
-                output = self.func(*args, **kwargs)
-            else:
+            # Indexed caches rule out misses without reading anything
+            if (self.state != NodeState.RERUN
+                    and not self.cache.known_miss(key)):
                 # Try to load from the cache
-                if self.verbose:
-                    print(f'Loading cached output of {self.func.__name__}')
-                    if hasattr(self.cache, 'filepath'):
-                        print(f'> Attempting load from {self.cache.filepath}')
-                output = self.cache.load(
-                    key=key,
-                    device_idx=self.device_idx
-                )
+                output = self.load(key, call)
                 if output is not None:
-                    if self.verbose:
-                        print('> Load succeeded.')
                     return output
-                if self.verbose:
-                    print('> Load failed, recomputing...')
-                output = self.func(*args, **kwargs)
-            # Add to the cache
-            self.cache.store(
-                key=key,
-                data=output
-            )
+            if call is not None:
+                call.hit = False
+            with self.cache.lock(key):
+                if self.state != NodeState.RERUN:
+                    # Another process may have computed it while we waited
+                    if not self.cache.known_miss(key):
+                        output = self.load(key, call)
+                        if output is not None:
+                            return output
+                    if self.verbose:
+                        print('> Load failed, recomputing...')
+                if 'allocate' in self.signature.parameters \
+                        and hasattr(self.cache, 'allocate'):
+                    # Let func fill in a chunked array in the cache dir
+                    kwargs['allocate'] = functools.partial(
+                        self.cache.allocate, key)
+                start = time.perf_counter()
+                with timed(call, 'compute_time'):
+                    output = self.func(*args, **kwargs)
+                    if self.is_chunked(output):
+                        # Written chunk by chunk, then loaded back lazily.
+                        # This bypasses write-behind, which would hold on
+                        # to the (single use) generator
+                        if isinstance(output, ChunkedArray):
+                            self.cache.commit_chunks(key, output)
+                        else:
+                            self.cache.store_chunks(key, output)
+                runtime = time.perf_counter() - start
+                if self.is_chunked(output):
+                    with timed(call, 'load_time'):
+                        output = self.cache.load(key=key,
+                                                 device_idx=self.device_idx)
+                else:
+                    # Add to the cache
+                    with timed(call, 'store_time'):
+                        self.cache.store(
+                            key=key,
+                            data=output
+                        )
+                    if call is not None:
+                        call.bytes_written += nbytes(output)
+                self.cache.record_runtime(key, runtime, node=self.name)
+            if self.hash_memo is not None:
+                self.hash_memo.register_output(output, key, self.name)
 
             return output
-        return self.func(*args, **kwargs)
+        with timed(call, 'compute_time'):
+            output = self.func(*args, **kwargs)
+        if key is not None and self.hash_memo is not None:
+            self.hash_memo.register_output(output, key, self.name)
+        return output
+
+    def __call__(self, *args, **kwargs):
+        if self.state == NodeState.SKIP:
+            return None
+        call = self.start_call()
+        key = None
+        if self.needs_key:
+            with timed(call, 'hash_time'):
+                key = self.get_key(*args, **kwargs)
+        output = self._call_with_key(key, args, kwargs, call)
+        self.finish_call(call)
+        return output
 
     def __repr__(self):
         return f'{self.__class__.__name__}(' \
@@ -105,8 +339,11 @@ class PipelineConfig:
 
 
 class DataPipeline:
-    def __init__(self):
+    def __init__(self, hash_memo: Optional[HashMemo] = None):
         self.graph = nx.DiGraph()
+        # Shared by all nodes so that each array is hashed once per run
+        self.hash_memo = hash_memo or HashMemo()
+        self.sink: Optional[Sink] = None
 
     def add(self, deps, **node_kwargs):
         """Decorator version"""
@@ -125,18 +362,29 @@ class DataPipeline:
             deps: List[Node],
         ):
 
+        if node.hash_memo is None:
+            node.hash_memo = self.hash_memo
+        if node.sink is None:
+            node.sink = self.sink
         self.graph.add_node(node.name, node=node)
         for dep in deps:
             assert isinstance(dep, Node), f'dep {dep} must be a node'
             self.graph.add_edge(dep.name, node.name)
+            if dep not in node.upstream:
+                node.upstream.append(dep)
+            if node not in dep.downstream:
+                dep.downstream.append(node)
         return node
 
     def configure_deps(self, targets, reruns):
         """
         targets: list of nodes whose outputs we want (None = all nodes)
         reruns: list of nodes to force rerun
+        States left by a previous configuration are reset first.
         """
         assert nx.is_directed_acyclic_graph(self.graph)
+        for _, node in self.graph.nodes(data='node'):
+            node.state = NodeState.DEFAULT
         if len(targets) != 0:
             all_ancestors = set()
             for target in targets:
@@ -164,6 +412,144 @@ class DataPipeline:
 
         return rungraph
 
+    def run(self,
+            targets: Optional[List[str]] = None,
+            reruns: Optional[List[str]] = None,
+            inputs: Optional[Dict[str, Any]] = None,
+            max_workers: Optional[int] = None):
+        """Runs the nodes needed for targets, feeding each node the outputs
+        of its deps (see Node.bind_inputs). Nodes whose deps are done are run
+        concurrently on a thread pool.
+
+        Keys are computed up front from upstream keys (see Node.graph_key),
+        so a node whose output is cached is loaded without materializing
+        any of its ancestors. Only the ancestors of uncached nodes are run
+        or loaded. These are the same keys as those of nodes called by hand
+        on the outputs of their deps (see Node.get_key). Nodes without a
+        cache or cached descendants get no key.
+
+        targets: names of nodes whose outputs we want (empty = all nodes)
+        reruns: names of nodes to force rerun (see configure_deps)
+        inputs: extra arguments, passed to any node with a parameter of
+          that name
+        max_workers: number of threads (1 = run serially)
+
+        Returns a dict of node name -> output for the targets (or for all
+        nodes if no targets were given).
+        """
+        targets = targets or []
+        rungraph = self.configure_deps(targets, reruns or [])
+        keep = set(targets) if len(targets) > 0 else set(rungraph.nodes)
+        nodes = {name: rungraph.nodes[name]['node'] for name in rungraph}
+
+        # Keys are only computed for cached nodes and their ancestors
+        order = list(nx.topological_sort(rungraph))
+        uses_key = set()
+        for name in reversed(order):
+            if nodes[name].cache is not None or any(
+                succ in uses_key for succ in rungraph.successors(name)
+            ):
+                uses_key.add(name)
+        keys = {}
+        hash_times = {}
+        for name in order:
+            if name not in uses_key:
+                keys[name] = None
+                continue
+            upstream_keys = {dep: keys[dep]
+                             for dep in rungraph.predecessors(name)}
+            start = time.perf_counter()
+            keys[name] = nodes[name].graph_key(upstream_keys, inputs)
+            hash_times[name] = time.perf_counter() - start
+
+        needed = set()
+        hits = set() # Nodes that will be loaded from their cache
+        done = set()
+        outputs = {}
+
+        def require(name):
+            """Marks name as needed, along with the ancestors needed to
+            compute it if it isn't cached"""
+            if name in needed and (name in outputs or name not in done):
+                return
+            needed.add(name)
+            done.discard(name)
+            if nodes[name].is_cached(keys[name]):
+                hits.add(name)
+            else:
+                hits.discard(name)
+                for dep in rungraph.predecessors(name):
+                    require(dep)
+
+        for name in keep:
+            require(name)
+
+        def is_ready(name):
+            return name in hits or all(
+                dep in done for dep in rungraph.predecessors(name)
+            )
+
+        def release(name):
+            """Drops the output of name once nothing else needs it"""
+            if name in keep or name not in outputs:
+                return
+            for succ in rungraph.successors(name):
+                if succ in needed and succ not in hits and succ not in done:
+                    return
+            del outputs[name]
+
+        def call(name):
+            node = nodes[name]
+            # Keys were hashed up front, only the first call is charged
+            record = node.start_call(keys[name], hash_times.pop(name, 0.))
+            if name in hits:
+                output = node.load(keys[name], record)
+                if output is None:
+                    return None
+            else:
+                if node.state == NodeState.SKIP:
+                    return None
+                upstream = {dep: outputs[dep]
+                            for dep in rungraph.predecessors(name)}
+                output = node._call_with_key(
+                    keys[name], (), node.bind_inputs(upstream, inputs), record
+                )
+            node.finish_call(record)
+            return output
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+            while True:
+                for name in needed - done - set(running.values()):
+                    if is_ready(name):
+                        running[executor.submit(call, name)] = name
+                if len(running) == 0:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    output = future.result()
+                    if name in hits and output is None:
+                        # Cache entry vanished since it was checked
+                        hits.discard(name)
+                        for dep in rungraph.predecessors(name):
+                            require(dep)
+                        continue
+                    outputs[name] = output
+                    done.add(name)
+                    if name not in hits:
+                        for dep in rungraph.predecessors(name):
+                            release(dep)
+                    release(name)
+        self.flush()
+        return {name: outputs[name] for name in keep}
+
+    def flush(self):
+        """Waits for all background cache writes to finish"""
+        for _, node in self.graph.nodes(data='node'):
+            if hasattr(node.cache, 'flush'):
+                node.cache.flush()
+
     def set_cache_dir(self, cache_dir: Path):
         def configure(node):
             if node.cache is not None:
@@ -171,6 +557,84 @@ class DataPipeline:
             return node
         self.configure_nodes(func=configure)
 
+    def set_write_behind(self, max_pending_bytes: int = 2**30):
+        """Wraps every node's cache in a WriteBehindCache"""
+        def configure(node):
+            if (node.cache is not None
+                and not isinstance(node.cache, WriteBehindCache)):
+                node.cache = WriteBehindCache(node.cache, max_pending_bytes)
+            return node
+        self.configure_nodes(func=configure)
+
+    def set_memory_tier(self,
+                        max_bytes: int = 2**30,
+                        device_max_bytes: Optional[int] = None):
+        """Puts in-process memory tiers in front of every node's cache (see
+        cache.TieredCache). The tiers are shared by all nodes, so max_bytes
+        (host) and device_max_bytes (device-resident, disabled if None)
+        bound the memory used by the whole pipeline.
+        """
+        tiers = []
+        if device_max_bytes is not None:
+            tiers.append(MemoryCache(device_max_bytes, device_resident=True))
+        tiers.append(MemoryCache(max_bytes))
+        def configure(node):
+            if node.cache is not None:
+                cache = node.cache
+                if isinstance(cache, TieredCache):
+                    cache = cache.persistent
+                node.cache = TieredCache(tiers + [cache])
+            return node
+        self.configure_nodes(func=configure)
+
+    def set_sink(self, sink: Optional[Sink] = None) -> Sink:
+        """Sends a NodeCall for every node call to sink (default: a new
+        instrument.MemorySink), see report. Returns the sink."""
+        if sink is None:
+            sink = MemorySink()
+        self.sink = sink
+        def configure(node):
+            node.sink = sink
+            return node
+        self.configure_nodes(func=configure)
+        return sink
+
+    def node_stats(self) -> Dict[str, dict]:
+        """Totals per node of the calls recorded by the sink (see
+        instrument.summarize)"""
+        if self.sink is None:
+            return {}
+        return summarize(self.sink.records())
+
+    def report(self) -> str:
+        """Table of node_stats, with the nodes that took longest first"""
+        return format_summary(self.node_stats())
+
+    def save_trace(self, path: Path):
+        """Writes the calls recorded by the sink as a Chrome trace-event
+        timeline, which opens in chrome://tracing or Perfetto (see
+        instrument.trace_events)"""
+        assert self.sink is not None, 'No calls recorded, see set_sink'
+        save_trace(self.sink.records(), path)
+
+    def cache_stats(self) -> Dict[str, list]:
+        """Hits and misses per tier for each node with a TieredCache"""
+        return {name: node.cache.stats
+                for name, node in self.graph.nodes(data='node')
+                if isinstance(node.cache, TieredCache)}
+
+    def evict(self, max_bytes: int, policy: str = 'lru') -> list:
+        """Evicts cached outputs until each cache_dir used by the nodes'
+        caches fits in max_bytes (see cache.CacheManager)"""
+        cache_dirs = set()
+        for _, node in self.graph.nodes(data='node'):
+            if hasattr(node.cache, 'cache_dir'):
+                cache_dirs.add(Path(node.cache.cache_dir))
+        evicted = []
+        for cache_dir in sorted(cache_dirs):
+            evicted.extend(CacheManager(cache_dir, max_bytes, policy).evict())
+        return evicted
+
     def set_verbose(self, verbose: bool):
         def configure(node):
             node.verbose = verbose
@@ -183,6 +647,12 @@ class DataPipeline:
             return node
         self.configure_nodes(func=configure)
 
+    def set_hash_mode(self, hash_mode: str):
+        def configure(node):
+            node.hash_mode = hash_mode
+            return node
+        self.configure_nodes(func=configure)
+
     def configure_nodes(self, func, nodes=None):
         """
         func: inplace function to apply to seleted node objects
@@ -0,0 +1,129 @@
+import json
+import time
+
+import numpy as np
+
+from flow_utils.flow_cache import Inspect, ListEntries, Prune
+from pipeline_utils.cache import CacheManager, PklCache
+from pipeline_utils.index import CacheIndex
+from pipeline_utils.pipeline import DataPipeline
+
+
+def test_index_entries(tmp_path):
+    index = CacheIndex(tmp_path)
+    assert not index.contains('step1', 'step1(0)')
+    index.update('step1', 'step1(0)', runtime=2.)
+    # Metadata only, nothing stored yet
+    assert not index.contains('step1', 'step1(0)')
+    index.update('step1', 'step1(0)', file='a.pkl', size=10, created=1.,
+                 blobs=['abc'])
+    index.update('step1', 'step1(0)', created=5.)
+    assert index.contains('step1', 'step1(0)')
+    assert index.get('step1', 'step1(0)') == {
+        'file': 'a.pkl', 'size': 10, 'created': 1., 'runtime': 2.,
+        'blobs': ['abc'],
+    }
+    index.update('step2', 'step2(0)', file='b.pkl', size=5)
+    assert index.caches() == ['step1', 'step2']
+    assert index.nbytes() == 15
+    index.remove('step1', 'step1(0)')
+    assert index.entries() == {('step2', 'step2(0)'): {'file': 'b.pkl',
+                                                       'size': 5}}
+
+
+def test_touch_batched(tmp_path):
+    index = CacheIndex(tmp_path)
+    index.touch_interval = 60.
+    now = time.time()
+    index.update('step1', 'step1(0)', file='a.pkl', size=10, accessed=now)
+    index.touch('step1', 'step1(0)', now + 1)
+    index.touch('step1', 'step1(0)', now + 2)
+    # The first touch is written, later ones wait for the next batch
+    other = CacheIndex(tmp_path)
+    assert other.get('step1', 'step1(0)')['accessed'] == now + 1
+    assert index.get('step1', 'step1(0)')['accessed'] == now + 2
+    assert other.get('step1', 'step1(0)')['accessed'] == now + 2
+
+
+def test_journal_mode(tmp_path):
+    index = CacheIndex(tmp_path)
+    mode = lambda index: index.connection().execute(
+        'PRAGMA journal_mode').fetchone()[0]
+    assert mode(index) == 'delete'
+    index.update('step1', 'step1(0)', file='a.pkl', size=10)
+    index.connection().close()
+    index._local.conn = None
+
+    wal_index = CacheIndex(tmp_path)
+    wal_index.wal = True
+    assert mode(wal_index) == 'wal'
+    assert wal_index.contains('step1', 'step1(0)')
+    wal_index.connection().close()
+    wal_index._local.conn = None
+    # Switched back by the next default connection
+    assert mode(CacheIndex(tmp_path)) == 'delete'
+
+
+def test_node_records_producer(tmp_path):
+    pipeline = DataPipeline()
+
+    @pipeline.add(deps=[], cache=PklCache('step1.pkl', cache_dir=tmp_path),
+                  name='first')
+    def step1(a):
+        return np.arange(a)
+
+    step1(3)
+    (entry,) = step1.cache.read_index().values()
+    assert entry['node'] == 'first'
+    assert entry['runtime'] >= 0
+    assert step1.cache.known_miss(step1.get_key(4))
+    assert not step1.cache.known_miss(step1.get_key(3))
+
+
+def test_migrate_json_index(tmp_path):
+    cache = PklCache('step1.pkl', cache_dir=tmp_path)
+    cache.store('step1(0)', 0)
+    entry = cache.read_index()['step1(0)']
+    # Rewrite in the old layout
+    CacheIndex(tmp_path).remove('step1', 'step1(0)')
+    with open(cache.legacy_index_path, 'w') as f:
+        json.dump({'step1(0)': entry}, f)
+
+    cache = PklCache('step1.pkl', cache_dir=tmp_path)
+    assert 'step1(0)' in cache
+    assert cache.read_index()['step1(0)'] == entry
+    assert not cache.legacy_index_path.is_file()
+
+
+def test_prune(tmp_path):
+    step1 = PklCache('step1.pkl', cache_dir=tmp_path)
+    step2 = PklCache('step2.pkl', cache_dir=tmp_path)
+    step1.store('step1(0)', np.zeros(100))
+    step1.record_runtime('step1(0)', 1., node='step1')
+    step2.store('step2(0)', np.zeros(100))
+    step2.record_runtime('step2(0)', 1., node='step2')
+    step2.store('step2(1)', np.zeros(100))
+    step2.shard_path('step2(1)').unlink()
+
+    manager = CacheManager(tmp_path)
+    assert len(manager.entries()) == 3
+    pruned = manager.prune(node='step2', dry_run=True)
+    assert sorted(key for _, key in pruned) == ['step2(0)', 'step2(1)']
+    assert len(manager.entries()) == 3
+    # Missing files are always pruned
+    assert [key for _, key in manager.prune()] == ['step2(1)']
+    assert manager.prune(accessed_before=time.time() - 60) == []
+    assert [key for _, key in manager.prune(node='step2')] == ['step2(0)']
+    assert list(manager.entries()) == [('step1', 'step1(0)')]
+
+
+def test_cli(tmp_path, capsys):
+    cache = PklCache('step1.pkl', cache_dir=tmp_path)
+    cache.store('step1(0)', np.zeros(100))
+    ListEntries(cache_dir=tmp_path).run()
+    assert 'step1\tstep1(0)' in capsys.readouterr().out
+    Inspect('step1(0)', cache_dir=tmp_path).run()
+    assert 'file:' in capsys.readouterr().out
+    Prune(cache_dir=tmp_path, max_bytes=0).run()
+    assert 'Removed step1: step1(0)' in capsys.readouterr().out
+    assert cache.keys() == []
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from pipeline_utils.cache import ChunkedCache
+from pipeline_utils.chunked import ChunkedArray, write_chunks
+from pipeline_utils.hashing import hash_data
+from pipeline_utils.pipeline import DataPipeline
+
+
+def blocks(n_chunks, rows=100):
+    for i in range(n_chunks):
+        yield np.arange(i*rows*3, (i + 1)*rows*3, dtype=np.float32).reshape(rows, 3)
+
+
+def test_chunked_array_indexing(tmp_path):
+    arr = write_chunks(tmp_path/'arr', blocks(4))
+    expected = np.concatenate(list(blocks(4)))
+    assert arr.shape == expected.shape and len(arr) == 400
+    assert np.array_equal(arr[5], expected[5])
+    assert np.array_equal(arr[-1], expected[-1])
+    assert np.array_equal(arr[90:260], expected[90:260])
+    assert np.array_equal(arr[120:130, 1], expected[120:130, 1])
+    assert np.array_equal(arr[::7], expected[::7])
+    assert np.array_equal(np.asarray(arr), expected)
+    with pytest.raises(ValueError):
+        write_chunks(tmp_path/'bad', [np.zeros((2, 3)), np.zeros((2, 4))])
+
+
+def test_store_generator(tmp_path):
+    cache = ChunkedCache('big.pkl', cache_dir=tmp_path)
+    cache.store('big(0)', blocks(3))
+    out = cache.load('big(0)')
+    assert isinstance(out, ChunkedArray)
+    assert np.array_equal(out[:], np.concatenate(list(blocks(3))))
+    assert isinstance(out.chunk(0), np.memmap)
+    assert 'big(0)' in cache.keys()
+    assert cache.nbytes() >= out.nbytes
+    # Regular outputs are stored as usual
+    cache.store('big(1)', {'a': np.ones(3)})
+    assert np.array_equal(cache.load('big(1)')['a'], np.ones(3))
+
+    cache.remove('big(0)')
+    assert cache.load('big(0)') is None
+    assert not cache.chunk_dir('big(0)').exists()
+
+
+def test_allocate(tmp_path):
+    cache = ChunkedCache('big.pkl', cache_dir=tmp_path)
+    arr = cache.allocate('big(0)', (10, 2), np.int64, chunk_rows=4)
+    arr[:] = 7
+    arr[3:6] = np.arange(6).reshape(3, 2)
+    cache.store('big(0)', arr)
+    out = cache.load('big(0)')
+    assert not out.writable
+    assert out.chunk_rows == [4, 4, 2]
+    expected = np.full((10, 2), 7)
+    expected[3:6] = np.arange(6).reshape(3, 2)
+    assert np.array_equal(out[:], expected)
+    # Only the committed chunk dir is left
+    assert [p.name for p in tmp_path.glob('big/*.chunks')] \
+        == [cache.chunk_dir('big(0)').name]
+
+
+def test_hash_uses_chunk_digests(tmp_path):
+    a = write_chunks(tmp_path/'a', blocks(2))
+    b = write_chunks(tmp_path/'b', blocks(2))
+    c = write_chunks(tmp_path/'c', blocks(3))
+    assert hash_data(a) == hash_data(b)
+    assert hash_data(a) != hash_data(c)
+
+
+def test_pipeline_chunked_nodes(tmp_path):
+    pipeline = DataPipeline()
+    calls = []
+
+    @pipeline.add(deps=[], cache=ChunkedCache('frames.pkl', cache_dir=tmp_path))
+    def frames(n: int):
+        calls.append('frames')
+        yield from blocks(n)
+
+    @pipeline.add(deps=[frames],
+                  cache=ChunkedCache('scaled.pkl', cache_dir=tmp_path))
+    def scaled(frames, allocate=None):
+        calls.append('scaled')
+        out = allocate(frames.shape, frames.dtype, chunk_rows=64)
+        for start in range(0, len(frames), 64):
+            out[start:start + 64] = frames[start:start + 64] * 2
+        return out
+
+    outputs = pipeline.run(inputs={'n': 3})
+    assert isinstance(outputs['scaled'], ChunkedArray)
+    assert np.array_equal(outputs['scaled'][:],
+                          np.concatenate(list(blocks(3))) * 2)
+    assert calls == ['frames', 'scaled']
+
+    outputs = pipeline.run(inputs={'n': 3})
+    assert calls == ['frames', 'scaled']
+    assert outputs['scaled'].chunk_rows == [64]*4 + [44]
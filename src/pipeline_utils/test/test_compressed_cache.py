@@ -0,0 +1,61 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pytest
+import torch
+
+from pipeline_utils.cache import CompressedPklCache, PklCache
+from pipeline_utils.compression import CODECS, buffer_kind
+
+
+@dataclass
+class Result:
+    mask: np.ndarray
+    res: torch.Tensor
+
+
+def make_data():
+    mask = np.zeros((256, 256), dtype=bool)
+    mask[100:150, 30:90] = True
+    return {
+        'mask': mask,
+        'result': Result(mask=mask.T, res=torch.arange(10000.)),
+        'small': np.arange(3, dtype=np.complex64),
+        'info': ['yes', 1, None],
+    }
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_roundtrip(tmp_path, codec):
+    cache = CompressedPklCache('step1.pkl', cache_dir=tmp_path, codec=codec,
+                               chunk_bytes=1000)
+    data = make_data()
+    cache.store('step1(0)', data)
+    out = cache.load('step1(0)')
+    expected = make_data()
+    assert np.array_equal(out['mask'], expected['mask'])
+    assert np.array_equal(out['result'].mask, expected['result'].mask)
+    assert torch.equal(out['result'].res, expected['result'].res)
+    assert np.array_equal(out['small'], expected['small'])
+    assert out['info'] == ['yes', 1, None]
+    out['mask'][0, 0] = True # Writable
+
+
+def test_smaller_than_pickle(tmp_path):
+    compressed = CompressedPklCache('step1.pkl', cache_dir=tmp_path/'zlib')
+    plain = PklCache('step1.pkl', cache_dir=tmp_path/'plain')
+    compressed.store('step1(0)', make_data())
+    plain.store('step1(0)', make_data())
+    assert compressed.nbytes() < plain.nbytes() / 4
+
+
+def test_select_codec(tmp_path):
+    cache = CompressedPklCache('step1.pkl', cache_dir=tmp_path,
+                               codec='zlib', dtype_codecs={'f': 'none'},
+                               min_bytes=100)
+    assert cache.select_codec(memoryview(np.ones(1000, bool))) == 'zlib'
+    assert cache.select_codec(memoryview(np.ones(1000))) == 'none'
+    assert cache.select_codec(memoryview(np.ones(10, bool))) == 'none'
+    assert buffer_kind(memoryview(np.ones(3, complex))) == 'c'
+    with pytest.raises(ValueError):
+        CompressedPklCache('step1.pkl', cache_dir=tmp_path, codec='nope')
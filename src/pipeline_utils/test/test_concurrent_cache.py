@@ -0,0 +1,73 @@
+import multiprocessing
+import time
+
+import numpy as np
+
+from pipeline_utils.cache import PklCache, MmapPklCache
+from pipeline_utils.pipeline import Node
+
+ctx = multiprocessing.get_context('fork')
+
+
+def store_keys(cache_dir, worker, n):
+    cache = PklCache('step1.pkl', cache_dir=cache_dir)
+    for i in range(n):
+        cache.store(f'step1({worker}, {i})', np.full(100, i))
+
+
+def test_concurrent_stores(tmp_path):
+    procs = [ctx.Process(target=store_keys, args=(tmp_path, w, 20))
+             for w in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    cache = PklCache('step1.pkl', cache_dir=tmp_path)
+    assert len(cache.keys()) == 80
+    assert np.array_equal(cache.load('step1(3, 19)'), np.full(100, 19))
+
+
+def slow_step(log_path, a):
+    with open(log_path, 'a') as f:
+        f.write('computed\n')
+    time.sleep(0.5)
+    return np.arange(a)
+
+
+def call_node(cache_dir, log_path, queue):
+    node = Node(slow_step, cache=MmapPklCache('slow.pkl', cache_dir=cache_dir))
+    queue.put(node(str(log_path), 10).tolist())
+
+
+def test_compute_once(tmp_path):
+    log_path = tmp_path/'log.txt'
+    queue = ctx.Queue()
+    procs = [ctx.Process(target=call_node, args=(tmp_path, log_path, queue))
+             for _ in range(3)]
+    for p in procs:
+        p.start()
+    outputs = [queue.get(timeout=30) for _ in procs]
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    assert outputs == [list(range(10))] * 3
+    assert log_path.read_text() == 'computed\n'
+
+
+def test_in_progress(tmp_path):
+    cache = PklCache('step1.pkl', cache_dir=tmp_path)
+    assert not cache.in_progress('step1(0)')
+    with cache.lock('step1(0)'):
+        assert cache.in_progress('step1(0)')
+    assert not cache.in_progress('step1(0)')
+
+
+def test_mmap_overwrite(tmp_path):
+    cache = MmapPklCache('step1.pkl', cache_dir=tmp_path)
+    cache.store('step1(0)', np.zeros(10))
+    out = cache.load('step1(0)')
+    cache.store('step1(0)', np.ones(10))
+    assert np.array_equal(out, np.zeros(10))
+    assert np.array_equal(cache.load('step1(0)'), np.ones(10))
+    assert len(list(cache.buffer_paths('step1(0)'))) == 1
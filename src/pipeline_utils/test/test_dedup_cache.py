@@ -0,0 +1,128 @@
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+
+from pipeline_utils.cache import (
+    BLOB_DIRNAME,
+    CacheManager,
+    DedupPklCache,
+    PklCache,
+    collect_garbage,
+)
+from pipeline_utils.hashing import HashMemo
+from pipeline_utils.index import CacheIndex
+
+
+@dataclass
+class Result:
+    image: np.ndarray
+    score: torch.Tensor
+
+
+def blob_files(cache_dir):
+    return sorted((cache_dir/BLOB_DIRNAME).glob('*/*.npy'))
+
+
+def test_roundtrip(tmp_path):
+    cache = DedupPklCache('step1.pkl', cache_dir=tmp_path)
+    image = np.random.rand(64, 64)
+    data = {'result': Result(image, torch.arange(2000.)),
+            'small': np.arange(3), 'info': ['a', None]}
+    cache.store('step1(0)', data)
+    # The stored data is left as it was
+    assert data['result'].image is image
+    out = cache.load('step1(0)')
+    assert np.array_equal(out['result'].image, image)
+    assert torch.equal(out['result'].score, torch.arange(2000.))
+    assert np.array_equal(out['small'], np.arange(3))
+    assert out['info'] == ['a', None]
+    assert len(blob_files(tmp_path)) == 2 # small array stays in the shard
+
+
+def test_shared_across_entries_and_caches(tmp_path):
+    image = np.random.rand(128, 128)
+    step1 = DedupPklCache('step1.pkl', cache_dir=tmp_path)
+    step2 = DedupPklCache('step2.pkl', cache_dir=tmp_path)
+    for i in range(3):
+        step1.store(f'step1({i})', {'input': image, 'i': i})
+    plain = PklCache('plain.pkl', cache_dir=tmp_path/'plain')
+    for i in range(3):
+        plain.store(f'step1({i})', {'input': image, 'i': i})
+    on_disk = sum(path.stat().st_size for path in tmp_path.rglob('*')
+                  if path.is_file() and 'plain' not in path.parts
+                  and not path.name.startswith(CacheIndex.filename))
+    assert on_disk < plain.nbytes() / 2
+
+    step2.store('step2(0)', Result(image.copy(), torch.zeros(1)))
+    # Same contents with a different shape is a different blob
+    step2.store('step2(1)', Result(image.reshape(-1), torch.zeros(1)))
+    assert len(blob_files(tmp_path)) == 2
+    assert step1.read_index()['step1(0)']['blobs'] \
+        == step2.read_index()['step2(0)']['blobs']
+
+
+def test_garbage_collection(tmp_path):
+    a, b = np.random.rand(100, 100), np.random.rand(100, 100)
+    cache = DedupPklCache('step1.pkl', cache_dir=tmp_path)
+    cache.store('step1(0)', [a, b])
+    cache.store('step1(1)', [a])
+    assert len(blob_files(tmp_path)) == 2
+
+    cache.remove('step1(0)')
+    assert len(blob_files(tmp_path)) == 1
+    assert np.array_equal(cache.load('step1(1)')[0], a)
+
+    # Blobs of a store in progress are registered in the index first, and
+    # kept until it commits
+    index = CacheIndex(tmp_path)
+    index.update('step1', 'step1(3)', pending_blobs=[cache.blob_name(b)])
+    cache.store('step1(2)', [b])
+    cache.remove('step1(2)')
+    assert len(blob_files(tmp_path)) == 2
+    index.remove('step1', 'step1(3)')
+    assert collect_garbage(tmp_path, grace=60) == 0
+    assert collect_garbage(tmp_path) > 0
+    assert len(blob_files(tmp_path)) == 1
+
+
+def test_evict_collects_garbage(tmp_path):
+    cache = DedupPklCache('step1.pkl', cache_dir=tmp_path)
+    for i in range(4):
+        cache.store(f'step1({i})', np.full(10000, i, dtype=np.float64))
+    CacheManager(tmp_path, max_bytes=200000).evict()
+    assert len(cache.keys()) == 2
+    assert len(blob_files(tmp_path)) == 2
+    cache.evict(max_bytes=100000)
+    assert len(blob_files(tmp_path)) == 1
+
+
+def test_shared_blobs_count_once(tmp_path):
+    cache = DedupPklCache('step1.pkl', cache_dir=tmp_path)
+    shared = np.random.rand(128, 128) # 131 KB
+    for i in range(5):
+        cache.store(f'step1({i})', {'input': shared, 'i': i})
+    assert cache.nbytes() < 140000
+    manager = CacheManager(tmp_path, max_bytes=300000)
+    assert manager.nbytes() == cache.nbytes()
+    assert manager.evict() == []
+    assert len(cache.keys()) == 5
+
+    # The blob is only freed with the last entry referencing it
+    own = np.random.rand(128, 128)
+    cache.store('step1(5)', {'input': own})
+    manager.max_bytes = 200000
+    evicted = manager.evict()
+    assert [key for _, key in evicted] \
+        == [f'step1({i})' for i in range(5)]
+    assert len(blob_files(tmp_path)) == 1
+    assert manager.nbytes() <= 200000
+
+
+def test_hash_memo(tmp_path):
+    memo = HashMemo(freeze_arrays=True)
+    cache = DedupPklCache('step1.pkl', cache_dir=tmp_path, hash_memo=memo)
+    image = np.random.rand(64, 64)
+    cache.store('step1(0)', image)
+    assert len(memo) == 1
+    assert np.array_equal(cache.load('step1(0)'), image)
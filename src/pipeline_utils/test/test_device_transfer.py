@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+import torch
+
+from pipeline_utils.cache import PklCache
+from pipeline_utils.conversion import (
+    DeviceArray,
+    PinnedPool,
+    host_view,
+    infer_all,
+    to_device,
+    to_host,
+    unpack_all,
+)
+
+
+def test_pool_reuses_buffers():
+    pool = PinnedPool(pin=False, max_bytes=2**12)
+    buf = pool.acquire(1000)
+    assert buf.numel() == 1024 and buf.dtype == torch.uint8
+    pool.release(buf)
+    assert pool.nbytes() == 1024
+    assert pool.acquire(600) is buf
+    assert pool.nbytes() == 0
+    big = pool.acquire(5000) # Too big to round up or keep
+    assert big.numel() == 5000 and not big.is_pinned()
+    pool.release(big)
+    assert pool.nbytes() == 0
+
+
+def test_large_transfers_streamed():
+    pool = PinnedPool(pin=False, max_bytes=2**10)
+    pool.chunk_bytes = 2**8
+    tensors = [torch.arange(100.), torch.arange(600, dtype=torch.int16),
+               torch.arange(300.).reshape(10, 30)[:, ::3], torch.ones(0)]
+    # The first fits in the pool, the others exceed it
+    arrays = to_host(tensors, pool)
+    for tensor, arr in zip(tensors, arrays):
+        assert np.array_equal(arr, tensor.numpy())
+        assert arr.dtype == tensor.numpy().dtype
+    assert pool.nbytes() <= pool.max_bytes
+
+    back = to_device(arrays, [torch.device('cpu')] * len(arrays), pool)
+    for tensor, out in zip(tensors, back):
+        assert torch.equal(out, tensor)
+    assert pool.nbytes() <= pool.max_bytes
+
+
+def test_staged_transfers_on_cpu():
+    pool = PinnedPool(pin=False)
+    tensors = [torch.arange(6.).reshape(2, 3), torch.ones(5, dtype=torch.int16),
+               torch.zeros(0), torch.arange(8.).reshape(2, 4)[:, ::2]]
+    arrays = to_host(tensors, pool)
+    for tensor, arr in zip(tensors, arrays):
+        assert np.array_equal(arr, tensor.numpy())
+        assert arr.dtype == tensor.numpy().dtype
+    assert pool.nbytes() > 0
+    # Results don't share the reused buffers
+    arrays[0][0, 0] = 100
+    assert to_host([tensors[1]], pool)[0].sum() == 5
+
+    back = to_device(arrays, [torch.device('cpu')] * len(arrays), pool)
+    assert torch.equal(back[1], tensors[1])
+    assert back[0][0, 0] == 100
+    back[1] += 1
+    assert torch.equal(to_device([arrays[1]], [torch.device('cpu')], pool)[0],
+                       tensors[1])
+
+
+def test_infer_unpack_all_cpu_fallback():
+    data = {'a': np.arange(3), 'b': [torch.ones(2), 'label']}
+    packed = infer_all(data)
+    assert isinstance(packed['b'][0], DeviceArray)
+    out = unpack_all(packed, device_idx=-1)
+    assert np.array_equal(out['a'], np.arange(3))
+    assert torch.equal(out['b'][0], torch.ones(2))
+    assert out['b'][1] == 'label'
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs CUDA')
+def test_infer_unpack_all_cuda():
+    tensors = [torch.rand(100, device='cuda') for _ in range(10)]
+    data = {'tensors': list(tensors), 'cpu': torch.ones(2)}
+    packed = infer_all(data)
+    assert all(leaf.device.type == 'cuda' for leaf in packed['tensors'])
+    out = unpack_all(packed)
+    for tensor, leaf in zip(tensors, out['tensors']):
+        assert leaf.device == tensor.device and torch.equal(leaf, tensor)
+    assert out['cpu'].device.type == 'cpu'
+
+
+def test_store_leaves_data_untouched(tmp_path, monkeypatch):
+    tensor = torch.arange(4.)
+    inner = [tensor, np.ones(3)]
+    data = {'pair': (inner, 'label')}
+    def no_unpack(*args, **kwargs):
+        raise AssertionError('store should not unpack')
+    monkeypatch.setattr(DeviceArray, 'unpack', no_unpack)
+    cache = PklCache('out.pkl', cache_dir=tmp_path)
+    cache.store('out(0)', data)
+    assert isinstance(data['pair'], tuple)
+    assert data['pair'][0] is inner and inner[0] is tensor
+    monkeypatch.undo()
+    out = cache.load('out(0)')
+    assert torch.equal(out['pair'][0][0], tensor)
+    assert isinstance(out['pair'], tuple)
+
+
+def test_host_view_cpu():
+    pool = PinnedPool(pin=False)
+    data = [torch.ones(2), np.zeros(3)]
+    with host_view(data, pool) as packed:
+        assert [leaf.mode for leaf in packed] == ['torch', 'numpy']
+        assert packed[1].arr is data[1]
+    assert pool.nbytes() == 0 # Nothing staged without GPU tensors
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs CUDA')
+def test_host_view_cuda():
+    pool = PinnedPool()
+    tensor = torch.rand(100, device='cuda')
+    with host_view({'x': tensor}, pool) as packed:
+        assert np.array_equal(packed['x'].arr, tensor.cpu().numpy())
+        assert pool.nbytes() == 0
+    assert pool.nbytes() > 0 # Released for reuse
@@ -0,0 +1,79 @@
+import time
+
+import numpy as np
+
+from pipeline_utils.cache import PklCache, CacheManager, select_evictions
+from pipeline_utils.pipeline import DataPipeline
+
+
+def test_select_evictions():
+    entries = {
+        'a': {'size': 100, 'accessed': 3, 'runtime': 10.},
+        'b': {'size': 100, 'accessed': 1, 'runtime': 100.},
+        'c': {'size': 100, 'accessed': 2},
+    }
+    assert select_evictions(entries, 300) == []
+    assert select_evictions(entries, 250, 'lru') == ['b']
+    assert select_evictions(entries, 150, 'lru') == ['b', 'c']
+    assert select_evictions(entries, 250, 'cost') == ['c']
+    assert select_evictions(entries, 150, 'cost') == ['c', 'a']
+    assert select_evictions(entries, 150, 'lru', protect={'b'}) == ['c', 'a']
+
+
+def test_index_metadata(tmp_path):
+    cache = PklCache('step1.pkl', cache_dir=tmp_path)
+    cache.store('step1(0)', np.zeros(1000))
+    cache.record_runtime('step1(0)', 2.5)
+    entry = cache.read_index()['step1(0)']
+    assert entry['size'] >= 8000
+    assert entry['runtime'] == 2.5
+    accessed = entry['accessed']
+    time.sleep(0.01)
+    cache.load('step1(0)')
+    assert cache.read_index()['step1(0)']['accessed'] > accessed
+
+
+def test_max_bytes_lru(tmp_path):
+    cache = PklCache('step1.pkl', cache_dir=tmp_path, max_bytes=25000)
+    for i in range(3):
+        cache.store(f'step1({i})', np.zeros(1000))
+        time.sleep(0.01)
+    assert sorted(cache.keys()) == ['step1(0)', 'step1(1)', 'step1(2)']
+    cache.load('step1(0)')
+    cache.store('step1(3)', np.zeros(1000))
+    assert sorted(cache.keys()) == ['step1(0)', 'step1(2)', 'step1(3)']
+    assert cache.load('step1(1)') is None
+    assert cache.nbytes() <= 25000
+    assert len(list(cache.shard_dir.glob('*.pkl'))) == 3
+
+
+def test_cache_manager(tmp_path):
+    cache1 = PklCache('step1.pkl', cache_dir=tmp_path)
+    cache2 = PklCache('step2.pkl', cache_dir=tmp_path)
+    cache1.store('step1(0)', np.zeros(1000))
+    cache2.store('step2(0)', np.zeros(1000))
+    cache1.record_runtime('step1(0)', 100.)
+    cache2.record_runtime('step2(0)', 1.)
+
+    manager = CacheManager(tmp_path, max_bytes=12000, policy='cost')
+    evicted = manager.evict()
+    assert [key for _, key in evicted] == ['step2(0)']
+    assert cache2.keys() == []
+    assert cache1.keys() == ['step1(0)']
+    assert manager.nbytes() <= 12000
+
+
+def test_pipeline_records_runtime(tmp_path):
+    pipeline = DataPipeline()
+
+    @pipeline.add(deps=[], cache=PklCache('step1.pkl', cache_dir=tmp_path))
+    def step1():
+        time.sleep(0.05)
+        return 1
+
+    step1()
+    (entry,) = step1.cache.read_index().values()
+    assert entry['runtime'] >= 0.05
+    evicted = pipeline.evict(max_bytes=0)
+    assert [key for _, key in evicted] == [step1.get_key()]
+    assert step1.cache.keys() == []
@@ -0,0 +1,119 @@
+from unittest import mock
+
+import numpy as np
+import torch
+
+from pipeline_utils import hashing
+from pipeline_utils.hashing import hash_data, HashMemo
+from pipeline_utils.pipeline import DataPipeline
+from pipeline_utils.cache import PklCache
+
+
+def count_digests():
+    return mock.patch.object(
+        hashing, 'array_digest', wraps=hashing.array_digest
+    )
+
+
+def test_memo_same_keys():
+    arr = np.random.randn(10)
+    memo = HashMemo()
+    assert hash_data([arr], memo=memo) == hash_data([arr])
+    assert hash_data([arr], mode='tree', memo=memo) \
+        == hash_data([arr], mode='tree')
+
+
+def test_memo_torch_version():
+    t = torch.arange(5.)
+    memo = HashMemo()
+    with count_digests() as digest:
+        h1 = hash_data(t, memo=memo)
+        assert hash_data(t, memo=memo) == h1
+        assert digest.call_count == 1
+        t.add_(1)
+        assert hash_data(t, memo=memo) != h1
+        assert digest.call_count == 2
+
+
+def test_memo_numpy_writeable():
+    arr = np.arange(5.)
+    memo = HashMemo()
+    with count_digests() as digest:
+        hash_data(arr, memo=memo)
+        hash_data(arr, memo=memo)
+        assert digest.call_count == 2  # Writable arrays are not memoized
+        arr.flags.writeable = False
+        hash_data(arr, memo=memo)
+        hash_data(arr, memo=memo)
+        assert digest.call_count == 3
+    memo = HashMemo(freeze_arrays=True)
+    arr2 = np.arange(5.)
+    hash_data(arr2, memo=memo)
+    assert not arr2.flags.writeable
+
+
+def test_memo_weakref():
+    memo = HashMemo()
+    t = torch.arange(5.)
+    hash_data(t, memo=memo)
+    assert len(memo) == 1
+    del t
+    assert len(memo) == 0
+
+
+def test_pipeline_shared_memo(tmp_path):
+    pipeline = DataPipeline()
+    pipeline.hash_memo.reuse_output_keys = True
+
+    @pipeline.add(deps=[], cache=PklCache('step1.pkl', cache_dir=tmp_path))
+    def step1():
+        return torch.arange(1000.)
+
+    @pipeline.add(deps=[step1], cache=PklCache('step2a.pkl', cache_dir=tmp_path))
+    def step2a(x):
+        return x + 1
+
+    @pipeline.add(deps=[step1], cache=PklCache('step2b.pkl', cache_dir=tmp_path))
+    def step2b(x):
+        return x + 2
+
+    with count_digests() as digest:
+        out = step1()
+        step2a(out)
+        step2b(out)
+        assert digest.call_count == 0
+
+
+def test_memo_numpy_writable_base():
+    arr = np.arange(5.)
+    view = arr[:]
+    view.flags.writeable = False
+    memo = HashMemo()
+    h1 = hash_data(view, memo=memo)
+    assert len(memo) == 0 # The base can still be written
+    arr[0] = 99
+    assert hash_data(view, memo=memo) == hash_data(view) != h1
+
+    arr.flags.writeable = False
+    view = arr[1:]
+    hash_data(view, memo=memo)
+    assert len(memo) == 1
+    memo = HashMemo(freeze_arrays=True)
+    arr2 = np.arange(5.)
+    hash_data(arr2[1:], memo=memo)
+    assert not arr2.flags.writeable
+    assert hashing.is_frozen(np.frombuffer(b'abcd', dtype=np.uint8))
+    assert not hashing.is_frozen(np.frombuffer(bytearray(4), dtype=np.uint8))
+
+
+def test_memo_module_parameters():
+    model = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.Linear(3, 1))
+    memo = HashMemo()
+    with count_digests() as digest:
+        key = hash_data(model, memo=memo)
+        assert hash_data(model, memo=memo) == key
+        assert digest.call_count == 4 # Each weight and bias once
+        with torch.no_grad():
+            model[1].bias.add_(1)
+        assert hash_data(model, memo=memo) != key
+        assert digest.call_count == 5
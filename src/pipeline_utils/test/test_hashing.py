@@ -1,11 +1,22 @@
+import copy
+from dataclasses import dataclass
+import datetime
+from decimal import Decimal
+from enum import Enum
+from functools import partial
 import hashlib
 import metrohash
 import json
+from pathlib import Path
 import struct
+import threading
 
 import numpy as np
+import pytest
+import torch
 
 from pipeline_utils.cache import hash_data, recursive_hash
+from pipeline_utils.hashing import hash_array_fast, hash_nested, register_hash
 from pipeline_utils.conversion import to_nested_mapping, recursive_map
 
 class TestClass:
@@ -93,6 +104,125 @@ def test_metrohashing():
     # print(hash_obj.hexdigest())
 
 
+def test_array_layout_hashing():
+    arr = np.arange(12, dtype=np.int32)
+    keys = {hash_data(arr), hash_data(arr.reshape(3, 4)),
+            hash_data(arr.view(np.float32)), hash_data(arr.view(np.uint8))}
+    assert len(keys) == 4
+    assert hash_data(torch.from_numpy(arr)) == hash_data(arr)
+
+
+def test_scalar_hashing():
+    values = [1, 1., True, '1', np.int64(1), np.float32(1), None, 1 + 0j]
+    assert len({hash_data(v) for v in values}) == len(values)
+    assert hash_data(0.1) == hash_data(np.float64(0.1))
+    assert hash_data(['ab']) != hash_data(['a', 'b'])
+    assert hash_data([[1], 2]) != hash_data([1, [2]])
+    assert hash_data({'a': 1}) != hash_data(['a', 1])
+
+
+def test_fast_fingerprint():
+    arr = np.arange(2**16, dtype=np.float64)
+    fast = partial(hash_array_fast, min_bytes=1024, blocks=4,
+                   block_bytes=64, samples=16)
+    def digest(arr):
+        digests = []
+        fast(arr, lambda x: digests.append(bytes(x)))
+        return digests
+    assert len(digest(arr)) == 5 # Block checksums and strided samples
+    changed = arr.copy()
+    changed[-1] = -1 # In the last block
+    assert digest(changed) != digest(arr)
+    changed = arr.copy()
+    changed[100] = -1 # Not sampled
+    assert digest(changed) == digest(arr)
+    assert digest(np.asfortranarray(arr.reshape(256, 256))) \
+        == digest(arr.reshape(256, 256))
+    assert digest(torch.from_numpy(arr)) == digest(arr)
+
+    small = np.arange(10.)
+    assert hash_data(small, mode='fast') == hash_data(small)
+
+def test_module_hashing():
+    torch.manual_seed(0)
+    model = torch.nn.Linear(3, 2)
+    key = hash_data(model)
+    assert hash_data(copy.deepcopy(model)) == key
+    model.register_forward_hook(lambda *args: None)
+    model.train(False)
+    assert hash_data(model) == key # Only the state_dict counts
+    with torch.no_grad():
+        model.weight[0, 0] += 1
+    assert hash_data(model) != key
+    assert hash_data(torch.nn.ReLU()) != hash_data(torch.nn.Tanh())
+
+
+class Color(Enum):
+    RED = 1
+    BLUE = 2
+
+
+@dataclass(slots=True)
+class Slotted:
+    x: int
+    y: list
+
+
+def test_registered_types():
+    assert hash_data(Path('a/b')) == hash_data(Path('a') / 'b')
+    assert hash_data(Path('a')) != hash_data('a')
+    assert hash_data(Color.RED) != hash_data(Color.BLUE)
+    assert hash_data(Color.RED) != hash_data(1)
+    assert hash_data(b'ab') == hash_data(bytearray(b'ab'))
+    assert hash_data(b'ab') != hash_data('ab')
+    assert hash_data({3, 'a', (1, 2)}) == hash_data({(1, 2), 'a', 3})
+    assert hash_data({1, 2}) != hash_data([1, 2])
+    # Hashed like an object with a __dict__
+    assert hash_data(Slotted(1, [2])) == hash_data({'x': 1, 'y': [2]})
+    assert hash_data(Slotted(1, [2])) != hash_data(Slotted(1, [3]))
+    with pytest.raises(TypeError, match='register_hash'):
+        hash_data(threading.Lock())
+
+
+def scaled(x, scale=2):
+    return x * scale
+
+
+def test_value_and_function_types():
+    values = [torch.device('cpu'), torch.device('cuda', 0), torch.float32,
+              torch.int64, np.dtype('float32'), np.dtype('int64'), np.add,
+              slice(1, 2), slice(1, 3), range(3), range(4),
+              datetime.date(2020, 1, 1), datetime.datetime(2020, 1, 1),
+              datetime.timedelta(days=1), scaled, len, partial(scaled, 1)]
+    digests = [hash_data(v) for v in values]
+    assert len(set(digests)) == len(values)
+    assert digests == [hash_data(copy.deepcopy(v)) for v in values]
+    assert hash_data(torch.float32) != hash_data(np.dtype('float32'))
+    # Functions by source and defaults, not by their (empty) __dict__
+    assert hash_data(scaled) != hash_data({})
+    assert hash_data(lambda x: x) != hash_data(lambda x: x + 1)
+    assert hash_data(partial(scaled, 1)) != hash_data(partial(scaled, 2))
+    fn = lambda x: x
+    assert hash_data(fn) == hash_data(fn)
+    # Other objects without __dict__ or __slots__ by their pickled state
+    assert hash_data(datetime.timezone.utc) \
+        != hash_data(datetime.timezone(datetime.timedelta(hours=1)))
+    assert hash_data(Decimal('1.5')) != hash_data(Decimal('2.5'))
+
+
+def test_register_hash():
+    class Handle:
+        def __init__(self, name):
+            self.name = name
+            self.lock = threading.Lock() # Not hashable by default
+
+    @register_hash(Handle)
+    def hash_handle(data, hash_fn, hash_array):
+        hash_nested(data.name, hash_fn, hash_array)
+
+    assert hash_data([Handle('a')]) == hash_data(['a'])
+    assert hash_data(Handle('a')) != hash_data(Handle('b'))
+
 
 if __name__ == '__main__':
     test_class_hashing()
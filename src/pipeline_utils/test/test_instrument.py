@@ -0,0 +1,124 @@
+import json
+
+import numpy as np
+
+from pipeline_utils.cache import PklCache
+from pipeline_utils.instrument import (
+    JsonlSink,
+    MemorySink,
+    NodeCall,
+    trace_events,
+)
+from pipeline_utils.lazy import Pending, is_lazy
+from pipeline_utils.pipeline import DataPipeline
+
+
+def make_pipeline(cache_dir):
+    pipeline = DataPipeline()
+
+    @pipeline.add(deps=[], cache=PklCache('step1.pkl', cache_dir=cache_dir))
+    def step1(n: int):
+        return np.arange(n, dtype=np.float64)
+
+    @pipeline.add(deps=[step1])
+    def step2(step1):
+        return step1.sum()
+
+    return pipeline
+
+
+def test_run_records_calls(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    sink = pipeline.set_sink()
+    pipeline.run(inputs={'n': 1000})
+    pipeline.run(inputs={'n': 1000})
+    records = sink.records()
+    assert [(call.node, call.hit) for call in records
+            if call.node == 'step1'] == [('step1', False), ('step1', True)]
+    miss, hit = [call for call in records if call.node == 'step1']
+    assert miss.bytes_written == 8000 and miss.bytes_read == 0
+    assert hit.bytes_read == 8000 and hit.bytes_written == 0
+    assert miss.hash_time > 0 and miss.store_time > 0
+    assert hit.load_time > 0 and hit.compute_time == 0
+    assert all(call.hit is None for call in records if call.node == 'step2')
+    assert all(call.peak_rss_increase is None or call.peak_rss_increase >= 0
+               for call in records)
+
+    stats = pipeline.node_stats()
+    assert stats['step1']['calls'] == 2
+    assert stats['step1']['hits'] == 1 and stats['step1']['misses'] == 1
+    assert stats['step2']['calls'] == 2
+    report = pipeline.report()
+    assert 'step1' in report and 'step2' in report
+
+
+def test_hand_call_records_hashing(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    sink = pipeline.set_sink(MemorySink())
+    step1 = pipeline.graph.nodes['step1']['node']
+    step1(10)
+    (call,) = sink.records()
+    assert call.key == step1.get_key(10)
+    assert call.hit is False
+    assert 0 < call.hash_time <= call.duration
+
+
+def test_lazy_load_counts_stored_bytes(tmp_path):
+    pipeline = DataPipeline()
+
+    @pipeline.add(deps=[],
+                  cache=PklCache('step1.pkl', cache_dir=tmp_path, lazy=True))
+    def step1(n: int):
+        return {'a': np.zeros(n), 'b': [np.ones(n, dtype=np.float32)]}
+
+    sink = pipeline.set_sink()
+    step1(10)
+    out = step1(10)
+    assert is_lazy(out)
+    assert sink.records()[-1].bytes_read == 120
+    # Counted without resolving the leaves
+    assert all(isinstance(v, Pending) for v in out._data.values())
+
+
+def test_jsonl_sink(tmp_path):
+    sink = JsonlSink(tmp_path/'calls.jsonl')
+    assert sink.records() == []
+    call = NodeCall.start_now('step1', 'step1(0)')
+    call.finish()
+    sink.record(call)
+    sink.record(NodeCall('step2', hit=True))
+    assert JsonlSink(tmp_path/'calls.jsonl').records() \
+        == [call, NodeCall('step2', hit=True)]
+
+
+def test_trace(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    pipeline.set_sink(JsonlSink(tmp_path/'calls.jsonl'))
+    pipeline.run(inputs={'n': 1000}, max_workers=2)
+    step1 = pipeline.graph.nodes['step1']['node']
+    step1(1000)
+    pipeline.save_trace(tmp_path/'trace.json')
+    with open(tmp_path/'trace.json', 'r') as f:
+        events = json.load(f)['traceEvents']
+
+    calls = [e for e in events if e.get('cat') == 'node']
+    assert sorted(e['name'] for e in calls) == ['step1', 'step1', 'step2']
+    phases = [e for e in events if e['ph'] == 'X' and e['cat'] != 'node']
+    assert {e['name'] for e in phases} == {'hash', 'load', 'compute', 'store'}
+    for span in phases:
+        # Each span lies within a call on the same track
+        assert any(call['tid'] == span['tid'] and call['pid'] == span['pid']
+                   and call['ts'] <= span['ts']
+                   and span['ts'] + span['dur'] <= call['ts'] + call['dur']
+                   for call in calls)
+    (store,) = [e for e in phases if e['name'] == 'store']
+    assert store['args']['bytes'] == 8000
+    assert {e['name'] for e in events if e['ph'] == 'M'} \
+        == {'thread_name', 'process_name'}
+
+
+def test_trace_events_without_spans():
+    call = NodeCall('step1', 'step1(0)', start=1., duration=2., hash_time=.5)
+    (event, *_) = trace_events([call])
+    assert event['ts'] == 1e6 and event['dur'] == 2e6
+    assert event['args']['hash_time'] == .5
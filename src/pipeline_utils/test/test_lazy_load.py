@@ -0,0 +1,102 @@
+import copy
+from dataclasses import dataclass, fields
+import pickle
+
+import numpy as np
+import torch
+
+from pipeline_utils.cache import MmapPklCache, PklCache
+from pipeline_utils.conversion import (
+    DeviceArray,
+    is_leaf,
+    recursive_apply_inplace_with_stop,
+)
+from pipeline_utils.hashing import hash_data
+from pipeline_utils.lazy import (
+    LazyMapping,
+    LazySequence,
+    is_lazy,
+    lazy_view,
+    materialize,
+)
+
+
+@dataclass
+class Result:
+    image: np.ndarray
+    score: torch.Tensor
+    extra: list
+
+
+def make_data():
+    return {'result': Result(np.ones((4, 4)), torch.arange(3.),
+                             [np.zeros(2), {'a': torch.ones(1)}]),
+            'name': 'step1'}
+
+
+def test_leaves_resolved_on_access():
+    unpacked = []
+
+    def unpack(leaf):
+        unpacked.append(leaf)
+        return DeviceArray.unpack(leaf)
+
+    data = make_data()
+    data = recursive_apply_inplace_with_stop(data, DeviceArray.infer, is_leaf)
+    view = lazy_view(data, unpack)
+    assert isinstance(view, LazyMapping)
+    result = view['result']
+    assert isinstance(result, Result) and is_lazy(result)
+    assert unpacked == []
+    assert torch.equal(result.score, torch.arange(3.))
+    assert len(unpacked) == 1
+    assert result.score is result.score # Resolved once
+    assert isinstance(result.extra, LazySequence)
+    assert torch.equal(result.extra[1]['a'], torch.ones(1))
+    assert len(unpacked) == 2
+    assert view['name'] == 'step1'
+
+
+def test_materialize_and_hash():
+    data = make_data()
+    view = lazy_view(copy.deepcopy(data), lambda x: x)
+    out = materialize(view)
+    assert type(out['result']) is Result
+    assert type(out['result'].extra) is list
+    assert hash_data(view) == hash_data(data)
+    assert [f.name for f in fields(view['result'])] == ['image', 'score', 'extra']
+    # Pickles as the plain structure
+    restored = pickle.loads(pickle.dumps(view))
+    assert type(restored['result']) is Result
+
+
+def test_lazy_cache_load(tmp_path):
+    for cache_type in [PklCache, MmapPklCache]:
+        cache = cache_type('step1.pkl', cache_dir=tmp_path, lazy=True)
+        cache.store('step1(0)', make_data())
+        out = cache.load('step1(0)', device_idx=-1)
+        assert is_lazy(out)
+        assert np.array_equal(out['result'].image, np.ones((4, 4)))
+        assert out['result'].score.device == torch.device('cpu')
+        assert torch.equal(out['result'].extra[1]['a'], torch.ones(1))
+        # Can be stored again, e.g. by another cache
+        cache.store('step1(1)', out)
+        out = cache.load('step1(1)')
+        assert torch.equal(out['result'].score, torch.arange(3.))
+
+
+@dataclass
+class Point:
+    x: float
+    label: str
+
+
+def test_lazy_objects_compare_equal(tmp_path):
+    cache = PklCache('points.pkl', cache_dir=tmp_path, lazy=True)
+    cache.store('p', {'point': Point(1., 'a')})
+    out = cache.load('p')['point']
+    assert type(out) is not Point
+    assert out == Point(1., 'a') and Point(1., 'a') == out
+    assert out != Point(2., 'a')
+    eager = cache.load('p', lazy=False)['point']
+    assert type(eager) is Point and eager == out
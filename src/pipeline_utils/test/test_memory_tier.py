@@ -0,0 +1,98 @@
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+
+from pipeline_utils.cache import MemoryCache, PklCache, TieredCache
+from pipeline_utils.pipeline import DataPipeline
+
+
+@dataclass
+class Result:
+    res1: np.ndarray
+    res2: torch.Tensor
+
+
+def test_memory_cache_lru():
+    cache = MemoryCache(max_bytes=200)
+    cache.store('a', np.zeros(10))
+    cache.store('b', np.zeros(10))
+    cache.load('a')
+    cache.store('c', np.zeros(10))
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+    assert cache.nbytes() == 160
+    cache.store('d', np.zeros(100)) # Too big to hold
+    assert 'd' not in cache
+
+
+def test_memory_cache_structure():
+    cache = MemoryCache()
+    data = {'r': Result(np.arange(3), torch.ones(2)), 'l': [1, 'yes']}
+    cache.store('a', data)
+    out = cache.load('a', device_idx=-1)
+    assert isinstance(data['r'].res2, torch.Tensor) # Not modified
+    assert out is not data and out['r'] is not data['r']
+    assert np.array_equal(out['r'].res1, np.arange(3))
+    assert torch.equal(out['r'].res2, torch.ones(2))
+    assert out['l'] == [1, 'yes']
+
+
+def test_memory_cache_copies_on_store(tmp_path):
+    cache = MemoryCache()
+    x, y = np.zeros(3), torch.zeros(3)
+    cache.store('a', {'x': x, 'y': y})
+    x += 5
+    y += 5
+    out = cache.load('a', device_idx=-1)
+    assert np.array_equal(out['x'], np.zeros(3))
+    assert torch.equal(out['y'], torch.zeros(3))
+
+    cache = TieredCache([MemoryCache(), PklCache('a.pkl', cache_dir=tmp_path)])
+    x = np.zeros(3)
+    cache.store('a', x)
+    x += 5
+    assert np.array_equal(cache.load('a'), np.zeros(3))
+
+
+def test_device_resident():
+    cache = MemoryCache(device_resident=True)
+    t = torch.ones(2)
+    cache.store('a', {'t': t})
+    assert cache.load('a')['t'] is t
+    assert cache.load('a', device_idx=-1)['t'] is t
+    if not torch.cuda.is_available():
+        assert cache.load('a', device_idx=0)['t'] is t # Falls back to cpu
+
+
+def test_tiered_cache(tmp_path):
+    memory = MemoryCache()
+    cache = TieredCache([memory, PklCache('step1.pkl', cache_dir=tmp_path)])
+    assert cache.load('a') is None
+    cache.store('a', np.arange(3))
+    assert np.array_equal(cache.load('a'), np.arange(3))
+    assert cache.stats == [{'hits': 1, 'misses': 1}, {'hits': 0, 'misses': 1}]
+
+    memory.clear()
+    assert np.array_equal(cache.load('a'), np.arange(3))
+    assert 'a' in memory # Promoted
+    assert cache.stats[1]['hits'] == 1
+    assert cache.cache_dir == tmp_path
+    assert cache.keys() == ['a']
+
+
+def test_pipeline_memory_tier(tmp_path, monkeypatch):
+    pipeline = DataPipeline()
+    calls = []
+
+    @pipeline.add(deps=[], cache=PklCache('step1.pkl'))
+    def step1():
+        calls.append('step1')
+        return np.arange(5)
+
+    pipeline.set_cache_dir(tmp_path)
+    pipeline.set_memory_tier(max_bytes=2**20)
+    step1()
+    monkeypatch.setattr(PklCache, 'load', lambda *args, **kwargs: None)
+    assert np.array_equal(step1(), np.arange(5))
+    assert calls == ['step1']
+    assert pipeline.cache_stats()['step1'][0]['hits'] == 1
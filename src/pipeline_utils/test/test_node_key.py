@@ -0,0 +1,169 @@
+import importlib
+import inspect
+import linecache
+import os
+from unittest import mock
+
+from pipeline_utils.fingerprint import normalize_source
+from pipeline_utils.pipeline import DataPipeline, Node
+
+
+def test_normalize_source():
+    src1 = '''
+def f(a, b=2):
+    return a + b
+'''
+    src2 = '''
+    def f(a,
+          b = 2):  # a comment
+        # Another comment
+
+        return (a + b)
+'''
+    src3 = '''
+def f(a, b=3):
+    return a + b
+'''
+    assert normalize_source(src1) == normalize_source(src2)
+    assert normalize_source(src1) != normalize_source(src3)
+
+
+def step(a, b=2):
+    return a + b
+
+
+def test_source_read_once():
+    node = Node(step)
+    with mock.patch.object(
+            inspect, 'getsource', wraps=inspect.getsource
+    ) as getsource:
+        key = node.get_key(1)
+        for _ in range(5):
+            assert node.get_key(1) == key
+            assert node.get_key(a=1, b=2) == key
+        assert getsource.call_count == 1
+    assert node.get_key(1, b=3) != key
+
+
+def write_module(path, src):
+    """Writes src and bumps the mtime, even on filesystems with coarse
+    timestamps"""
+    mtime = path.stat().st_mtime_ns if path.exists() else 0
+    path.write_text(src)
+    os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+
+
+def test_source_refreshed_on_mtime(tmp_path, monkeypatch):
+    module = tmp_path/'mod_node_key.py'
+    write_module(module, 'def f(a):\n    return a\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import mod_node_key
+    node = Node(mod_node_key.f)
+    fingerprint = node.code_fingerprint
+
+    write_module(module, 'def f(a):\n    return  a  # same\n')
+    assert node.code_fingerprint == fingerprint
+
+    write_module(module, 'def f(a):\n    return 2*a\n')
+    assert node.code_fingerprint != fingerprint
+
+
+def test_dependency_fingerprint(tmp_path, monkeypatch):
+    module = tmp_path/'mod_node_deps.py'
+    src = '''
+import math
+SCALE = {scale}
+PARAMS = {{'sizes': [1, {size}]}}
+
+class Helper:
+    def apply(self, a):
+        return a + {offset}
+
+def helper(a):
+    return Helper().apply(a) * SCALE * len(PARAMS['sizes'])
+
+def f(a):
+    return math.sqrt(helper(a))
+'''
+    write_module(module, src.format(scale=2, offset=1, size=2))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import mod_node_deps
+    node = Node(mod_node_deps.f)
+    fingerprint = node.code_fingerprint
+    key = node.get_key(1)
+
+    write_module(module, src.format(scale=3, offset=1, size=2))
+    importlib.reload(mod_node_deps)
+    assert node.code_fingerprint != fingerprint
+    write_module(module, src.format(scale=2, offset=2, size=2))
+    importlib.reload(mod_node_deps)
+    assert node.code_fingerprint != fingerprint
+    # Module-level containers are hashed by value
+    write_module(module, src.format(scale=2, offset=1, size=3))
+    importlib.reload(mod_node_deps)
+    assert node.code_fingerprint != fingerprint
+    write_module(module, src.format(scale=2, offset=1, size=2))
+    importlib.reload(mod_node_deps)
+    assert node.code_fingerprint == fingerprint
+    assert node.get_key(1) == key
+
+    node_no_deps = Node(mod_node_deps.f, track_dependencies=False)
+    fingerprint = node_no_deps.code_fingerprint
+    write_module(module, src.format(scale=3, offset=1, size=2))
+    importlib.reload(mod_node_deps)
+    assert node_no_deps.code_fingerprint == fingerprint
+
+
+def test_upstream_fingerprint():
+    pipeline = DataPipeline()
+
+    @pipeline.add(deps=[])
+    def step1():
+        return 1
+
+    @pipeline.add(deps=[step1])
+    def step2(x):
+        return x
+
+    fingerprint = step2.code_fingerprint
+    step1._fingerprint = 'changed'
+    step1._fingerprint_mtimes = {}
+    assert step2.code_fingerprint != fingerprint
+
+
+def test_fingerprint_without_source_file():
+    src = 'def f(a):\n    return a\n'
+    linecache.cache['<nodes>'] = (len(src), None, src.splitlines(True),
+                                  '<nodes>')
+    namespace = {}
+    exec(compile(src, '<nodes>', 'exec'), namespace)
+    for track_dependencies in [True, False]:
+        node = Node(namespace['f'], track_dependencies=track_dependencies)
+        assert node.get_key(1) == node.get_key(1)
+
+
+def test_fingerprint_ignores_runtime_mutation(tmp_path, monkeypatch):
+    module = tmp_path/'mod_node_seen.py'
+    write_module(module, '''
+SEEN = []
+LIMITS = (1, 2)
+
+def f(a):
+    SEEN.append(a)
+    return a + LIMITS[0]
+''')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import mod_node_seen
+    node = Node(mod_node_seen.f)
+    key = node.get_key(1)
+    node(1)
+    node._fingerprint = None # Recomputed as if in a new process
+    assert node.get_key(1) == key
+
+    seen = []
+    def g(a):
+        seen.append(a)
+        return a
+    fingerprint = Node(g).code_fingerprint
+    seen.append(1)
+    assert Node(g).code_fingerprint == fingerprint
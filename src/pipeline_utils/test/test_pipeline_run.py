@@ -0,0 +1,235 @@
+import threading
+import weakref
+
+import numpy as np
+import torch
+
+from pipeline_utils.pipeline import DataPipeline, NodeState
+from pipeline_utils.cache import PklCache
+
+
+def make_pipeline(cache_dir, calls):
+    pipeline = DataPipeline()
+
+    @pipeline.add(deps=[], cache=PklCache('step1.pkl', cache_dir=cache_dir))
+    def step1a():
+        calls.append('step1a')
+        return 1
+
+    @pipeline.add(deps=[])
+    def step1b():
+        calls.append('step1b')
+        return 2
+
+    @pipeline.add(deps=[step1a], cache=PklCache('step2.pkl', cache_dir=cache_dir))
+    def step2(step1: int):
+        calls.append('step2')
+        return step1 + 3
+
+    @pipeline.add(deps=[step1a, step2, step1b],
+                  cache=PklCache('step3.pkl', cache_dir=cache_dir))
+    def step3(step1a: int, step2: int, step1b: int, step3_arg: int):
+        calls.append('step3')
+        return step1a + step2 + step1b + step3_arg
+
+    @pipeline.add(deps=[step3])
+    def step4a(step3):
+        calls.append('step4a')
+        return step3 * 2
+
+    @pipeline.add(deps=[step2])
+    def step4b(step2):
+        calls.append('step4b')
+        return step2 * 3
+
+    return pipeline
+
+
+def test_run_all(tmp_path):
+    calls = []
+    pipeline = make_pipeline(tmp_path, calls)
+    outputs = pipeline.run(inputs={'step3_arg': 3}, max_workers=4)
+    assert outputs == {'step1a': 1, 'step1b': 2, 'step2': 4, 'step3': 10,
+                       'step4a': 20, 'step4b': 12}
+    assert sorted(calls) == sorted(outputs.keys())
+
+
+def test_run_targets_and_reruns(tmp_path):
+    calls = []
+    pipeline = make_pipeline(tmp_path, calls)
+    outputs = pipeline.run(targets=['step4b'])
+    assert outputs == {'step4b': 12}
+    assert sorted(calls) == ['step1a', 'step2', 'step4b']
+    assert pipeline.graph.nodes['step3']['node'].state == NodeState.SKIP
+
+    calls.clear()
+    pipeline = make_pipeline(tmp_path, calls)
+    outputs = pipeline.run(targets=['step4b'])
+    assert calls == ['step4b']  # step1a and step2 are cached
+
+    calls.clear()
+    pipeline = make_pipeline(tmp_path, calls)
+    outputs = pipeline.run(targets=['step4b'], reruns=['step2'])
+    assert sorted(calls) == ['step2', 'step4b']
+
+
+def test_run_concurrent():
+    pipeline = DataPipeline()
+    barrier = threading.Barrier(2, timeout=5)
+
+    @pipeline.add(deps=[])
+    def a():
+        barrier.wait()  # Deadlocks unless a and b run concurrently
+        return 1
+
+    @pipeline.add(deps=[])
+    def b():
+        barrier.wait()
+        return 2
+
+    @pipeline.add(deps=[a, b])
+    def c(a, b):
+        return a + b
+
+    assert pipeline.run(targets=['c'], max_workers=2) == {'c': 3}
+
+
+def test_run_prunes_cached_ancestors(tmp_path, monkeypatch):
+    calls = []
+    pipeline = make_pipeline(tmp_path, calls)
+    pipeline.run(targets=['step3'], inputs={'step3_arg': 3})
+
+    loaded = []
+    load = PklCache.load
+    def spy_load(self, key, device_idx=None):
+        loaded.append(self.filename)
+        return load(self, key, device_idx)
+    monkeypatch.setattr(PklCache, 'load', spy_load)
+
+    calls.clear()
+    pipeline = make_pipeline(tmp_path, calls)
+    outputs = pipeline.run(targets=['step3'], inputs={'step3_arg': 3})
+    assert outputs == {'step3': 10}
+    assert calls == []
+    assert loaded == ['step3.pkl']
+
+    # A different input changes step3's key only
+    loaded.clear()
+    pipeline = make_pipeline(tmp_path, calls)
+    outputs = pipeline.run(targets=['step3'], inputs={'step3_arg': 4})
+    assert outputs == {'step3': 11}
+    assert sorted(calls) == ['step1b', 'step3']
+    # step3 is a known miss in the index, so it is never read
+    assert sorted(loaded) == ['step1.pkl', 'step2.pkl']
+
+
+def test_run_cache_entry_vanishes(tmp_path, monkeypatch):
+    calls = []
+    pipeline = make_pipeline(tmp_path, calls)
+    pipeline.run(targets=['step4b'])
+
+    # step2 reports a hit but its entry is gone by the time it is loaded
+    load = PklCache.load
+    def flaky_load(self, key, device_idx=None):
+        if self.filename == 'step2.pkl' and 'step2' not in calls:
+            return None
+        return load(self, key, device_idx)
+    monkeypatch.setattr(PklCache, 'load', flaky_load)
+
+    calls.clear()
+    pipeline = make_pipeline(tmp_path, calls)
+    outputs = pipeline.run(targets=['step4b'])
+    assert outputs == {'step4b': 12}
+    assert sorted(calls) == ['step2', 'step4b']
+
+
+def test_run_twice(tmp_path):
+    calls = []
+    pipeline = make_pipeline(tmp_path, calls)
+    assert pipeline.run(targets=['step1a']) == {'step1a': 1}
+    assert pipeline.run(targets=['step4b']) == {'step4b': 12}
+
+    calls.clear()
+    pipeline.run(targets=['step2'], reruns=['step2'])
+    assert calls == ['step2']
+    assert pipeline.graph.nodes['step2']['node'].state == NodeState.RERUN
+    calls.clear()
+    assert pipeline.run(targets=['step2']) == {'step2': 4}
+    assert calls == []
+    assert pipeline.graph.nodes['step2']['node'].state == NodeState.DEFAULT
+
+
+def make_tensor_pipeline(cache_dir, calls):
+    pipeline = DataPipeline()
+
+    @pipeline.add(deps=[], cache=PklCache('a.pkl', cache_dir=cache_dir))
+    def a():
+        calls.append('a')
+        return torch.zeros(3)
+
+    @pipeline.add(deps=[a], cache=PklCache('b.pkl', cache_dir=cache_dir))
+    def b(a, scale: float):
+        calls.append('b')
+        return a + scale
+
+    return pipeline
+
+
+def test_run_matches_manual_keys(tmp_path):
+    calls = []
+    pipeline = make_tensor_pipeline(tmp_path, calls)
+    nodes = {name: node for name, node in pipeline.graph.nodes(data='node')}
+    nodes['b'](nodes['a'](), scale=2.)
+
+    calls.clear()
+    pipeline = make_tensor_pipeline(tmp_path, calls)
+    outputs = pipeline.run(targets=['b'], inputs={'scale': 2.})
+    assert torch.equal(outputs['b'], torch.full((3,), 2.))
+    assert calls == []
+    for name in ['a', 'b']:
+        assert len(nodes[name].cache.keys()) == 1
+
+
+def test_manual_keys_see_changed_outputs(tmp_path):
+    calls = []
+    pipeline = make_tensor_pipeline(tmp_path, calls)
+    nodes = {name: node for name, node in pipeline.graph.nodes(data='node')}
+    x = nodes['a']()
+    assert torch.equal(nodes['b'](x, scale=0.), torch.zeros(3))
+    x += 1 # No longer the cached output of a
+    assert torch.equal(nodes['b'](x, scale=0.), torch.ones(3))
+
+
+def test_memo_doesnt_hold_outputs(tmp_path):
+    pipeline = DataPipeline()
+
+    @pipeline.add(deps=[])
+    def a():
+        return {'x': np.zeros(10)}
+
+    @pipeline.add(deps=[a])
+    def b(a):
+        return 1
+
+    out = a()
+    ref = weakref.ref(out['x'])
+    del out
+    assert ref() is None
+    pipeline.run(targets=['b'])
+    assert len(pipeline.hash_memo._outputs) == 0
+
+
+def test_run_without_source(tmp_path):
+    namespace = {'DataPipeline': DataPipeline}
+    exec('''
+pipeline = DataPipeline()
+
+@pipeline.add(deps=[])
+def a():
+    return 1
+
+@pipeline.add(deps=[a])
+def b(a):
+    return a + 1
+''', namespace)
+    assert namespace['pipeline'].run(targets=['b']) == {'b': 2}
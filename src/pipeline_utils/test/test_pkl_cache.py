@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from pipeline_utils.cache import PklCache, MmapPklCache
+
+
+@dataclass
+class Result:
+    res1: np.ndarray
+    res2: torch.Tensor
+
+
+def test_store_load(tmp_path):
+    cache = PklCache('step1.pkl', cache_dir=tmp_path)
+    assert cache.load('step1(abc)') is None
+
+    cache.store('step1(abc)', {'a': np.arange(3), 'b': [1, 'yes']})
+    cache.store('step1(def)', Result(res1=np.ones(2),
+                                     res2=torch.tensor([3., 4.])))
+
+    out = cache.load('step1(abc)')
+    assert np.array_equal(out['a'], np.arange(3))
+    assert out['b'] == [1, 'yes']
+    out = cache.load('step1(def)')
+    assert isinstance(out.res2, torch.Tensor)
+    assert torch.equal(out.res2, torch.tensor([3., 4.]))
+
+
+def test_one_file_per_key(tmp_path):
+    cache = PklCache('step1.pkl', cache_dir=tmp_path)
+    for i in range(3):
+        cache.store(f'step1({i})', i)
+    shards = list(cache.shard_dir.glob('*.pkl'))
+    assert len(shards) == 3
+    assert sorted(cache.keys()) == ['step1(0)', 'step1(1)', 'step1(2)']
+    assert 'step1(1)' in cache
+    assert 'step1(3)' not in cache
+    assert not cache.filepath.exists()
+
+
+def test_migrate_single_file(tmp_path):
+    with open(tmp_path/'step1.pkl', 'wb') as f:
+        pickle.dump({'step1(0)': 0, 'step1(1)': np.arange(4)}, f)
+
+    cache = PklCache('step1.pkl', cache_dir=tmp_path)
+    assert cache.load('step1(0)') == 0
+    assert np.array_equal(cache.load('step1(1)'), np.arange(4))
+    assert not cache.filepath.exists()
+    assert sorted(cache.keys()) == ['step1(0)', 'step1(1)']
+
+
+def is_memmapped(arr):
+    while arr is not None:
+        if isinstance(arr, np.memmap):
+            return True
+        arr = getattr(arr, 'base', None)
+    return False
+
+
+def test_mmap_store_load(tmp_path):
+    cache = MmapPklCache('step1.pkl', cache_dir=tmp_path)
+    data = {
+        'a': np.arange(10.),
+        'b': [np.arange(6).reshape(2, 3).T, 'yes', None],
+        'c': Result(res1=np.ones(0), res2=torch.tensor([3., 4.])),
+    }
+    cache.store('step1(abc)', data)
+
+    out = cache.load('step1(abc)')
+    assert is_memmapped(out['a'])
+    assert np.array_equal(out['a'], np.arange(10.))
+    assert np.array_equal(out['b'][0], np.arange(6).reshape(2, 3).T)
+    assert out['b'][1:] == ['yes', None]
+    assert out['c'].res1.shape == (0,)
+    assert torch.equal(out['c'].res2, torch.tensor([3., 4.]))
+
+    # Copy-on-write: modifying the loaded output leaves the cache intact
+    out['a'][0] = -1.
+    assert cache.load('step1(abc)')['a'][0] == 0.
@@ -1,31 +1,260 @@
-import numpy as np
+"""Benchmarks of the hashing, conversion and caching hot paths. Run as a
+script, e.g.
+
+    python test_timings.py --out results.json
+    python test_timings.py --out new.json --baseline results.json
+
+Each benchmark is timed on nested structures of arrays over a grid of sizes,
+dtypes and nesting depths, keeping the best of several repeats. Results are
+saved as json; given a baseline, benchmarks slower than it by more than
+threshold are listed and the script exits with status 1.
+"""
+from dataclasses import dataclass
+import json
+from pathlib import Path
+import platform
+import sys
+import tempfile
 from time import perf_counter
-import metrohash
+from typing import Callable, Dict, Optional, Tuple
 
-from pipeline_utils.cache import hash_data
+import numpy as np
+import torch
+import tyro
 
+from pipeline_utils.cache import PklCache
+from pipeline_utils.conversion import (
+    DeviceArray,
+    copy_structure,
+    flatten,
+    is_leaf,
+    is_leaf_or_device_arr,
+    nbytes,
+    recursive_apply_inplace_with_stop,
+    to_nested_mapping,
+    unflatten,
+)
+from pipeline_utils.hashing import hash_data
+from pipeline_utils.pipeline import Node
 
-arr = np.random.randn(1_000_000_000)
 
-def time_hash_data():
-    start = perf_counter()
-    hash_data(arr)
-    total = perf_counter() - start
-    print(f'Hash data timing: {total}s')
+def make_data(size: int, dtype: str, depth: int, seed: int = 0):
+    """Nested dicts and lists with 2**depth array leaves holding size
+    elements in total"""
+    rng = np.random.default_rng(seed)
+    leaf_size = max(size >> depth, 1)
+    def make(depth):
+        if depth == 0:
+            return (rng.random(leaf_size) * 100).astype(dtype)
+        return {'a': make(depth - 1), 'b': [make(depth - 1), 'label'],
+                'meta': {'depth': depth}}
+    return make(depth)
+
+
+def identity(data, i):
+    return data
+
+
+# name -> function of (data, tmp_dir) returning the callable to time
+BENCHMARKS: Dict[str, Callable] = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+@benchmark
+def hash_flat(data, tmp_dir):
+    return lambda: hash_data(data)
+
+
+@benchmark
+def hash_tree(data, tmp_dir):
+    return lambda: hash_data(data, mode='tree')
+
+
+@benchmark
+def hash_fast(data, tmp_dir):
+    return lambda: hash_data(data, mode='fast')
+
+
+@benchmark
+def nested_mapping(data, tmp_dir):
+    return lambda: to_nested_mapping(data)
+
+
+@benchmark
+def apply_inplace(data, tmp_dir):
+    return lambda: recursive_apply_inplace_with_stop(
+        copy_structure(data), lambda x: x, is_leaf
+    )
+
+
+@benchmark
+def flatten_unflatten(data, tmp_dir):
+    def run():
+        leaves, spec = flatten(data)
+        return unflatten(spec, leaves)
+    return run
 
-def time_pure_hash():
+
+@benchmark
+def device_infer(data, tmp_dir):
+    return lambda: recursive_apply_inplace_with_stop(
+        copy_structure(data), DeviceArray.infer, is_leaf
+    )
+
+
+@benchmark
+def device_unpack(data, tmp_dir):
+    packed = recursive_apply_inplace_with_stop(
+        copy_structure(data), DeviceArray.infer, is_leaf
+    )
+    return lambda: recursive_apply_inplace_with_stop(
+        copy_structure(packed, is_leaf_or_device_arr),
+        DeviceArray.unpack, is_leaf_or_device_arr
+    )
+
+
+@benchmark
+def pkl_store(data, tmp_dir):
+    cache = PklCache('store.pkl', cache_dir=tmp_dir)
+    return lambda: cache.store('data(0)', data)
+
+
+@benchmark
+def pkl_load(data, tmp_dir):
+    cache = PklCache('load.pkl', cache_dir=tmp_dir)
+    cache.store('data(0)', data)
+    return lambda: cache.load('data(0)')
+
+
+@benchmark
+def node_miss(data, tmp_dir):
+    """Hashing the arguments, missing, computing and storing"""
+    node = Node(identity, cache=PklCache('miss.pkl', cache_dir=tmp_dir))
+    calls = iter(range(10**9))
+    return lambda: node(data, next(calls))
+
+
+@benchmark
+def node_hit(data, tmp_dir):
+    """Hashing the arguments and loading"""
+    node = Node(identity, cache=PklCache('hit.pkl', cache_dir=tmp_dir))
+    node(data, 0)
+    return lambda: node(data, 0)
+
+
+def time_call(func: Callable, repeats: int, min_time: float) -> float:
+    """Best time per call over repeats, each looping func for at least
+    min_time"""
     start = perf_counter()
-    metrohash.hash64_int(arr)
-    total = perf_counter() - start
-    print(f'MetroHash timing: {total}s')
+    func() # Warm up
+    number = max(1, int(min_time / max(perf_counter() - start, 1e-9)))
+    best = float('inf')
+    for _ in range(repeats):
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (perf_counter() - start) / number)
+    return best
+
+
+def run_benchmarks(sizes, dtypes, depths, repeats: int = 5,
+                   min_time: float = 0.05, only: Optional[str] = None,
+                   verbose: bool = True) -> dict:
+    """name[size=,dtype=,depth=] -> {'seconds', 'bytes', 'mb_per_s'}"""
+    results = {}
+    for size in sizes:
+        for dtype in dtypes:
+            for depth in depths:
+                data = make_data(size, dtype, depth)
+                for name, bench in BENCHMARKS.items():
+                    if only is not None and only not in name:
+                        continue
+                    label = f'{name}[size={size},dtype={dtype},depth={depth}]'
+                    with tempfile.TemporaryDirectory() as tmp_dir:
+                        seconds = time_call(bench(data, Path(tmp_dir)),
+                                            repeats, min_time)
+                    size_bytes = nbytes(data)
+                    results[label] = {
+                        'seconds': seconds,
+                        'bytes': size_bytes,
+                        'mb_per_s': size_bytes / seconds / 2**20,
+                    }
+                    if verbose:
+                        print(f'{label:<60} {seconds * 1e3:10.3f} ms '
+                              f'{size_bytes / seconds / 2**20:10.1f} MiB/s')
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """(label, baseline seconds, seconds) of the benchmarks more than
+    threshold (a fraction) slower than in baseline"""
+    regressions = []
+    for label, result in results.items():
+        if label not in baseline:
+            continue
+        before = baseline[label]['seconds']
+        if result['seconds'] > before * (1 + threshold):
+            regressions.append((label, before, result['seconds']))
+    return regressions
+
+
+def environment() -> dict:
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'torch': torch.__version__}
+
+
+@dataclass
+class Benchmark:
+    """Times the hashing, conversion and caching hot paths"""
+    out: Optional[Path] = None # Save results as json
+    baseline: Optional[Path] = None # Results to compare against
+    threshold: float = 0.25 # Allowed slowdown, as a fraction of baseline
+    sizes: Tuple[int, ...] = (2**10, 2**16, 2**22) # Elements per structure
+    dtypes: Tuple[str, ...] = ('uint8', 'float32', 'float64')
+    depths: Tuple[int, ...] = (0, 3) # Nesting levels
+    repeats: int = 5
+    only: Optional[str] = None # Only run benchmarks whose name contains this
+
+    def run(self) -> int:
+        results = run_benchmarks(self.sizes, self.dtypes, self.depths,
+                                 self.repeats, only=self.only)
+        if self.out is not None:
+            with open(self.out, 'w') as f:
+                json.dump({'environment': environment(),
+                           'results': results}, f, indent=2)
+        if self.baseline is None:
+            return 0
+        with open(self.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, self.threshold)
+        for label, before, after in regressions:
+            print(f'REGRESSION {label}: {before * 1e3:.3f} ms -> '
+                  f'{after * 1e3:.3f} ms ({after / before - 1:+.0%})')
+        print(f'{len(regressions)} regressions beyond {self.threshold:.0%}')
+        return 1 if regressions else 0
+
 
+def test_benchmarks(tmp_path):
+    """Runs every benchmark once on small data"""
+    args = Benchmark(out=tmp_path/'results.json', sizes=(256,),
+                     dtypes=('float32',), depths=(0, 2), repeats=1)
+    assert args.run() == 0
+    with open(args.out, 'r') as f:
+        results = json.load(f)['results']
+    assert len(results) == 2 * len(BENCHMARKS)
 
-def time_pkl():
-    pass
+    # A baseline twice as fast flags everything
+    baseline = {label: {'seconds': result['seconds'] / 2}
+                for label, result in results.items()}
+    assert len(compare(results, baseline, 0.25)) == len(results)
+    assert compare(results, results, 0.25) == []
 
-def time_npz():
-    pass
 
 if __name__ == '__main__':
-    time_hash_data()
-    time_pure_hash()
+    sys.exit(tyro.cli(Benchmark).run())
@@ -0,0 +1,50 @@
+"""Compares store/load throughput of CompressedPklCache codecs against
+PklCache. Run as a script."""
+from pathlib import Path
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+from pipeline_utils.cache import CompressedPklCache, PklCache
+from pipeline_utils.compression import CODECS
+
+
+def make_data(n=2**24):
+    """Sparse mask plus a low-entropy array, ~n bytes each"""
+    rng = np.random.default_rng(0)
+    mask = rng.random(n) < 0.01
+    levels = rng.integers(0, 4, n // 8).astype(np.float64)
+    return {'mask': mask, 'levels': levels}
+
+
+def time_cache(cache, data, repeats=3):
+    nbytes = sum(v.nbytes for v in data.values())
+    store = load = float('inf')
+    for i in range(repeats):
+        start = perf_counter()
+        cache.store(f'data({i})', data)
+        store = min(store, perf_counter() - start)
+        start = perf_counter()
+        cache.load(f'data({i})')
+        load = min(load, perf_counter() - start)
+    size = cache.nbytes() / repeats
+    print(f'{str(cache):<60} '
+          f'store: {nbytes / store / 2**20:8.1f} MiB/s  '
+          f'load: {nbytes / load / 2**20:8.1f} MiB/s  '
+          f'ratio: {nbytes / size:6.2f}')
+
+
+def time_codecs():
+    data = make_data()
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        time_cache(PklCache('pkl.pkl', cache_dir=tmp), data)
+        for codec in sorted(CODECS):
+            cache = CompressedPklCache(f'{codec}.pkl', cache_dir=tmp,
+                                       codec=codec)
+            time_cache(cache, data)
+
+
+if __name__ == '__main__':
+    time_codecs()
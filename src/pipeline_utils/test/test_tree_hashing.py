@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+from pipeline_utils.hashing import hash_array_tree, hash_data, iter_blocks
+
+
+def test_tree_hash_stable():
+    arr = np.random.randn(1000, 17)
+    assert hash_data(arr, mode='tree') == hash_data(arr.copy(), mode='tree')
+    assert hash_data(arr, mode='tree') != hash_data(arr + 1, mode='tree')
+
+
+def test_tree_hash_layout_independent():
+    arr = np.random.randn(300, 40)
+    view = np.asfortranarray(arr)
+    assert not view.flags.c_contiguous
+    for chunk_bytes in [8, 1000, 2**20]:
+        blocks = list(iter_blocks(view, chunk_bytes))
+        assert np.array_equal(np.concatenate(blocks), arr.reshape(-1))
+    assert hash_data(view, mode='tree') == hash_data(arr, mode='tree')
+    assert hash_data(arr[::2], mode='tree') == \
+        hash_data(np.ascontiguousarray(arr[::2]), mode='tree')
+
+
+def test_tree_hash_edge_cases():
+    for arr in [np.array(1.), np.zeros((0, 3)), np.ones(5, dtype=bool),
+                torch.arange(10)]:
+        hash_data({'arr': arr}, mode='tree')
+
+
+def test_tree_hash_splits_rows():
+    arr = np.random.randn(2, 1000)
+    blocks = list(iter_blocks(arr.T, 808))
+    assert [len(block) for block in blocks] == [101] * 19 + [81]
+    assert np.array_equal(np.concatenate(blocks), arr.T.reshape(-1))
+    assert hash_data(arr.T, mode='tree') == \
+        hash_data(np.ascontiguousarray(arr.T), mode='tree')
+    assert hash_data(arr, mode='tree') != hash_data(arr.T, mode='tree')
+
+
+def test_tree_hash_blocks_of_views():
+    arr = np.random.randn(5, 7, 9)
+    for view in [arr[::2, 1:, ::3], arr.transpose(2, 0, 1), arr[:, 3]]:
+        expected = np.ascontiguousarray(view)
+        for chunk_bytes in [8, 40, 200, 10000]:
+            blocks = list(iter_blocks(view, chunk_bytes))
+            assert np.array_equal(np.concatenate(blocks), expected.reshape(-1))
+            digests = []
+            hash_array_tree(view, digests.append, chunk_bytes=chunk_bytes)
+            expected_digests = []
+            hash_array_tree(expected, expected_digests.append,
+                            chunk_bytes=chunk_bytes)
+            assert digests == expected_digests
@@ -0,0 +1,85 @@
+from collections import defaultdict, namedtuple
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+
+from pipeline_utils.conversion import (
+    LEAF,
+    OBJECT,
+    flatten,
+    is_leaf,
+    map_leaves,
+    node_kind,
+    recursive_apply_inplace_with_stop,
+    to_nested_mapping,
+    unflatten,
+)
+from pipeline_utils.hashing import hash_data
+
+Point = namedtuple('Point', ['x', 'y'])
+
+
+@dataclass
+class Inner:
+    arr: np.ndarray
+    label: str
+
+
+@dataclass
+class Outer:
+    inner: Inner
+    items: list
+    scale: float = 1.
+
+
+def make_data():
+    return {
+        'outer': Outer(Inner(np.arange(3), 'a'), [torch.ones(2), None]),
+        'point': Point(1, (2., 'b')),
+        'counts': defaultdict(int, {'x': 3}),
+        7: [np.zeros((2, 2)), {'nested': 'c'}],
+    }
+
+
+def test_flatten_roundtrip():
+    data = make_data()
+    leaves, spec = flatten(data)
+    assert spec.num_leaves == len(leaves) == 11
+
+    visited = []
+    recursive_apply_inplace_with_stop(make_data(), visited.append, is_leaf)
+    assert [type(leaf) for leaf in leaves] == [type(v) for v in visited]
+
+    out = unflatten(spec, leaves)
+    assert out is not data
+    assert isinstance(out['outer'], Outer) and out['outer'] is not data['outer']
+    assert out['outer'].inner.arr is data['outer'].inner.arr
+    assert out['point'] == Point(1, (2., 'b'))
+    assert out['counts']['y'] == 0 # Keeps the default_factory
+    assert out[7][1] == {'nested': 'c'}
+
+
+def test_map_leaves_leaves_data_untouched():
+    data = make_data()
+    out = map_leaves(data, lambda x: x * 2 if isinstance(x, int) else x)
+    assert out['point'] == Point(2, (2., 'b'))
+    assert data['point'] == Point(1, (2., 'b'))
+    assert out['counts']['x'] == 6 and data['counts']['x'] == 3
+
+
+def test_node_kind():
+    assert node_kind(bool) == LEAF
+    assert node_kind(np.ndarray) == LEAF
+    assert node_kind(Outer) == OBJECT
+    stop = lambda x: is_leaf(x) or isinstance(x, list)
+    leaves, _ = flatten({'a': 1, 'b': [2]}, stop_cond=stop)
+    assert leaves == [1, [2]]
+
+
+def test_hash_matches_nested_mapping():
+    """Objects are hashed like the mapping of their attributes"""
+    data = make_data()
+    # to_nested_mapping can't rebuild these
+    del data['counts'], data['point']
+    assert hash_data(data) == hash_data(to_nested_mapping(data))
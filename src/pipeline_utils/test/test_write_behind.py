@@ -0,0 +1,137 @@
+import gc
+import threading
+import time
+import weakref
+
+import numpy as np
+import pytest
+import torch
+
+from pipeline_utils.cache import PklCache, WriteBehindCache
+from pipeline_utils.index import CacheIndex
+from pipeline_utils.pipeline import DataPipeline
+
+
+class BlockingCache(PklCache):
+    """PklCache whose stores wait until released"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.release = threading.Event()
+
+    def store(self, key, data):
+        assert self.release.wait(timeout=5)
+        super().store(key, data)
+
+
+def test_store_returns_immediately(tmp_path):
+    cache = WriteBehindCache(BlockingCache('step1.pkl', cache_dir=tmp_path))
+    data = {'a': np.arange(3), 'b': [torch.ones(2), 'yes']}
+    cache.store('step1(0)', data)
+
+    # Output is untouched and served from memory while pending
+    assert isinstance(data['b'][0], torch.Tensor)
+    assert 'step1(0)' in cache
+    out = cache.load('step1(0)')
+    assert np.array_equal(out['a'], np.arange(3))
+    assert 'step1(0)' not in cache.cache
+
+    cache.cache.release.set()
+    cache.flush()
+    assert 'step1(0)' in cache.cache
+    assert torch.equal(cache.cache.load('step1(0)')['b'][0], torch.ones(2))
+
+
+def test_pending_outputs_protected(tmp_path):
+    cache = WriteBehindCache(BlockingCache('step1.pkl', cache_dir=tmp_path))
+    base = np.arange(6.)
+    tensor = torch.zeros(2)
+    cache.store('step1(0)', {'view': base[:3], 'tensor': tensor})
+    cache.store('step1(1)', base)
+    with pytest.raises(ValueError, match='read-only'):
+        base[0] = 100 # Consumer writing to a pending output
+    tensor += 1 # Pending tensors are copies
+
+    cache.cache.release.set()
+    cache.flush()
+    out = cache.load('step1(0)')
+    assert out['view'][0] == 0 and torch.equal(out['tensor'], torch.zeros(2))
+    base[0] = 100 # Writable again once written
+    assert cache.load('step1(1)')[0] == 0
+
+
+def test_bounded_pending_bytes(tmp_path):
+    cache = WriteBehindCache(BlockingCache('step1.pkl', cache_dir=tmp_path),
+                             max_pending_bytes=100)
+    cache.store('step1(0)', np.zeros(10)) # 80 bytes
+    stored = threading.Event()
+    def store():
+        cache.store('step1(1)', np.zeros(10))
+        stored.set()
+    thread = threading.Thread(target=store)
+    thread.start()
+    assert not stored.wait(timeout=0.2) # Blocked on the budget
+    cache.cache.release.set()
+    assert stored.wait(timeout=5)
+    thread.join()
+    cache.flush()
+    assert sorted(cache.keys()) == ['step1(0)', 'step1(1)']
+
+
+def test_flush_raises_errors(tmp_path):
+    class FailingCache(PklCache):
+        def store(self, key, data):
+            raise RuntimeError('disk full')
+    cache = WriteBehindCache(FailingCache('step1.pkl', cache_dir=tmp_path))
+    cache.store('step1(0)', 1)
+    with pytest.raises(RuntimeError):
+        cache.flush()
+    cache.flush()
+
+
+def test_pending_load_applies_callbacks(tmp_path):
+    cache = WriteBehindCache(BlockingCache(
+        'step1.pkl', cache_dir=tmp_path,
+        store_callback=lambda x: {'stored': x},
+        load_callback=lambda x: x['stored'],
+    ))
+    cache.store('step1(0)', torch.ones(2))
+    out = cache.load('step1(0)', device_idx=-1)
+    assert isinstance(out, torch.Tensor) and out.device.type == 'cpu'
+    cache.cache.release.set()
+    cache.flush()
+    assert torch.equal(cache.load('step1(0)'), out)
+
+
+def test_collected_after_flush(tmp_path):
+    cache = WriteBehindCache(PklCache('step1.pkl', cache_dir=tmp_path))
+    cache.store('step1(0)', 1)
+    cache.flush()
+    ref = weakref.ref(cache)
+    del cache
+    # The writer thread exits shortly after the last store
+    deadline = time.time() + 5
+    while ref() is not None and time.time() < deadline:
+        gc.collect()
+        time.sleep(0.01)
+    assert ref() is None
+
+
+def test_pipeline_write_behind(tmp_path):
+    pipeline = DataPipeline()
+
+    @pipeline.add(deps=[], cache=PklCache('step1.pkl'))
+    def step1():
+        return np.arange(5)
+
+    @pipeline.add(deps=[step1], cache=PklCache('step2.pkl'))
+    def step2(step1):
+        return step1 + 1
+
+    pipeline.set_cache_dir(tmp_path)
+    pipeline.set_write_behind()
+    assert isinstance(step1.cache, WriteBehindCache)
+    assert step1.cache.cache_dir == tmp_path
+    outputs = pipeline.run(targets=['step2'])
+    assert np.array_equal(outputs['step2'], np.arange(1, 6))
+    assert len(step2.cache.cache.keys()) == 1
+    assert (tmp_path/CacheIndex.filename).is_file()